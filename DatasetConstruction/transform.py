@@ -6,18 +6,21 @@ import numpy as np
 import json
 import os
 import sys
+import argparse
+from multiprocessing import Pool
 
 fgd = set(json.load(open('stat/objlist.json')))
 img_paths = json.load(open('data/img_path.json'))
 objstat = dict()
 IMGNUM = 22210
 
-def transform_annotation(dir_path, img_id):
+def transform_annotation(dir_path, img_id, stat=None):
     """
     read the image and generate bounding box annotations into a json file
     json file is specified by [{obj:id, box:[]}]
     :param dir_path:
     :param img_path:
+    :param stat: dict counting the objects of each id, objstat by default
     :return: None
     """
     seg_path = img_paths[img_id][:-4] + "_seg.png"
@@ -34,71 +37,87 @@ def transform_annotation(dir_path, img_id):
     img = np.transpose(img, (2, 0, 1)).astype(np.int)
     [_, G, R] = img
     seg_maps = ((R/10 * 256) + G).astype(np.int)
-    annotation = search_object(seg_maps)
+    annotation = search_object(seg_maps, stat)
     result['annotation'] = annotation
     return result
 
 
-def search_object(seg_map):
+def search_object(seg_map, stat=None):
     """
     search for objects in the map
+    every 4-connected component of a foreground object id is an object
     format is specified by [{obj:id, box:[]}]
     :param seg_map: annotation map
+    :param stat: dict counting the objects of each id, objstat by default
     :return: a list of objects with their locations
     """
-    visiting_queue = []
-    directions = [[0, -1], [0, 1], [1, 0], [-1, 0]]
-    annotation_list = []
-    cur_obj = -1
+    if stat is None:
+        stat = objstat
+    components = []
     H, W = seg_map.shape
     area = H * W
 
-    for h in range(H):
-        for w in range(W):
-            if seg_map[h, w] == -1:
-                continue
-            if int(seg_map[h, w]) not in fgd:
-                continue
-            visiting_queue.append([h, w])
-            left = right = w
-            up = down = h
-            while visiting_queue:
-                cur_position = visiting_queue.pop()
-                if seg_map[cur_position[0], cur_position[1]] == -1:
-                    continue
-                cur_obj = seg_map[cur_position[0], cur_position[1]]
-                if int(cur_obj) not in fgd:
-                    continue
-                seg_map[cur_position[0], cur_position[1]] = -1
-
-                left = min(left, cur_position[1])
-                right = max(right, cur_position[1])
-                up = min(up, cur_position[0])
-                down = max(down, cur_position[0])
+    for obj in np.unique(seg_map):
+        if obj == -1 or int(obj) not in fgd:
+            continue
+        mask = (seg_map == obj).astype(np.uint8)
+        num, labels, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=4)
+        # position of the first pixel of each component in raster order
+        _, first_pixels = np.unique(labels.ravel(), return_index=True)
+        for k in range(1, num):
+            left = int(stats[k, cv2.CC_STAT_LEFT])
+            up = int(stats[k, cv2.CC_STAT_TOP])
+            right = left + int(stats[k, cv2.CC_STAT_WIDTH]) - 1
+            down = up + int(stats[k, cv2.CC_STAT_HEIGHT]) - 1
+            components.append((first_pixels[k], int(obj), left, right, up, down))
 
-                for direction in directions:
-                    new_position = [cur_position[0] + direction[0], cur_position[1] + direction[1]]
-                    if new_position[0] >= 0 and new_position[0] < H and new_position[1] >= 0 and new_position[1] < W:
-                        if seg_map[new_position[0], new_position[1]] == cur_obj:
-                            visiting_queue.append(new_position)
-            sample_area = (right - left) * (down - up)
-            if sample_area <= min(100, area / 900):
-                continue
-            if (right - left) / (down - up) < 10 and (right - left) / (down - up) > 1 / 10:
-                annotation_list.append({'obj': int(cur_obj), 'box': [left, right, up, down]})
-                cur_obj = int(cur_obj)
-                if cur_obj not in objstat:
-                    objstat[cur_obj] = 0
-                objstat[cur_obj] += 1
+    # keep the order of a raster scan over the map
+    components.sort()
+    annotation_list = []
+    for _, cur_obj, left, right, up, down in components:
+        sample_area = (right - left) * (down - up)
+        if sample_area <= min(100, area / 900):
+            continue
+        if (right - left) / (down - up) < 10 and (right - left) / (down - up) > 1 / 10:
+            annotation_list.append({'obj': cur_obj, 'box': [left, right, up, down]})
+            if cur_obj not in stat:
+                stat[cur_obj] = 0
+            stat[cur_obj] += 1
 
     return annotation_list
 
+
+def transform_worker(task):
+    """
+    transform one image in a worker process
+    :param task: (dir_path, img_id)
+    :return: annotation result and the object counts of this image
+    """
+    dir_path, img_id = task
+    stat = dict()
+    return transform_annotation(dir_path, img_id, stat), stat
+
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dir', default='../../')
+    parser.add_argument('--workers', default=8, type=int)
+    args = parser.parse_args()
+
     res = []
-    dir = "../../"
-    for i in range(IMGNUM):
-        res.append(transform_annotation(dir, i))
+    pool = Pool(args.workers)
+    tasks = [(args.dir, i) for i in range(IMGNUM)]
+    for i, (result, stat) in enumerate(pool.imap(transform_worker, tasks, chunksize=16)):
+        res.append(result)
+        # merge the object counts of every image
+        for obj, num in stat.items():
+            if obj not in objstat:
+                objstat[obj] = 0
+            objstat[obj] += num
+        if i % 1000 == 0:
+            print('{} / {}'.format(i, IMGNUM))
+    pool.close()
+    pool.join()
 
     json.dump(res, open('data/data_all.json', 'w'))
     json.dump(objstat, open('stat/occurrence.json', 'w'))
-
@@ -0,0 +1,72 @@
+"""
+memory and latency of the cosine classifier
+expand: cosine_similarity on the batch * class * dim expanded tensors, the former implementation
+matmul: cosine_logits, normalize the features and the weight, then a matrix product
+"""
+import sys
+sys.path.append('../')
+import time
+import argparse
+import torch
+import torch.nn.functional as F
+from model.component.classifier import CosClassifier, cosine_logits
+
+
+def expand_logits(module, feature):
+    batch_size = feature.size(0)
+    num_class, dim = module.weight.shape
+    return module.t.to(feature.device) * F.cosine_similarity(
+        feature.unsqueeze(1).expand(batch_size, num_class, dim),
+        module.weight.unsqueeze(0).expand(batch_size, num_class, dim), 2)
+
+
+def measure(func, module, feature, repeat):
+    """
+    :return: seconds per call and peak memory above the inputs in MB, the memory is only measured on cuda
+    """
+    is_cuda = feature.is_cuda
+    func(module, feature)
+    if is_cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+    start = time.time()
+    for i in range(repeat):
+        logits = func(module, feature)
+        del logits
+    if is_cuda:
+        torch.cuda.synchronize()
+    elapsed = (time.time() - start) / repeat
+    peak = (torch.cuda.max_memory_allocated() - base) / 1024 ** 2 if is_cuda else None
+    return elapsed, peak
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', default=299, type=int, help='instances in a batch')
+    parser.add_argument('--num_base_class', default=189, type=int)
+    parser.add_argument('--feat_dim', default=512, type=int)
+    parser.add_argument('--crop_height', default=3, type=int)
+    parser.add_argument('--crop_width', default=3, type=int)
+    parser.add_argument('--repeat', default=20, type=int)
+    parser.add_argument('--cpu', default=0, type=int, help='run on cpu even if cuda is available')
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() and not args.cpu else 'cpu'
+    module = CosClassifier(args).to(device)
+    module.eval()
+    dim = args.feat_dim * args.crop_height * args.crop_width
+    feature = torch.randn(args.batch_size, dim, device=device)
+
+    with torch.no_grad():
+        diff = (expand_logits(module, feature) - cosine_logits(module, feature)).abs().max().item()
+        print('max difference of the logits: {:.2e}'.format(diff))
+        # largest temporary of each implementation, used when the memory can not be measured
+        temporary = {'expand': args.batch_size * args.num_base_class * dim * 4 / 1024 ** 2,
+                     'matmul': (args.batch_size + args.num_base_class) * dim * 4 / 1024 ** 2}
+        for name, func in [('expand', expand_logits), ('matmul', cosine_logits)]:
+            elapsed, peak = measure(func, module, feature, args.repeat)
+            if peak is None:
+                print('{}: {:.2f} ms, largest temporary {:.1f} MB'.format(name, elapsed * 1000, temporary[name]))
+            else:
+                print('{}: {:.2f} ms, peak memory {:.1f} MB'.format(name, elapsed * 1000, peak))
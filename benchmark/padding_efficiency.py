@@ -0,0 +1,81 @@
+"""
+batches of an epoch under the groupings of build_epoch_sampler
+padding efficiency: ratio of the image pixels to the pixels of the batch tensors
+variation: coefficient of variation over the batches of the anchors and of the padded pixels,
+the backbone and RoI head work of a device
+anchor balance: mean over the steps of the mean to the max of the anchors of the devices
+two groups: h > w and h <= w, as BaseDataset._get_sub_batch groups the images
+the images are only listed, nothing is loaded
+"""
+import sys
+sys.path.append('../')
+import argparse
+import copy
+import numpy as np
+from dataset.proto_dataset import BaseProtoDataset
+from dataset.sampler import build_epoch_sampler
+
+
+def epoch_statistics(dataset, args, **options):
+    config = copy.copy(args)
+    for key, value in options.items():
+        setattr(config, key, value)
+    sampler = build_epoch_sampler(dataset, config)
+    grouping = sampler.batch_sampler
+    batches = sampler.epoch_batches(0)
+    anchors = np.minimum(dataset.sample_anchor_nums(), args.max_anchor_per_img)
+    batch_anchors, batch_pixels = [], []
+    for batch in batches:
+        batch_anchors.append(anchors[batch].sum())
+        batch_pixels.append(grouping.batch_pixels(batch)[1])
+    batch_anchors, batch_pixels = np.array(batch_anchors), np.array(batch_pixels)
+    # the devices of a step wait for the one with the most anchors
+    step_anchors = batch_anchors.reshape(-1, args.devices)
+    return {'efficiency': sampler.padding_efficiency(0), 'batches': len(batches),
+            'images': len(dataset.sample_anchor_nums()) / len(batches),
+            'anchor_variation': batch_anchors.std() / batch_anchors.mean(),
+            'pixel_variation': batch_pixels.std() / batch_pixels.mean(),
+            'max_anchors': batch_anchors.max(), 'max_pixels': batch_pixels.max(),
+            'balance': (step_anchors.mean(1) / step_anchors.max(1)).mean()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--list', default='../data/ADE/ADE_Base/base_img_train.json',
+                        help='list of the samples or folder of a compiled index')
+    parser.add_argument('--imgShortSize', default=800, type=int)
+    parser.add_argument('--imgMaxSize', default=1500, type=int)
+    parser.add_argument('--padding_constant', default=8, type=int)
+    parser.add_argument('--max_anchor_per_img', default=100, type=int)
+    parser.add_argument('--batch_size_per_gpu', default=2, type=int)
+    parser.add_argument('--devices', default=4, type=int, help='batches of a step')
+    parser.add_argument('--seed', default=73, type=int)
+    parser.add_argument('--aspect_bins', default='0.6,0.8,1,1.25,1.67', type=str)
+    parser.add_argument('--anchor_bins', default='10,30', type=str)
+    parser.add_argument('--batch_max_anchors', default=0, type=int,
+                        help='anchor budget, 0 for max_anchor_per_img')
+    parser.add_argument('--batch_max_pixels', default=0, type=float,
+                        help='pixel budget, 0 for 1.5 times the mean pixels of batch_size_per_gpu images')
+    parser.add_argument('--batch_max_images', default=8, type=int)
+    args = parser.parse_args()
+
+    dataset = BaseProtoDataset(args.list, args)
+    args.index_batching = 1
+    args.gpus = list(range(args.devices))
+    if args.batch_max_anchors == 0:
+        args.batch_max_anchors = args.max_anchor_per_img
+    if args.batch_max_pixels == 0:
+        args.batch_max_pixels = 1.5 * dataset.resized_sizes().prod(1).mean() * args.batch_size_per_gpu
+    configs = [('two groups', dict(aspect_bins='1', anchor_bins='')),
+               ('aspect bins {}'.format(args.aspect_bins), dict(anchor_bins='')),
+               ('aspect bins {}, anchor bins {}'.format(args.aspect_bins, args.anchor_bins), dict()),
+               ('budget of {} anchors and {:.2e} pixels'.format(args.batch_max_anchors, args.batch_max_pixels),
+                dict(anchor_bins=''))]
+    for name, options in configs:
+        if 'budget' not in name:
+            options.update(batch_max_anchors=0, batch_max_pixels=0)
+        stats = epoch_statistics(dataset, args, **options)
+        print('{}: padding efficiency {:4.2f}, {} batches of {:.2f} images, variation of the anchors {:.2f} '
+              'and of the pixels {:.2f}, largest batch {} anchors {:.2e} pixels, anchor balance {:4.2f}'.format(
+                  name, stats['efficiency'] * 100, stats['batches'], stats['images'], stats['anchor_variation'],
+                  stats['pixel_variation'], stats['max_anchors'], stats['max_pixels'], stats['balance'] * 100))
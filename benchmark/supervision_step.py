@@ -0,0 +1,134 @@
+"""
+throughput of a training step with all the supervisions of supervision.json on synthetic batches
+the self supervision stage is also timed alone, it ran once for every image of the step before it was
+hoisted out of the per image loop
+"""
+import sys
+sys.path.append('../')
+import os
+import time
+import json
+import argparse
+import torch
+from model.builder import ModelBuilder
+from model.base_model import BaseLearningModule
+
+
+def synthetic_batch(args, device):
+    """
+    a batch in the format of BaseDataset with random content
+    """
+    batch_size, size, max_anchor = args.batch_size, args.size, args.anchor_per_img
+    xs = (torch.rand(batch_size, max_anchor, 2) * (size - 16)).sort(-1)[0]
+    ys = (torch.rand(batch_size, max_anchor, 2) * (size - 16)).sort(-1)[0]
+    anchors = torch.cat([xs[..., :1], xs[..., 1:] + 8, ys[..., :1], ys[..., 1:] + 8], -1)
+    batch = dict()
+    batch['img_data'] = torch.randn(batch_size, 3, size, size)
+    batch['scales'] = torch.ones(batch_size, 2)
+    batch['label'] = torch.randint(0, args.num_base_class, (batch_size, max_anchor)).float()
+    batch['anchors'] = anchors
+    batch['anchor_num'] = torch.full((batch_size,), max_anchor)
+    for supervision in args.supervision:
+        name, other = supervision['name'], supervision['other']
+        if name in ['attr', 'part']:
+            batch[name] = (torch.rand(batch_size, max_anchor, other['num_attr']) < 0.05).float()
+        elif name == 'hierarchy':
+            batch[name] = torch.stack([torch.randint(0, width, (batch_size, max_anchor))
+                                       for width in other['layer_width']], -1).float()
+        elif name == 'bbox':
+            batch[name] = anchors + torch.rand(batch_size, max_anchor, 4) * torch.tensor([-4., 4., -4., 4.])
+        elif name == 'scene':
+            batch[name] = torch.randint(0, other['scene_num'], (batch_size,)).float()
+        elif name == 'seg':
+            batch[name] = torch.randint(0, args.num_base_class + 1, (batch_size, size, size)).float()
+        elif name == 'bkg':
+            batch[name] = torch.randint(0, args.num_all_class, (batch_size, size, size)).float()
+        elif name == 'patch_location':
+            batch['patch_location_img'] = torch.randn(batch_size, 2, 3, size // 3, size // 3)
+            batch['patch_location_label'] = torch.randint(0, 8, (batch_size,))
+        elif name == 'rotation':
+            batch['rotation_img'] = torch.randn(batch_size, 3, args.rotation_size, args.rotation_size)
+            batch['rotation_label'] = torch.randint(0, 4, (batch_size,))
+    return dict((key, value.to(device)) for key, value in batch.items())
+
+
+def synchronize(device):
+    if device == 'cuda':
+        torch.cuda.synchronize()
+
+
+def measure(func, device, repeat):
+    """
+    :return: seconds per call, after a warm up call
+    """
+    func()
+    synchronize(device)
+    start = time.time()
+    for i in range(repeat):
+        func()
+    synchronize(device)
+    return (time.time() - start) / repeat
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--architecture', default='resnet10')
+    parser.add_argument('--feat_dim', default=512, type=int)
+    parser.add_argument('--crop_height', default=3, type=int)
+    parser.add_argument('--crop_width', default=3, type=int)
+    parser.add_argument('--num_base_class', default=189, type=int)
+    parser.add_argument('--num_all_class', default=1000, type=int)
+    parser.add_argument('--down_sampling_rate', default=8, type=int)
+    parser.add_argument('--cls', default='Linear', type=str)
+    parser.add_argument('--pack_backbone', default=0, type=int)
+    parser.add_argument('--pack_max_padding', default=0., type=float)
+    parser.add_argument('--amp', default=0, type=int)
+    parser.add_argument('--amp_dtype', default='float16', type=str)
+    parser.add_argument('--channels_last', default=0, type=int)
+    parser.add_argument('--supervision', default='../supervision.json', type=str)
+    parser.add_argument('--root', default='../', help='folder of data/ADE, seg and bkg read the base class list')
+    parser.add_argument('--batch_size', default=2, type=int, help='images of a step')
+    parser.add_argument('--size', default=480, type=int, help='height and width of the images')
+    parser.add_argument('--rotation_size', default=600, type=int, help='height and width of the rotation images')
+    parser.add_argument('--anchor_per_img', default=30, type=int)
+    parser.add_argument('--repeat', default=5, type=int)
+    parser.add_argument('--cpu', default=0, type=int, help='run on cpu even if cuda is available')
+    args = parser.parse_args()
+
+    f = open(args.supervision, 'r')
+    args.supervision = json.load(f)
+    f.close()
+    device = 'cuda' if torch.cuda.is_available() and not args.cpu else 'cpu'
+
+    cwd = os.getcwd()
+    os.chdir(args.root)
+    builder = ModelBuilder(args)
+    supervision_modules = []
+    for supervision in args.supervision:
+        supervision_modules.append({'name': supervision['name'],
+                                    'module': getattr(builder, 'build_' + supervision['name'])()})
+    setattr(args, 'module', supervision_modules)
+    network = BaseLearningModule(args, builder.build_backbone(), builder.build_classifier())
+    os.chdir(cwd)
+    network.to(device)
+    network.train()
+    batch = synthetic_batch(args, device)
+
+    def train_step():
+        network.zero_grad()
+        loss = network(batch)[1]
+        loss.backward()
+
+    def self_stage():
+        loss = 0
+        for step in network.self_supervision_plan:
+            loss += network.run_self_branch(step, batch) * step['weight']
+        loss.backward()
+
+    print('supervisions: {}'.format(', '.join(supervision['name'] for supervision in args.supervision)))
+    elapsed = measure(train_step, device, args.repeat)
+    print('train step: {:.1f} ms, {:.2f} images / s'.format(elapsed * 1000, args.batch_size / elapsed))
+    if len(network.self_supervision_plan) != 0:
+        elapsed_self = measure(self_stage, device, args.repeat)
+        print('self supervision stage: {:.1f} ms per step, the per image loop ran it {} times, about {:.1f} ms'.format(
+            elapsed_self * 1000, args.batch_size, elapsed_self * args.batch_size * 1000))
@@ -4,6 +4,8 @@ import numpy as np
 import cv2
 from dataset.transform import Transform
 from dataset.proto_dataset import BaseProtoDataset
+from dataset.image_cache import ImageCache, BatchImages
+from dataset.sample_index import pack_csr
 import logging
 import shutil
 from copy import deepcopy
@@ -16,6 +18,10 @@ class BaseDataset(BaseProtoDataset):
     """
     def __init__(self, data_file, args):
         super(BaseDataset, self).__init__(data_file, args)
+        # each process of a distributed run loads its own part of the samples,
+        # unless the batches are planned by EpochBatchSampler which splits them by rank
+        if getattr(args, 'world_size', 1) > 1 and not getattr(args, 'index_batching', 0):
+            self.shard(args.rank, args.world_size)
         self.root_dataset = args.root_dataset
         # down sampling rate of feature map
         self.down_sampling_rate = args.down_sampling_rate
@@ -31,6 +37,8 @@ class BaseDataset(BaseProtoDataset):
         if hasattr(args, 'supervision'):
             self.supervision = args.supervision
         self.transform = Transform(args)
+        self.image_cache = ImageCache(self.root_dataset, getattr(args, 'img_cache_dir', ''),
+                                      int(getattr(args, 'img_cache_size', 0) * 1024 ** 3))
 
     def _get_sub_batch(self):
         while True:
@@ -40,7 +48,7 @@ class BaseDataset(BaseProtoDataset):
                 self.cur_idx += 1
                 if self.cur_idx >= self.num_sample:
                     self.cur_idx = 0
-                    np.random.shuffle(self.list_sample)
+                    self.shuffle_list_sample()
                 continue
             if this_sample['height'] > this_sample['width']:
                 self.batch_record_list[0].append(this_sample)  # h > w, go to 1st class
@@ -51,7 +59,7 @@ class BaseDataset(BaseProtoDataset):
             self.cur_idx += 1
             if self.cur_idx >= self.num_sample:
                 self.cur_idx = 0
-                np.random.shuffle(self.list_sample)
+                self.shuffle_list_sample()
 
             if len(self.batch_record_list[0]) == self.batch_per_gpu:
                 batch_records = self.batch_record_list[0]
@@ -65,25 +73,32 @@ class BaseDataset(BaseProtoDataset):
         return batch_records
 
     def __getitem__(self, index):
-        # NOTE: random shuffle for the first time. shuffle in __init__ is useless
-        if not self.if_shuffled:
-            np.random.shuffle(self.list_sample)
-            self.if_shuffled = True
-
-        # get sub-batch candidates
-        batch_records = self._get_sub_batch()
+        if isinstance(index, list):
+            # a batch planned by EpochBatchSampler, the index is ignored otherwise
+            batch_records = [self.list_sample[i] for i in index]
+        else:
+            # NOTE: random shuffle for the first time. shuffle in __init__ is useless
+            if not self.if_shuffled:
+                self.shuffle_list_sample()
+                self.if_shuffled = True
+
+            # get sub-batch candidates
+            batch_records = self._get_sub_batch()
+        batch_size = len(batch_records)
+        # every image is decoded once and shared by all the branches
+        batch_images_raw = BatchImages(self.image_cache, batch_records)
 
         this_short_size = self.imgShortSize
 
         # calculate the BATCH's height and width
         # since we concat more than one samples, the batch's h and w shall be larger than EACH sample
-        batch_resize_size = np.zeros((self.batch_per_gpu, 2), np.int32)
-        batch_scales = np.zeros((self.batch_per_gpu, 2), np.float)
-        batch_anchor_num = np.zeros(self.batch_per_gpu)
-        batch_labels = np.zeros((self.batch_per_gpu, self.max_anchor_per_img))
-        batch_anchors = np.zeros((self.batch_per_gpu, self.max_anchor_per_img, 4))
+        batch_resize_size = np.zeros((batch_size, 2), np.int32)
+        batch_scales = np.zeros((batch_size, 2), np.float64)
+        batch_anchor_num = np.zeros(batch_size)
+        batch_labels = np.zeros((batch_size, self.max_anchor_per_img))
+        batch_anchors = np.zeros((batch_size, self.max_anchor_per_img, 4))
 
-        for i in range(self.batch_per_gpu):
+        for i in range(batch_size):
             img_height, img_width = batch_records[i]['height'], batch_records[i]['width']
             this_scale = min(
                 this_short_size / min(img_height, img_width), self.imgMaxSize / max(img_height, img_width))
@@ -96,21 +111,21 @@ class BaseDataset(BaseProtoDataset):
         batch_resize_height = int(self.round2nearest_multiple(batch_resize_height, self.padding_constant))
         batch_resize_width = int(self.round2nearest_multiple(batch_resize_width, self.padding_constant))
 
-        for i in range(self.batch_per_gpu):
+        for i in range(batch_size):
             batch_scales[i, 0] = batch_resize_height / batch_records[i]['height']
             batch_scales[i, 1] = batch_resize_width / batch_records[i]['width']
 
         assert self.padding_constant >= self.down_sampling_rate, \
             'padding constant must be equal or large than segm downsamping rate'
-        batch_images = torch.zeros(self.batch_per_gpu, 3, batch_resize_height, batch_resize_width)
+        batch_images = torch.zeros(batch_size, 3, batch_resize_height, batch_resize_width)
 
-        for i in range(self.batch_per_gpu):
+        for i in range(batch_size):
             this_record = batch_records[i]
 
             # load image and label
-            image_path = os.path.join(self.root_dataset, this_record['fpath_img'])
-            img = cv2.imread(image_path, cv2.IMREAD_COLOR)
-            assert (img.ndim == 3)
+            cache_size = ImageCache.scale_size(this_record['height'], this_record['width'],
+                                               this_short_size, self.imgMaxSize)
+            img = batch_images_raw.load(i, cache_size)
             # note that each sample within a mini batch has different scale param
             img = cv2.resize(img, (batch_resize_width, batch_resize_height), interpolation=cv2.INTER_CUBIC)
             # image transform
@@ -130,7 +145,7 @@ class BaseDataset(BaseProtoDataset):
         output['label'] = torch.tensor(batch_labels)
         output['anchors'] = torch.tensor(batch_anchors)
         output['anchor_num'] = torch.tensor(batch_anchor_num)
-        output['id'] = torch.tensor([self.cur_idx - 1])
+        output['id'] = torch.tensor([index[-1] if isinstance(index, list) else self.cur_idx - 1])
 
         if self.mode == 'val':
             return output
@@ -140,10 +155,10 @@ class BaseDataset(BaseProtoDataset):
 
         for supervision in self.supervision:
             if supervision['name'] == 'patch_location':
-                patch_location_dict = self.self_supervise_patch_location_data(batch_records)
+                patch_location_dict = self.self_supervise_patch_location_data(batch_records, batch_images_raw)
                 output = dict(output, **patch_location_dict)
             elif supervision['name'] == 'rotation':
-                rotation_dict = self.self_supervise_rotation_data(batch_records)
+                rotation_dict = self.self_supervise_rotation_data(batch_records, batch_images_raw)
                 output = dict(output, **rotation_dict)
 
         # add supervision information
@@ -151,52 +166,62 @@ class BaseDataset(BaseProtoDataset):
             if supervision['type'] != 'self':
                 output[supervision['name']] = None
 
-        for i in range(self.batch_per_gpu):
+        # for supervision such as attr, transform the anchors of the whole batch at once
+        anchor_img_index, anchor_index = self._get_anchor_positions(batch_records)
+        for supervision in self.supervision:
+            if supervision['type'] != 'inst':
+                continue
+            name = supervision['name']
+            contents = pack_csr([anchor[name] for record in batch_records
+                                 for anchor in record['anchors'][:self.max_anchor_per_img]])
+            tensor = self.transform.inst_batch_transform(name, contents, supervision['other'])
+            output[name] = torch.zeros((batch_size, self.max_anchor_per_img) + tensor.shape[1:])
+            output[name][anchor_img_index, anchor_index] = torch.from_numpy(tensor).float()
+
+        for i in range(batch_size):
             this_record = batch_records[i]
             for supervision in self.supervision:
                 name = supervision['name']
-                # for supervision such as attr
-                if supervision['type'] == 'inst':
-                    # determine the shape of the supervision information
-                    tensor = getattr(self.transform, name + '_transform')(this_record['anchors'][0][name],
-                                                                          supervision['other'])
-                    if tensor.ndim == 2 and output[name] is None:
-                        output[name] = torch.zeros(self.batch_per_gpu, self.max_anchor_per_img,
-                                                   tensor.shape[0], tensor.shape[1])
-                    elif tensor.ndim == 1 and output[name] is None:
-                        output[name] = torch.zeros(self.batch_per_gpu, self.max_anchor_per_img, tensor.shape[0])
-
-                    for j, anchor in enumerate(this_record['anchors']):
-                        content = anchor[name]
-                        tensor = getattr(self.transform, name + '_transform')(content, supervision['other'])
-                        output[name][i, j] = torch.from_numpy(tensor)
-
-                elif supervision['type'] == 'img':
+                if supervision['type'] == 'img':
                     # for the supervision such as segmentation
                     if supervision['content'] == 'map':
                         img = getattr(self.transform, name + '_transform')(this_record[name], supervision['other'])
                         img = cv2.resize(img, (batch_resize_width, batch_resize_height),
                                          interpolation=cv2.INTER_NEAREST)
                         if img.ndim == 2 and output[name] is None:
-                            output[name] = torch.zeros(self.batch_per_gpu, batch_resize_height, batch_resize_width)
+                            output[name] = torch.zeros(batch_size, batch_resize_height, batch_resize_width)
                         elif img.ndim == 3 and output[name] is None:
-                            output[name] = torch.zeros(self.batch_per_gpu, img.shape[0],
+                            output[name] = torch.zeros(batch_size, img.shape[0],
                                                        batch_resize_height, batch_resize_width)
                         output[name][i] = torch.from_numpy(img)
                     elif supervision['content'] == 'scene':
                         scene = getattr(self.transform, name + '_transform')(this_record[name], supervision['other'])
                         if output[name] is None:
-                            output[name] = torch.zeros(self.batch_per_gpu)
+                            output[name] = torch.zeros(batch_size)
                         output[name][i] = torch.from_numpy(scene)
         return output
 
-    def self_supervise_patch_location_data(self, batch_records):
-        batch_resize_size = np.zeros((self.batch_per_gpu, 2), np.int32)
-        batch_scales = np.zeros((self.batch_per_gpu, 2), np.float)
-        batch_labels = np.zeros(self.batch_per_gpu).astype(np.int)
+    def _get_anchor_positions(self, batch_records):
+        """
+        positions of all the anchors of a batch in the padded anchor tensors
+        :param batch_records: records of the batch
+        :return: image index and anchor index of every anchor
+        """
+        anchor_nums = [min(len(record['anchors']), self.max_anchor_per_img) for record in batch_records]
+        anchor_img_index = np.repeat(np.arange(len(batch_records)), anchor_nums)
+        anchor_index = np.concatenate([np.arange(anchor_num) for anchor_num in anchor_nums])
+        return torch.from_numpy(anchor_img_index), torch.from_numpy(anchor_index)
+
+    def self_supervise_patch_location_data(self, batch_records, images=None):
+        if images is None:
+            images = BatchImages(self.image_cache, batch_records)
+        batch_size = len(batch_records)
+        batch_resize_size = np.zeros((batch_size, 2), np.int32)
+        batch_scales = np.zeros((batch_size, 2), np.float64)
+        batch_labels = np.zeros(batch_size).astype(np.int64)
         this_short_size = 600
 
-        for i in range(self.batch_per_gpu):
+        for i in range(batch_size):
             img_height, img_width = batch_records[i]['height'], batch_records[i]['width']
             this_scale = min(
                 this_short_size / min(img_height, img_width), self.imgMaxSize / max(img_height, img_width))
@@ -209,21 +234,21 @@ class BaseDataset(BaseProtoDataset):
         batch_resize_height = int(self.round2nearest_multiple(batch_resize_height, 3))
         batch_resize_width = int(self.round2nearest_multiple(batch_resize_width, 3))
 
-        for i in range(self.batch_per_gpu):
+        for i in range(batch_size):
             batch_scales[i, 0] = batch_resize_height / batch_records[i]['height']
             batch_scales[i, 1] = batch_resize_width / batch_records[i]['width']
 
         assert self.padding_constant >= self.down_sampling_rate, \
             'padding constant must be equal or large than segm downsamping rate'
-        batch_images = torch.zeros(self.batch_per_gpu, 2, 3, batch_resize_height // 3, batch_resize_width // 3)
+        batch_images = torch.zeros(batch_size, 2, 3, batch_resize_height // 3, batch_resize_width // 3)
 
-        for i in range(self.batch_per_gpu):
+        for i in range(batch_size):
             this_record = batch_records[i]
 
             # load image and label
-            image_path = os.path.join(self.root_dataset, this_record['fpath_img'])
-            img = cv2.imread(image_path, cv2.IMREAD_COLOR)
-            assert (img.ndim == 3)
+            cache_size = ImageCache.scale_size(this_record['height'], this_record['width'],
+                                               this_short_size, self.imgMaxSize)
+            img = images.load(i, cache_size)
             # note that each sample within a mini batch has different scale param
             img = cv2.resize(img, (batch_resize_width, batch_resize_height), interpolation=cv2.INTER_CUBIC)
             # image transform
@@ -247,29 +272,31 @@ class BaseDataset(BaseProtoDataset):
         output['patch_location_label'] = torch.from_numpy(batch_labels.copy())
         return output
 
-    def self_supervise_rotation_data(self, batch_records):
-        batch_labels = np.zeros(self.batch_per_gpu).astype(np.int)
+    def self_supervise_rotation_data(self, batch_records, images=None):
+        if images is None:
+            images = BatchImages(self.image_cache, batch_records)
+        batch_size = len(batch_records)
+        batch_labels = np.zeros(batch_size).astype(np.int64)
         this_short_size = 600
         batch_resize_height = this_short_size
         batch_resize_width = this_short_size
 
         assert self.padding_constant >= self.down_sampling_rate, \
             'padding constant must be equal or large than segm downsamping rate'
-        batch_images = torch.zeros(self.batch_per_gpu, 3, batch_resize_height, batch_resize_width)
+        batch_images = torch.zeros(batch_size, 3, batch_resize_height, batch_resize_width)
 
-        for i in range(self.batch_per_gpu):
+        for i in range(batch_size):
             this_record = batch_records[i]
 
             # load image and label
-            image_path = os.path.join(self.root_dataset, this_record['fpath_img'])
-            img = cv2.imread(image_path, cv2.IMREAD_COLOR)
-            assert (img.ndim == 3)
             # note that each sample within a mini batch has different scale param
-            img_height, img_width, _ = img.shape
+            img_height, img_width = this_record['height'], this_record['width']
             if min(img_height, img_width) <= 850:
                 scales = 650.0 / float(min(img_height, img_width)) + 1
-                img = cv2.resize(img, (int(img_width * scales + 1), int(img_height * scales + 1)),
-                                 interpolation=cv2.INTER_CUBIC)
+                img_height, img_width = int(img_height * scales + 1), int(img_width * scales + 1)
+            img = images.load(i, (img_height, img_width))
+            if img.shape[0] != img_height or img.shape[1] != img_width:
+                img = cv2.resize(img, (img_width, img_height), interpolation=cv2.INTER_CUBIC)
             # image transform
             img = self.img_transform(img)
             y_start = np.random.randint(0, img.shape[1] - this_short_size)
@@ -3,6 +3,7 @@ import torch.nn as nn
 import torch
 import collections
 from torch.nn.parallel._functions import Gather
+from torch.nn.parallel import DistributedDataParallel
 
 
 def async_copy_to(obj, dev, main_stream=None):
@@ -57,6 +58,15 @@ class UserScatteredDataParallel(DictGatherDataParallel):
         return inputs, kwargs
 
 
+class UserScatteredDistributedDataParallel(DistributedDataParallel):
+    """
+    DistributedDataParallel taking the batch list of user_scattered_collate, which has one batch per process
+    """
+    def forward(self, inputs):
+        assert len(inputs) == 1
+        return super(UserScatteredDistributedDataParallel, self).forward(inputs[0])
+
+
 def user_scattered_collate(batch):
     return batch
 
@@ -0,0 +1,145 @@
+"""
+On-disk cache of decoded and resized images shared by all the data loader workers
+"""
+import os
+import hashlib
+import numpy as np
+import cv2
+
+
+class ImageCache(object):
+    """
+    Images are stored as uncompressed .npy files keyed by (fpath_img, size)
+    The least recently used files are evicted once the cache grows over max_bytes
+    """
+    def __init__(self, root_dataset, cache_dir='', max_bytes=0, stat_interval=32):
+        """
+        :param root_dataset: root of the image paths
+        :param cache_dir: cache directory, '' disables caching
+        :param max_bytes: byte budget of the cache, 0 means no limit
+        :param stat_interval: writes of a worker between two measures of the cache directory
+        """
+        self.root_dataset = root_dataset
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.stat_interval = stat_interval
+        self.enabled = cache_dir != ''
+        # every worker adds its own writes to the size of the directory it measured last, the directory
+        # is measured again every stat_interval writes to count the writes of the other workers and
+        # processes, the cache then exceeds max_bytes by at most stat_interval files of each writer
+        self.cur_bytes = 0
+        self.writes = 0
+
+        if self.enabled:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir, exist_ok=True)
+            self.cur_bytes = sum(size for _, size, _ in self._list_entries())
+
+    @staticmethod
+    def scale_size(height, width, short_size, max_size):
+        """
+        size of the image whose short edge is short_size, unless the long edge exceeds max_size
+        :return: (height, width)
+        """
+        scale = min(short_size / min(height, width), max_size / max(height, width))
+        return int(height * scale), int(width * scale)
+
+    def _cache_path(self, fpath_img, size):
+        key = '{}@{}x{}'.format(fpath_img, size[0], size[1])
+        return os.path.join(self.cache_dir, hashlib.md5(key.encode('utf-8')).hexdigest() + '.npy')
+
+    def _list_entries(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.npy'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # removed by another worker
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _evict(self):
+        entries = sorted(self._list_entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+        self.cur_bytes = total
+
+    def decode(self, fpath_img):
+        img = cv2.imread(os.path.join(self.root_dataset, fpath_img), cv2.IMREAD_COLOR)
+        assert (img.ndim == 3)
+        return img
+
+    def load(self, fpath_img, size, decode=None):
+        """
+        load an image through the cache
+        :param fpath_img: image path relative to root_dataset
+        :param size: (height, width) the image is cached at
+        :param decode: optional callable returning the decoded image, used on cache misses
+        :return: BGR image of the given size, or of the original size if caching is disabled
+        """
+        if decode is None:
+            decode = lambda: self.decode(fpath_img)
+        if not self.enabled:
+            return decode()
+
+        path = self._cache_path(fpath_img, size)
+        try:
+            img = np.load(path)
+            os.utime(path)
+            return img
+        except (IOError, OSError, ValueError):
+            pass
+
+        img = decode()
+        if img.shape[0] != size[0] or img.shape[1] != size[1]:
+            img = cv2.resize(img, (size[1], size[0]), interpolation=cv2.INTER_CUBIC)
+
+        # write to a temporary file first so that other workers never read a partial file
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        f = open(tmp_path, 'wb')
+        np.save(f, img)
+        f.close()
+        os.replace(tmp_path, path)
+
+        self.cur_bytes += os.path.getsize(path)
+        self.writes += 1
+        if self.max_bytes > 0 and self.writes % self.stat_interval == 0:
+            self.cur_bytes = sum(size for _, size, _ in self._list_entries())
+        if self.max_bytes > 0 and self.cur_bytes > self.max_bytes:
+            self._evict()
+        return img
+
+
+class BatchImages(object):
+    """
+    Images of one batch, each file is decoded at most once
+    and the raw array is shared by the main, patch_location and rotation paths
+    """
+    def __init__(self, image_cache, batch_records):
+        self.image_cache = image_cache
+        self.batch_records = batch_records
+        self.raw_images = [None] * len(batch_records)
+
+    def raw(self, i):
+        if self.raw_images[i] is None:
+            self.raw_images[i] = self.image_cache.decode(self.batch_records[i]['fpath_img'])
+        return self.raw_images[i]
+
+    def load(self, i, size):
+        """
+        :param i: position of the image in the batch
+        :param size: (height, width) the image is cached at, refer to ImageCache.load
+        :return: BGR image
+        """
+        return self.image_cache.load(self.batch_records[i]['fpath_img'], size, decode=lambda: self.raw(i))
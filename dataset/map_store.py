@@ -0,0 +1,95 @@
+"""
+Chunked store of pre-decoded supervision maps (seg, bkg)
+Every map is kept as one uint16 plane inside a raw chunk file, so that the loader can
+memory-map it instead of decoding a png at each step
+Layout of a store directory:
+    meta.json: number of maps and chunks
+    path_data.npy, path_offsets.npy: packed map paths, used as keys
+    table.npy: chunk id, element offset, height and width of every map
+    chunk_{k}.bin: concatenated uint16 planes
+"""
+import os
+import json
+import numpy as np
+from dataset.sample_index import pack_strings
+
+
+STORE_META = 'meta.json'
+
+
+def _chunk_path(store_dir, chunk):
+    return os.path.join(store_dir, 'chunk_{}.bin'.format(chunk))
+
+
+def build_map_store(paths, decode, store_dir, chunk_bytes=1024 ** 3):
+    """
+    decode all the maps once and write them into a store
+    :param paths: map paths, also the keys used by the transforms
+    :param decode: function from a path to a 2-d integer map with values < 65536
+    :param store_dir: output directory
+    :param chunk_bytes: a new chunk file is started once a chunk exceeds this size
+    :return: meta information of the store
+    """
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+    table = np.zeros((len(paths), 4), dtype=np.int64)
+    chunk = 0
+    offset = 0
+    f = open(_chunk_path(store_dir, chunk), 'wb')
+    for i, path in enumerate(paths):
+        plane = decode(path)
+        assert plane.ndim == 2 and plane.min() >= 0 and plane.max() < 65536, \
+            '{} can not be stored as an uint16 plane'.format(path)
+        if offset * 2 >= chunk_bytes:
+            f.close()
+            chunk += 1
+            offset = 0
+            f = open(_chunk_path(store_dir, chunk), 'wb')
+        f.write(np.ascontiguousarray(plane, dtype=np.uint16).tobytes())
+        table[i] = chunk, offset, plane.shape[0], plane.shape[1]
+        offset += plane.size
+        if i % 1000 == 0:
+            print('{} / {}'.format(i, len(paths)))
+    f.close()
+
+    path_data, path_offsets = pack_strings(paths)
+    np.save(os.path.join(store_dir, 'path_data.npy'), path_data)
+    np.save(os.path.join(store_dir, 'path_offsets.npy'), path_offsets)
+    np.save(os.path.join(store_dir, 'table.npy'), table)
+    meta = {'map_num': len(paths), 'chunk_num': chunk + 1}
+    f = open(os.path.join(store_dir, STORE_META), 'w')
+    json.dump(meta, f)
+    f.close()
+    return meta
+
+
+class MapStore(object):
+    """
+    Read-only access to a store built by build_map_store
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        f = open(os.path.join(store_dir, STORE_META), 'r')
+        self.meta = json.load(f)
+        f.close()
+        self.table = np.load(os.path.join(store_dir, 'table.npy'), mmap_mode='r')
+        self.chunks = [np.memmap(_chunk_path(store_dir, chunk), dtype=np.uint16, mode='r')
+                       for chunk in range(self.meta['chunk_num'])]
+
+        path_data = np.load(os.path.join(store_dir, 'path_data.npy'))
+        path_offsets = np.load(os.path.join(store_dir, 'path_offsets.npy'))
+        self.key2index = dict()
+        for i in range(self.meta['map_num']):
+            key = path_data[path_offsets[i]:path_offsets[i + 1]].tobytes().decode('utf-8')
+            self.key2index[key] = i
+
+    def __contains__(self, path):
+        return path in self.key2index
+
+    def __getitem__(self, path):
+        """
+        :param path: map path used when building the store
+        :return: read-only uint16 map of shape height * width
+        """
+        chunk, offset, height, width = self.table[self.key2index[path]]
+        return self.chunks[chunk][offset:offset + height * width].reshape(height, width)
@@ -1,3 +1,4 @@
+import os
 import bisect
 import warnings
 from torch._utils import _accumulate
@@ -10,6 +11,7 @@ import random
 import h5py
 import cv2
 from skimage.color import rgb2lab
+from dataset.sample_index import SampleIndex, SampleList
 
 
 class Dataset(object):
@@ -140,6 +142,11 @@ class BaseProtoDataset(Dataset):
             std=[1., 1., 1.])
 
     def parse_input_list(self, data_file):
+        # compiled index produced by preprocessing/compile_index.py
+        if os.path.isdir(data_file):
+            self.parse_input_index(data_file)
+            return
+
         f = open(data_file, 'r')
         old_list_sample = json.load(f)
         f.close()
@@ -152,6 +159,61 @@ class BaseProtoDataset(Dataset):
         self.num_sample = len(self.list_sample)
         print('# samples: {}'.format(self.num_sample))
 
+    def parse_input_index(self, index_dir):
+        index = SampleIndex(index_dir)
+        anchor_num = index.anchor_num()
+        ids = np.nonzero((anchor_num != 0) & (anchor_num <= 100))[0]
+        self.list_sample = SampleList(index, ids)
+
+        self.num_sample = len(self.list_sample)
+        print('# samples: {}'.format(self.num_sample))
+
+    def shard(self, rank, num_shards):
+        """
+        keep the samples of a process of a distributed run, sample i goes to process i % num_shards
+        the first samples are repeated to make the shards of the same size, as in DistributedSampler,
+        so that the processes run the same number of iterations
+        """
+        total_size = int(np.ceil(self.num_sample * 1.0 / num_shards)) * num_shards
+        if isinstance(self.list_sample, SampleList):
+            ids = np.resize(self.list_sample.ids, total_size)
+            self.list_sample = SampleList(self.list_sample.index, ids[rank::num_shards])
+        else:
+            samples = self.list_sample + self.list_sample[:total_size - self.num_sample]
+            self.list_sample = samples[rank::num_shards]
+        self.num_sample = len(self.list_sample)
+
+    def sample_sizes(self):
+        """
+        :return: num_sample * 2 array, height and width of every sample, read without building the records
+        """
+        if isinstance(self.list_sample, SampleList):
+            ids = self.list_sample.ids
+            return np.stack([self.list_sample.index.height[ids], self.list_sample.index.width[ids]], 1)
+        return np.array([[sample['height'], sample['width']] for sample in self.list_sample]).reshape(-1, 2)
+
+    def resized_sizes(self):
+        """
+        :return: num_sample * 2 array, height and width of every sample resized as in the batches
+        """
+        sizes = self.sample_sizes().astype(np.float64)
+        scales = np.minimum(self.imgShortSize / sizes.min(1), self.imgMaxSize / sizes.max(1))
+        return sizes * scales[:, None]
+
+    def sample_anchor_nums(self):
+        """
+        :return: number of anchors of every sample
+        """
+        if isinstance(self.list_sample, SampleList):
+            return self.list_sample.index.anchor_num()[self.list_sample.ids]
+        return np.array([len(sample['anchors']) for sample in self.list_sample])
+
+    def shuffle_list_sample(self):
+        if isinstance(self.list_sample, SampleList):
+            self.list_sample.shuffle()
+        else:
+            np.random.shuffle(self.list_sample)
+
     def img_transform(self, img):
         # image to float
         img = img.astype(np.float32)
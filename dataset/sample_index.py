@@ -0,0 +1,214 @@
+"""
+Columnar on-disk index of the sample lists generated by preprocessing/generate_list.py
+Every column is a plain .npy file, so that all the data loader workers can memory-map
+the same pages instead of holding their own copy of the json list
+Layout of an index directory:
+    meta.json: number of images/anchors and the names of the supervision columns
+    fpath_img_data, fpath_img_offsets: image paths as utf-8 bytes + offsets
+    height, width: image size
+    anchor_offsets: CSR offsets of the anchors of each image
+    anchor_boxes, anchor_labels: [l, r, u, d] boxes and labels of all anchors
+    inst_{name}_data, inst_{name}_offsets: CSR content of instance level supervision
+    img_{name}(_data, _offsets): image level supervision, strings are packed as paths
+"""
+import os
+import json
+import numpy as np
+
+
+INDEX_META = 'meta.json'
+RESERVED_IMG_KEYS = ['fpath_img', 'height', 'width', 'index', 'anchors']
+RESERVED_ANCHOR_KEYS = ['anchor', 'label']
+
+
+def _save_column(index_dir, name, arr):
+    np.save(os.path.join(index_dir, name + '.npy'), arr)
+
+
+def _load_column(index_dir, name):
+    return np.load(os.path.join(index_dir, name + '.npy'), mmap_mode='r')
+
+
+def pack_strings(strings):
+    """
+    pack a list of strings into one byte array
+    :param strings: list of str
+    :return: uint8 data, int64 offsets with len(strings) + 1 items
+    """
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(s) for s in encoded])
+    data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    return data, offsets
+
+
+def pack_csr(rows):
+    """
+    pack variable length numeric rows into CSR arrays
+    :param rows: list of lists
+    :return: data (int32 if every value is integral else float32), int64 offsets
+    """
+    offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(row) for row in rows])
+    flat = [value for row in rows for value in row]
+    data = np.array(flat, dtype=np.float64)
+    if np.all(np.equal(np.mod(data, 1), 0)):
+        return data.astype(np.int32), offsets
+    return data.astype(np.float32), offsets
+
+
+def compile_index(list_sample, index_dir):
+    """
+    compile a sample list into an index directory
+    :param list_sample: list of image dicts in the format of base_img_train.json
+    :param index_dir: output directory
+    :return: meta information of the index
+    """
+    if not os.path.exists(index_dir):
+        os.makedirs(index_dir)
+    img_num = len(list_sample)
+    anchors = [anchor for sample in list_sample for anchor in sample['anchors']]
+
+    img_keys = []
+    inst_keys = []
+    if img_num > 0:
+        img_keys = [key for key in list_sample[0].keys() if key not in RESERVED_IMG_KEYS]
+    if len(anchors) > 0:
+        inst_keys = [key for key in anchors[0].keys() if key not in RESERVED_ANCHOR_KEYS]
+
+    fpath_data, fpath_offsets = pack_strings([sample['fpath_img'] for sample in list_sample])
+    _save_column(index_dir, 'fpath_img_data', fpath_data)
+    _save_column(index_dir, 'fpath_img_offsets', fpath_offsets)
+    _save_column(index_dir, 'height', np.array([sample['height'] for sample in list_sample], dtype=np.int32))
+    _save_column(index_dir, 'width', np.array([sample['width'] for sample in list_sample], dtype=np.int32))
+    _save_column(index_dir, 'sample_index',
+                 np.array([sample.get('index', i) for i, sample in enumerate(list_sample)], dtype=np.int64))
+
+    anchor_offsets = np.zeros(img_num + 1, dtype=np.int64)
+    anchor_offsets[1:] = np.cumsum([len(sample['anchors']) for sample in list_sample])
+    _save_column(index_dir, 'anchor_offsets', anchor_offsets)
+    _save_column(index_dir, 'anchor_boxes',
+                 np.array([anchor['anchor'] for anchor in anchors], dtype=np.float32).reshape(-1, 4))
+    _save_column(index_dir, 'anchor_labels', np.array([anchor['label'] for anchor in anchors], dtype=np.int32))
+
+    for key in inst_keys:
+        data, offsets = pack_csr([anchor[key] for anchor in anchors])
+        _save_column(index_dir, 'inst_{}_data'.format(key), data)
+        _save_column(index_dir, 'inst_{}_offsets'.format(key), offsets)
+
+    img_columns = []
+    for key in img_keys:
+        values = [sample[key] for sample in list_sample]
+        if all(isinstance(value, str) for value in values):
+            data, offsets = pack_strings(values)
+            _save_column(index_dir, 'img_{}_data'.format(key), data)
+            _save_column(index_dir, 'img_{}_offsets'.format(key), offsets)
+            img_columns.append({'name': key, 'type': 'str'})
+        else:
+            _save_column(index_dir, 'img_{}'.format(key), np.array(values))
+            img_columns.append({'name': key, 'type': 'array'})
+
+    meta = {'img_num': img_num, 'anchor_num': len(anchors), 'inst': inst_keys, 'img': img_columns}
+    f = open(os.path.join(index_dir, INDEX_META), 'w')
+    json.dump(meta, f)
+    f.close()
+    return meta
+
+
+class SampleIndex(object):
+    """
+    Read-only view of a compiled index, every column is memory-mapped
+    """
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        f = open(os.path.join(index_dir, INDEX_META), 'r')
+        self.meta = json.load(f)
+        f.close()
+        self.img_num = self.meta['img_num']
+
+        self.fpath_img_data = _load_column(index_dir, 'fpath_img_data')
+        self.fpath_img_offsets = _load_column(index_dir, 'fpath_img_offsets')
+        self.height = _load_column(index_dir, 'height')
+        self.width = _load_column(index_dir, 'width')
+        self.sample_index = _load_column(index_dir, 'sample_index')
+        self.anchor_offsets = _load_column(index_dir, 'anchor_offsets')
+        self.anchor_boxes = _load_column(index_dir, 'anchor_boxes')
+        self.anchor_labels = _load_column(index_dir, 'anchor_labels')
+
+        self.inst = dict()
+        for key in self.meta['inst']:
+            self.inst[key] = (_load_column(index_dir, 'inst_{}_data'.format(key)),
+                              _load_column(index_dir, 'inst_{}_offsets'.format(key)))
+        self.img = dict()
+        for column in self.meta['img']:
+            key = column['name']
+            if column['type'] == 'str':
+                self.img[key] = (_load_column(index_dir, 'img_{}_data'.format(key)),
+                                 _load_column(index_dir, 'img_{}_offsets'.format(key)))
+            else:
+                self.img[key] = _load_column(index_dir, 'img_{}'.format(key))
+
+    def __len__(self):
+        return self.img_num
+
+    @staticmethod
+    def _get_string(data, offsets, i):
+        return data[offsets[i]:offsets[i + 1]].tobytes().decode('utf-8')
+
+    def anchor_num(self):
+        """
+        :return: number of anchors of every image
+        """
+        return np.diff(self.anchor_offsets)
+
+    def anchor_range(self, i):
+        return int(self.anchor_offsets[i]), int(self.anchor_offsets[i + 1])
+
+    def get_record(self, i):
+        """
+        build the record of image i in the same format as the json list
+        :param i: image position in the index
+        :return: dict
+        """
+        record = dict()
+        record['fpath_img'] = self._get_string(self.fpath_img_data, self.fpath_img_offsets, i)
+        record['height'] = int(self.height[i])
+        record['width'] = int(self.width[i])
+        record['index'] = int(self.sample_index[i])
+        for column in self.meta['img']:
+            key = column['name']
+            if column['type'] == 'str':
+                record[key] = self._get_string(self.img[key][0], self.img[key][1], i)
+            else:
+                record[key] = self.img[key][i].tolist()
+
+        start, end = self.anchor_range(i)
+        anchors = []
+        for j in range(start, end):
+            anchor = dict()
+            anchor['anchor'] = self.anchor_boxes[j].tolist()
+            anchor['label'] = int(self.anchor_labels[j])
+            for key, (data, offsets) in self.inst.items():
+                anchor[key] = data[offsets[j]:offsets[j + 1]].tolist()
+            anchors.append(anchor)
+        record['anchors'] = anchors
+        return record
+
+
+class SampleList(object):
+    """
+    Subset of an index that behaves like the list of records used by the datasets
+    Only the array of image ids is shuffled, records are built on access
+    """
+    def __init__(self, index, ids):
+        self.index = index
+        self.ids = np.array(ids, dtype=np.int64)
+
+    def __len__(self):
+        return self.ids.size
+
+    def __getitem__(self, i):
+        return self.index.get_record(int(self.ids[i]))
+
+    def shuffle(self):
+        np.random.shuffle(self.ids)
@@ -1,3 +1,5 @@
+import math
+import numpy as np
 import torch
 
 
@@ -129,3 +131,300 @@ class BatchSampler(object):
             return len(self.sampler) // self.batch_size
         else:
             return (len(self.sampler) + self.batch_size - 1) // self.batch_size
+
+
+class AspectRatioBatchSampler(BatchSampler):
+    """Wraps another sampler to yield mini-batches of images of similar aspect ratio.
+
+    The images of a batch are resized to the largest height and width among them, so
+    close aspect ratios leave fewer padded pixels to the backbone. An index goes to the
+    bucket of its aspect ratio bin, and of its anchor count bin if anchor_nums is given,
+    and a bucket yields a batch when it is full. The leftovers of the buckets are batched
+    together at the end, in the order of the bins.
+
+    Args:
+        sampler (Sampler): Base sampler of the image indices.
+        sizes (array): num_sample * 2, height and width of the images as they are resized.
+        batch_size (int): Size of mini-batch.
+        drop_last (bool): If ``True``, the sampler will drop the last leftover batch if
+            its size would be less than ``batch_size``
+        aspect_bins (list): increasing boundaries of the height / width ratio, [1.] gives
+            the h > w and h <= w groups of BaseDataset._get_sub_batch
+        anchor_nums (array, optional): anchors of the images
+        anchor_bins (list, optional): increasing boundaries of the anchor counts
+        padding_constant (int): the batch height and width are rounded up to a multiple of it
+
+    Example:
+        >>> sizes = [[3, 4], [4, 3], [3, 4], [4, 3], [3, 4]]
+        >>> list(AspectRatioBatchSampler(range(5), sizes, batch_size=2, drop_last=False))
+        [[0, 2], [1, 3], [4]]
+    """
+
+    def __init__(self, sampler, sizes, batch_size, drop_last, aspect_bins=(1.,), anchor_nums=None,
+                 anchor_bins=(), padding_constant=1):
+        super(AspectRatioBatchSampler, self).__init__(sampler, batch_size, drop_last)
+        self.sizes = np.asarray(sizes, dtype=np.float64)
+        self.padding_constant = padding_constant
+        # the bucket of every image, h / w equal to a boundary goes to the lower bin
+        self.keys = np.searchsorted(np.asarray(aspect_bins, dtype=np.float64),
+                                    self.sizes[:, 0] / self.sizes[:, 1], side='left')
+        self.anchor_nums = None
+        if anchor_nums is not None:
+            self.anchor_nums = np.asarray(anchor_nums)
+            self.keys = self.keys * (len(anchor_bins) + 1) + \
+                np.searchsorted(np.asarray(anchor_bins), self.anchor_nums, side='left')
+        self.real_pixels = 0
+        self.padded_pixels = 0
+
+    def batches(self, indices):
+        buckets = dict()
+        for idx in indices:
+            bucket = buckets.setdefault(self.keys[idx], [])
+            bucket.append(int(idx))
+            if len(bucket) == self.batch_size:
+                yield list(bucket)
+                del bucket[:]
+        rest = [idx for key in sorted(buckets) for idx in buckets[key]]
+        for start in range(0, len(rest), self.batch_size):
+            if self.drop_last and len(rest) - start < self.batch_size:
+                break
+            yield rest[start:start + self.batch_size]
+
+    def batch_pixels(self, batch):
+        """
+        :return: pixels of the images of the batch at their own size, pixels of the batch tensor
+        """
+        sizes = self.sizes[batch]
+        height, width = np.ceil(sizes.max(0) / self.padding_constant) * self.padding_constant
+        return sizes.prod(1).sum(), len(batch) * height * width
+
+    def batch_anchors(self, batch):
+        return self.anchor_nums[batch].sum()
+
+    def within_budget(self, batch):
+        return len(batch) <= self.batch_size
+
+    def update_efficiency(self, batch):
+        real, padded = self.batch_pixels(batch)
+        self.real_pixels += real
+        self.padded_pixels += padded
+
+    def padding_efficiency(self, batches=None):
+        """
+        :param batches: list of batches, None for the batches yielded so far
+        :return: ratio of the image pixels to the pixels of the batch tensors
+        """
+        if batches is None:
+            return self.real_pixels / max(self.padded_pixels, 1)
+        pixels = np.array([self.batch_pixels(batch) for batch in batches]).reshape(-1, 2).sum(0)
+        return pixels[0] / max(pixels[1], 1)
+
+    def __iter__(self):
+        for batch in self.batches(self.sampler):
+            self.update_efficiency(batch)
+            yield batch
+
+
+class BudgetBatchSampler(AspectRatioBatchSampler):
+    """Wraps another sampler to yield mini-batches filled up to a budget of anchors and pixels.
+
+    The number of images of a batch varies. A batch is closed when the next image would take
+    its anchors over max_anchors or its padded tensor over max_pixels, so that the RoI heads
+    and the backbone get about the same work, and memory, at every step. The images are
+    bucketed as in AspectRatioBatchSampler, an image over the budget forms a batch alone.
+
+    Args:
+        sampler (Sampler): Base sampler of the image indices.
+        sizes (array): num_sample * 2, height and width of the images as they are resized.
+        anchor_nums (array): anchors of the images, at most max_anchor_per_img
+        max_anchors (int): anchors of a batch, 0 for no limit
+        max_pixels (float): pixels of the padded batch tensor, 0 for no limit
+        max_images (int): images of a batch
+        aspect_bins, anchor_bins, padding_constant: as in AspectRatioBatchSampler
+    """
+
+    def __init__(self, sampler, sizes, anchor_nums, max_anchors, max_pixels, max_images, aspect_bins=(1.,),
+                 anchor_bins=(), padding_constant=1):
+        super(BudgetBatchSampler, self).__init__(sampler, sizes, max_images, False, aspect_bins=aspect_bins,
+                                                 anchor_nums=anchor_nums, anchor_bins=anchor_bins,
+                                                 padding_constant=padding_constant)
+        self.max_anchors = max_anchors
+        self.max_pixels = max_pixels
+        self.num_batches = None
+
+    def fits(self, batch, idx):
+        """
+        :return: whether the image idx can join the batch within the budget
+        """
+        if len(batch) == self.batch_size:
+            return False
+        if self.max_anchors > 0 and self.batch_anchors(batch) + self.anchor_nums[idx] > self.max_anchors:
+            return False
+        if self.max_pixels > 0 and self.batch_pixels(batch + [idx])[1] > self.max_pixels:
+            return False
+        return True
+
+    def within_budget(self, batch):
+        """
+        :return: whether the batch is within the budget, an image over the budget is a batch alone
+        """
+        return len(batch) == 1 or self.fits(batch[:-1], batch[-1])
+
+    def batches(self, indices):
+        buckets = dict()
+        for idx in indices:
+            bucket = buckets.setdefault(self.keys[idx], [])
+            if len(bucket) != 0 and not self.fits(bucket, idx):
+                yield list(bucket)
+                del bucket[:]
+            bucket.append(int(idx))
+        batch = []
+        for key in sorted(buckets):
+            for idx in buckets[key]:
+                if len(batch) != 0 and not self.fits(batch, idx):
+                    yield batch
+                    batch = []
+                batch.append(idx)
+        if len(batch) != 0:
+            yield batch
+
+    def __len__(self):
+        # the number of batches depends on the order of the images, it is planned once on the sampler
+        if self.sampler is None:
+            raise TypeError('the batches of a BudgetBatchSampler without a sampler are only planned by '
+                            'EpochBatchSampler, which gives the number of steps')
+        if self.num_batches is None:
+            self.num_batches = sum(1 for _ in self.batches(self.sampler))
+        return self.num_batches
+
+
+class EpochBatchSampler(Sampler):
+    """Yields the batches of BaseDataset, planned for each epoch from a seeded permutation.
+
+    The images of an epoch are grouped by an AspectRatioBatchSampler and every image is in
+    exactly one batch. The batches of a step go to the devices of one process, so that the
+    processes and the loader workers never draw the same image. Iteration goes on over the
+    following epochs, epoch e uses the permutation of seed + e.
+
+    Arguments:
+        batch_sampler (AspectRatioBatchSampler): grouping of the images, its sampler is unused
+        seed (int): seed of the permutations
+        devices (int): batches of a step of a process, the gpus of a data parallel
+        num_replicas (int, optional): processes of a distributed run
+        rank (int, optional): rank of the process
+        start_epoch (int, optional): first epoch to yield
+        num_epochs (int, optional): epochs of the run, they all get the same number of steps
+        balance_window (int, optional): steps whose batches are ordered by anchor count, when the
+            batch_sampler groups by anchor count
+    """
+
+    def __init__(self, batch_sampler, seed, devices=1, num_replicas=1, rank=0, start_epoch=0, num_epochs=1,
+                 balance_window=8):
+        self.batch_sampler = batch_sampler
+        self.balance_window = balance_window
+        self.seed = seed
+        self.devices = devices
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.start_epoch = start_epoch
+        # the batches of a budget vary in number between epochs, every epoch of the run is padded
+        # to the largest number of batches by splitting, merging batches would break the budget
+        replicas = num_replicas * devices
+        most = max(len(self.group(epoch)) for epoch in range(start_epoch, start_epoch + max(num_epochs, 1)))
+        self.num_batches = int(math.ceil(most * 1.0 / replicas)) * replicas
+        # padding efficiency of the batches of all the processes in each planned epoch
+        self.epoch_efficiency = dict()
+        self.num_steps = self.num_batches // replicas
+
+    def group(self, epoch):
+        """
+        :return: batches of all the processes in an epoch, before they are split
+        """
+        order = np.random.RandomState(self.seed + epoch).permutation(len(self.batch_sampler.sizes))
+        return list(self.batch_sampler.batches(order))
+
+    def epoch_batches(self, epoch):
+        """
+        :return: batches of the process in an epoch, the batches of step s are [s * devices, (s + 1) * devices)
+        """
+        batches = self.group(epoch)
+        # split the largest batches until every device of every process has the same number of batches.
+        # an epoch after the epochs of the run may have more batches, and then more steps
+        replicas = self.num_replicas * self.devices
+        total = max(self.num_batches, int(math.ceil(len(batches) * 1.0 / replicas)) * replicas)
+        while len(batches) < total:
+            j = max(range(len(batches)), key=lambda k: len(batches[k]))
+            assert len(batches[j]) > 1, 'fewer images than devices'
+            half = len(batches[j]) // 2
+            batches[j:j + 1] = [batches[j][:half], batches[j][half:]]
+        for batch in batches:
+            assert self.batch_sampler.within_budget(batch), 'batch {} is over the budget'.format(batch)
+        if self.batch_sampler.anchor_nums is not None:
+            # batches of close anchor counts share a step, so that its devices wait less for each other.
+            # they are only sorted within windows of steps, the epoch order stays random
+            window = replicas * self.balance_window
+            for start in range(0, total, window):
+                batches[start:start + window] = sorted(batches[start:start + window],
+                                                       key=self.batch_sampler.batch_anchors)
+        self.epoch_efficiency[epoch] = self.batch_sampler.padding_efficiency(batches)
+        mine = []
+        for step in range(total // replicas):
+            start = (step * self.num_replicas + self.rank) * self.devices
+            mine.extend(batches[start:start + self.devices])
+        return mine
+
+    def padding_efficiency(self, epoch):
+        """
+        :return: padding efficiency of the batches planned for the epoch
+        """
+        if epoch not in self.epoch_efficiency:
+            self.epoch_batches(epoch)
+        return self.epoch_efficiency[epoch]
+
+    def __iter__(self):
+        epoch = self.start_epoch
+        while True:
+            for batch in self.epoch_batches(epoch):
+                yield batch
+            epoch += 1
+
+    def __len__(self):
+        # batches of an epoch, the iterator itself does not stop
+        return self.num_steps * self.devices
+
+
+def parse_bins(bins):
+    """
+    :param bins: comma separated boundaries, e.g. '0.8,1,1.25'
+    """
+    return [float(x) for x in bins.split(',') if x != '']
+
+
+def build_epoch_sampler(dataset, args):
+    """
+    sampler of the batches of a BaseDataset planned for each epoch, None to let the dataset draw its own batches
+    args: index_batching, seed, aspect_bins, anchor_bins, the budget batch_max_anchors, batch_max_pixels and
+    batch_max_images, and world_size and rank in a distributed run
+    """
+    budget = getattr(args, 'batch_max_anchors', 0) > 0 or getattr(args, 'batch_max_pixels', 0) > 0
+    if not getattr(args, 'index_batching', 0):
+        assert not budget, 'the batch budget needs index_batching'
+        return None
+    anchor_nums = None
+    if budget or getattr(args, 'anchor_bins', '') != '':
+        anchor_nums = np.minimum(dataset.sample_anchor_nums(), int(args.max_anchor_per_img))
+    aspect_bins = parse_bins(getattr(args, 'aspect_bins', '1'))
+    anchor_bins = parse_bins(getattr(args, 'anchor_bins', ''))
+    if budget:
+        grouping = BudgetBatchSampler(None, dataset.resized_sizes(), anchor_nums, args.batch_max_anchors,
+                                      args.batch_max_pixels, args.batch_max_images, aspect_bins=aspect_bins,
+                                      anchor_bins=anchor_bins, padding_constant=args.padding_constant)
+    else:
+        grouping = AspectRatioBatchSampler(None, dataset.resized_sizes(), args.batch_size_per_gpu, False,
+                                           aspect_bins=aspect_bins, anchor_nums=anchor_nums, anchor_bins=anchor_bins,
+                                           padding_constant=args.padding_constant)
+    # the epochs of the warm up are counted even if it is skipped, an extra epoch only lengthens the planning
+    start_epoch = getattr(args, 'start_epoch', 0)
+    num_epochs = getattr(args, 'num_epoch', 1) - start_epoch + getattr(args, 'warm_up_epoch', 0)
+    return EpochBatchSampler(grouping, args.seed, devices=len(args.gpus), num_replicas=getattr(args, 'world_size', 1),
+                             rank=getattr(args, 'rank', 0), start_epoch=start_epoch, num_epochs=num_epochs)
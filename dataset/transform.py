@@ -6,11 +6,45 @@ import cv2
 import torch
 import os
 import json
+from dataset.map_store import MapStore
+
+
+def decode_seg(path):
+    """
+    :param path: full path of the segmentation png
+    :return: base class index of every pixel
+    """
+    return cv2.imread(path, 0)
+
+
+def decode_bkg(path):
+    """
+    :param path: full path of the 3-channel bkg png
+    :return: class index of every pixel, clamped at 999
+    """
+    img = cv2.imread(path)
+    p0, p1, p2 = np.transpose(img, (2, 0, 1))
+    bkg = p0 + 256 * p1 + 256 * 256 * p2
+    bkg = (bkg - 999) * (bkg < 999) + 999
+    return bkg.astype('int32')
 
 
 class Transform:
     def __init__(self, args):
         self.args = args
+        self.map_stores = dict()
+
+    def get_map_store(self, other):
+        """
+        pre-decoded map store given by 'store' in the supervision config, refer to preprocessing/compile_maps.py
+        :param other: other information of the supervision
+        :return: MapStore or None
+        """
+        if other is None or 'store' not in other:
+            return None
+        if other['store'] not in self.map_stores:
+            self.map_stores[other['store']] = MapStore(other['store'])
+        return self.map_stores[other['store']]
 
     def seg_transform(self, path, other=None):
         """
@@ -18,9 +52,11 @@ class Transform:
         :param path: segmentation map path
         :return: segmentation map in the original size
         """
+        store = self.get_map_store(other)
+        if store is not None:
+            return store[path].astype(np.uint8)
         path = os.path.join(self.args.root_dataset, path)
-        img = cv2.imread(path, 0)
-        return img
+        return decode_seg(path)
 
     def attr_transform(self, tensor, other=None):
         """
@@ -37,6 +73,53 @@ class Transform:
             result[i] = 1
         return result
 
+    @staticmethod
+    def multi_hot(data, offsets, num):
+        """
+        multi-hot encoding of CSR index lists
+        :param data: concatenated indexes of all the rows
+        :param offsets: row offsets, rows + 1 items
+        :param num: number of classes
+        :return: rows * num hot result
+        """
+        rows = np.repeat(np.arange(offsets.size - 1), np.diff(offsets))
+        result = np.zeros((offsets.size - 1, num)).astype(np.int64)
+        result[rows, data] = 1
+        return result
+
+    def inst_batch_transform(self, name, contents, other=None):
+        """
+        transform the instance level supervision of all the anchors in a batch at once
+        falls back to the per anchor transform if no batch transform is defined
+        :param name: supervision name
+        :param contents: CSR data and offsets of the supervision of every anchor
+        :param other: other information needed for transformation
+        :return: result with one row per anchor
+        """
+        data, offsets = contents
+        batch_transform = getattr(self, name + '_batch_transform', None)
+        if batch_transform is not None:
+            return batch_transform(data, offsets, other)
+        transform = getattr(self, name + '_transform')
+        return np.stack([transform(data[offsets[k]:offsets[k + 1]].tolist(), other)
+                         for k in range(offsets.size - 1)])
+
+    def attr_batch_transform(self, data, offsets, other=None):
+        if other is None:
+            raise Exception('No attribute num for attribute supervision')
+        return self.multi_hot(data, offsets, other['num_attr'])
+
+    def part_batch_transform(self, data, offsets, other=None):
+        if other is None:
+            raise Exception('No part num for attribute supervision')
+        return self.multi_hot(data, offsets, other['num_attr'])
+
+    def hierarchy_batch_transform(self, data, offsets, other=None):
+        return data.reshape(offsets.size - 1, -1)
+
+    def bbox_batch_transform(self, data, offsets, other=None):
+        return data.reshape(offsets.size - 1, -1)
+
     def part_transform(self, tensor, other=None):
         """
         attribute transform
@@ -96,12 +179,11 @@ class Transform:
         :param path: segmentation map path
         :return: segmentation map in the original size
         """
+        store = self.get_map_store(other)
+        if store is not None:
+            return store[path].astype('int32')
         path = os.path.join(self.args.root_dataset, path)
-        img = cv2.imread(path)
-        p0, p1, p2 = np.transpose(img, (2, 0, 1))
-        bkg = p0 + 256 * p1 + 256 * 256 * p2
-        bkg = (bkg - 999) * (bkg < 999) + 999
-        return bkg.astype('int32')
+        return decode_bkg(path)
 
     def hierarchy_transform(self, tensor, other=None):
         """
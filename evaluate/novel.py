@@ -217,6 +217,8 @@ if __name__ == '__main__':
                         help="a name for identifying the model")
     parser.add_argument('--arch', default='resnet10')
     parser.add_argument('--cls', default='novel_cls')
+    parser.add_argument('--cos_temperature', default=10, type=float, help='temperature of the cosine classifier')
+    parser.add_argument('--learn_temperature', default=0, type=int, help='learn the temperature of the cosine classifier')
     parser.add_argument('--feat_dim', default=512)
     parser.add_argument('--crop_height', default=3, type=int)
     parser.add_argument('--crop_width', default=3, type=int)
@@ -4,6 +4,7 @@ import torch
 from dataset.base_dataset import BaseDataset
 from dataset.dataloader import DataLoader
 from dataset.collate import UserScatteredDataParallel, user_scattered_collate
+from dataset.sampler import build_epoch_sampler
 from model.builder import ModelBuilder
 from model.base_model import BaseLearningModule
 from model.parallel.replicate import patch_replication_callback
@@ -34,8 +35,11 @@ def save_feature(args):
     dataset_val = BaseDataset(args.data_val, args)
     dataset_train.if_shuffled = True
     dataset_val.if_shuffled = True
+    sampler_train = build_epoch_sampler(dataset_train, args)
+    sampler_val = build_epoch_sampler(dataset_val, args)
     loader_train = DataLoader(
         dataset_train, batch_size=len(args.gpus), shuffle=False,
+        sampler=sampler_train,
         collate_fn=user_scattered_collate,
         num_workers=int(args.workers),
         drop_last=True,
@@ -43,6 +47,7 @@ def save_feature(args):
     )
     loader_val = DataLoader(
         dataset_val, batch_size=len(args.gpus), shuffle=False,
+        sampler=sampler_val,
         collate_fn=user_scattered_collate,
         num_workers=int(args.workers),
         drop_last=True,
@@ -51,10 +56,15 @@ def save_feature(args):
     iter_train = iter(loader_train)
     iter_val = iter(loader_val)
 
-    args.train_epoch_iters = \
-        math.ceil(dataset_train.num_sample / (args.batch_size_per_gpu * len(args.gpus)))
-    args.val_epoch_iters = \
-        math.ceil(dataset_val.num_sample / (args.batch_size_per_gpu * len(args.gpus)))
+    if args.index_batching:
+        # one pass over the images
+        args.train_epoch_iters = sampler_train.num_steps
+        args.val_epoch_iters = sampler_val.num_steps
+    else:
+        args.train_epoch_iters = \
+            math.ceil(dataset_train.num_sample / (args.batch_size_per_gpu * len(args.gpus)))
+        args.val_epoch_iters = \
+            math.ceil(dataset_val.num_sample / (args.batch_size_per_gpu * len(args.gpus)))
     print('1 Train Epoch = {} iters'.format(args.train_epoch_iters))
     print('1 Val Epoch = {} iters'.format(args.val_epoch_iters))
 
@@ -75,6 +85,8 @@ def save_feature(args):
         iterations += 1
     features = features[:flag, :]
     labels = labels[:flag]
+    if args.index_batching:
+        print('Padding efficiency: {:4.2f}'.format(sampler_train.padding_efficiency(sampler_train.start_epoch) * 100))
     f = h5py.File('data/img_test_train_feat_{}.h5'.format(args.id), 'w')
     f.create_dataset('feature_map', data=features)
     f.create_dataset('labels', data=labels)
@@ -98,6 +110,8 @@ def save_feature(args):
 
     features = features[:flag, :]
     labels = labels[:flag]
+    if args.index_batching:
+        print('Padding efficiency: {:4.2f}'.format(sampler_val.padding_efficiency(sampler_val.start_epoch) * 100))
     f = h5py.File('data/img_test_val_feat_{}.h5'.format(args.id), 'w')
     f.create_dataset('feature_map', data=features)
     f.create_dataset('labels', data=labels)
@@ -148,6 +162,10 @@ if __name__ == '__main__':
                         help='down sampling rate of the segmentation label')
     parser.add_argument('--sample_type', default='inst',
                         help='instance level or category level sampling')
+    parser.add_argument('--index_batching', default=0, type=int,
+                        help='batches of images of close aspect ratio, every image is extracted once')
+    parser.add_argument('--aspect_bins', default='0.6,0.8,1,1.25,1.67', type=str,
+                        help='boundaries of the height / width ratio of the images batched together')
 
     # Misc arguments
     parser.add_argument('--seed', default=304, type=int, help='manual seed')
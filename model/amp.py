@@ -0,0 +1,42 @@
+import torch
+
+
+def amp_enabled(args):
+    return bool(getattr(args, 'amp', 0))
+
+
+def autocast_dtype(args, device_type):
+    """
+    reduced precision of the autocast, cpu autocast only runs in bfloat16
+    """
+    if device_type == 'cpu' or getattr(args, 'amp_dtype', 'float16') == 'bfloat16':
+        return torch.bfloat16
+    return torch.float16
+
+
+def autocast(args, device_type):
+    """
+    autocast context of the forward pass, disabled unless args.amp is set
+    :param device_type: 'cuda' or 'cpu', type of the device of the inputs
+    """
+    return torch.autocast(device_type, dtype=autocast_dtype(args, device_type), enabled=amp_enabled(args))
+
+
+def build_grad_scaler(args):
+    """
+    loss scaler of the float16 training on cuda, a disabled scaler passes the loss and the steps through
+    bfloat16 has the range of float32 and needs no scaling
+    """
+    enabled = amp_enabled(args) and torch.cuda.is_available() and autocast_dtype(args, 'cuda') == torch.float16
+    return torch.amp.GradScaler('cuda', enabled=enabled)
+
+
+def scaled_backward(loss, optimizers, scaler):
+    """
+    backward of the scaled loss and a step of every optimizer
+    an optimizer skips its step if its gradients overflowed, and the scale is then lowered
+    """
+    scaler.scale(loss).backward()
+    for optimizer in optimizers:
+        scaler.step(optimizer)
+    scaler.update()
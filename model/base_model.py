@@ -2,16 +2,24 @@ import torch
 import torch.nn as nn
 import numpy as np
 from roi_align.roi_align import RoIAlign
-from torch.autograd import Variable
+from model.component.fused_head import fused_linear, head_widths
+from model.component.resnet import packed_forward
+from model.amp import autocast
 import random
 
 
-def to_variable(arr, requires_grad=False, is_cuda=True):
-    tensor = torch.from_numpy(arr)
-    if is_cuda:
-        tensor = tensor.cuda()
-    var = Variable(tensor, requires_grad=requires_grad)
-    return var
+def anchors_to_boxes(anchors, scales, down_sampling_rate):
+    """
+    map the anchors on the image to the boxes on the feature map, on the device of the anchors
+    :param anchors: ... * 4, [l, r, u, d]
+    :param scales: ... * 2, height and width scale of the image of the anchors
+    :param down_sampling_rate: down sampling rate of the feature map
+    :return: boxes ... * 4, [x1, y1, x2, y2]
+    """
+    scales = scales.unsqueeze(-2).float()
+    multiplier = torch.stack((scales[..., 1], scales[..., 1], scales[..., 0], scales[..., 0]), dim=-1)
+    boxes = anchors.float() / down_sampling_rate * multiplier
+    return boxes[..., [0, 2, 1, 3]]
 
 
 class BaseLearningModule(nn.Module):
@@ -32,136 +40,293 @@ class BaseLearningModule(nn.Module):
         if hasattr(args, 'module'):
             for module in args.module:
                 setattr(self, module['name'], module['module'])
+        # how the supervision branches are run, built once
+        self.dispatch_plan = self.build_dispatch_plan()
+        self.self_supervision_plan = self.build_self_supervision_plan()
 
         self.mode = 'train'
         if self.classifier is not None:
             self.classifier.mode = self.mode
 
-    def process_in_roi_layer(self, feature_map, scale, anchors, anchor_num):
-        """
-        process the data in roi_layer and get the feature
-        :param feature_map: C * H * W
-        :param scale: anchor_num * 2
-        :param anchors: anchor_num * 4
-        :param anchor_num: int
-        :return: feature C * crop_height * crop_width
-        """
-        anchors = np.array(anchors.detach().cpu())
-        scale = np.array(scale.detach().cpu())
-        anchors = anchors / self.down_sampling_rate
-        anchor_num = int(anchor_num)
-        anchors[:, 2] = anchors[:, 2] * scale[0]
-        anchors[:, 3] = anchors[:, 3] * scale[0]
-        anchors[:, 0] = anchors[:, 0] * scale[1]
-        anchors[:, 1] = anchors[:, 1] * scale[1]
-        anchors[:, [1, 2]] = anchors[:, [2, 1]]
-        anchor_index = np.zeros(anchor_num)
-        anchor_index = to_variable(anchor_index).int()
-        anchors = to_variable(anchors[:anchor_num, :]).float()
-        feature_map = feature_map.unsqueeze(0)
-        feature = self.roi_align(feature_map, anchors, anchor_index)
+    def get_anchor_nums(self, anchor_num):
+        """
+        number of anchors used in each image, images with no or too many anchors are skipped
+        :param anchor_num: N
+        :return: list of N ints
+        """
+        anchor_nums = anchor_num.detach().cpu().long()
+        anchor_nums[anchor_nums > 100] = 0
+        return anchor_nums.tolist()
+
+    @staticmethod
+    def anchor_index(anchor_nums, max_anchor_num, device):
+        """
+        index of the valid anchors, built from the anchor numbers already on the host
+        :param anchor_nums: list of anchor number of each image
+        :param max_anchor_num: size of the anchor dimension
+        :param device: device of the index
+        :return: image index and flattened anchor index, M each, ordered by image
+        """
+        image_index = np.repeat(np.arange(len(anchor_nums)), anchor_nums)
+        flat_index = np.concatenate([i * max_anchor_num + np.arange(n) for i, n in enumerate(anchor_nums)])
+        image_index = torch.from_numpy(image_index).to(device)
+        flat_index = torch.from_numpy(flat_index.astype(np.int64)).to(device)
+        return image_index, flat_index
+
+    def gather_anchors(self, tensor, anchor_nums):
+        """
+        concatenate the valid anchors of all the images
+        :param tensor: N * max_anchor_num * ...
+        :param anchor_nums: list of anchor number of each image
+        :return: M * ..., M is the total anchor number, ordered by image
+        """
+        _, flat_index = self.anchor_index(anchor_nums, tensor.shape[1], tensor.device)
+        return tensor.reshape((-1,) + tuple(tensor.shape[2:])).index_select(0, flat_index)
+
+    def process_in_roi_layer(self, feature_map, scales, anchors, anchor_nums):
+        """
+        process the anchors of all the images in a single roi_layer call
+        :param feature_map: N * C * H * W
+        :param scales: N * 2
+        :param anchors: N * max_anchor_num * 4
+        :param anchor_nums: list of anchor number of each image
+        :return: feature M * (C * crop_height * crop_width), ordered by image
+        """
+        image_index, flat_index = self.anchor_index(anchor_nums, anchors.shape[1], feature_map.device)
+        boxes = anchors_to_boxes(anchors.to(feature_map.device), scales.to(feature_map.device),
+                                 self.down_sampling_rate)
+        boxes = boxes.reshape(-1, 4).index_select(0, flat_index)
+        feature = self.roi_align(feature_map, boxes, image_index.int())
         feature = feature.view(-1, self.args.feat_dim * self.crop_height * self.crop_width)
         return feature
 
-    def predict(self, feed_dict):
-        feature_map = self.backbone(feed_dict['img_data'])
-        batch_img_num = feature_map.shape[0]
-        features = None
-        labels = None
-        for i in range(batch_img_num):
-            anchor_num = int(feed_dict['anchor_num'][i].detach().cpu())
-            if anchor_num == 0 or anchor_num > 100:
+    def compute_head_scores(self, feature):
+        """
+        compute the scores of the classifier and the instance level supervision heads in one product
+        :param feature: M * (C * crop_height * crop_width) features of all the anchors
+        :return: dict from the head name ('classifier' or supervision name) to its M * width scores
+        """
+        heads = []
+        if hasattr(self.classifier, 'head'):
+            heads.append(('classifier', self.classifier.head()))
+        if hasattr(self.args, 'module') and self.mode == 'train':
+            for supervision in self.args.supervision:
+                module = getattr(self, supervision['name'])
+                if supervision['type'] == 'inst' and hasattr(module, 'head'):
+                    heads.append((supervision['name'], module.head()))
+        if len(heads) <= 1:
+            return dict()
+
+        linears = [linear for _, head in heads for linear in head]
+        scores = fused_linear(feature, linears)
+        scores = torch.split(scores, [sum(head_widths(head)) for _, head in heads], dim=1)
+        return dict((name, score) for (name, _), score in zip(heads, scores))
+
+    def build_dispatch_plan(self):
+        """
+        dispatch plan of the instance and image level supervision branches
+        the modules are looked up by name at each step, so that the replicas use their own modules
+        :return: list of dict(index, name, type, weight, inputs), inputs are the keys taken from the feed_dict
+        """
+        plan = []
+        if not hasattr(self.args, 'module'):
+            return plan
+        for j, supervision in enumerate(self.args.supervision):
+            if supervision['type'] == 'self':
                 continue
-            feature = self.process_in_roi_layer(feature_map[i], feed_dict['scales'][i],
-                                                feed_dict['anchors'][i], anchor_num)
-            label = feed_dict['label'][i][:anchor_num].long()
+            plan.append({'index': j, 'name': supervision['name'], 'type': supervision['type'],
+                         'weight': supervision['weight'], 'inputs': [supervision['name']]})
+        return plan
 
-            if features is None:
-                features = feature.clone()
-                labels = label.clone()
-            else:
-                features = torch.stack((features, feature), dim=0)
-                labels = torch.stack((labels, label), dim=0)
-        if features.shape[0] != labels.shape[0]:
-            print(features.shape[0])
-            print(anchor_num)
-        return features, labels
+    def build_self_supervision_plan(self):
+        """
+        plan of the self supervision branches, they take their own images and run once per step
+        :return: list of dict(index, name, weight, inputs), inputs are the image and label keys of the feed_dict
+        """
+        plan = []
+        if not hasattr(self.args, 'module'):
+            return plan
+        for j, supervision in enumerate(self.args.supervision):
+            if supervision['type'] != 'self':
+                continue
+            name = supervision['name']
+            plan.append({'index': j, 'name': name, 'weight': supervision['weight'],
+                         'inputs': [name + '_img', name + '_label']})
+        return plan
 
-    def forward(self, feed_dict):
-        if self.mode == 'feature':
-            return self.predict(feed_dict)
-        elif self.mode == 'diagnosis':
-            return self.diagnosis(feed_dict)
+    def build_agg_batch(self, feed_dict, feature_map, feature, labels, anchor_nums):
+        """
+        generic data input of the supervision branches for all the images of the step
+        :return: dict, anchor level items are concatenated over the images and image level ones are batched
+        """
+        image_index, _ = self.anchor_index(anchor_nums, feed_dict['anchors'].shape[1], feature_map.device)
+        agg_batch = dict()
+        agg_batch['features'] = feature
+        agg_batch['feature_map'] = feature_map
+        agg_batch['anchors'] = self.gather_anchors(feed_dict['anchors'], anchor_nums)
+        agg_batch['scales'] = feed_dict['scales']
+        agg_batch['labels'] = labels
+        agg_batch['anchor_index'] = image_index
+        agg_batch['anchor_nums'] = torch.tensor(anchor_nums, dtype=torch.float, device=feature_map.device)
+        agg_batch['anchor_offsets'] = np.cumsum([0] + anchor_nums)
+        return agg_batch
 
-        category_accuracy = torch.zeros(2, self.args.num_base_class).cuda()
+    @staticmethod
+    def image_agg(agg, step, i):
+        """
+        input of image i for a module without forward_batch, in the format of the per image dispatch
+        """
+        start, end = agg['anchor_offsets'][i], agg['anchor_offsets'][i + 1]
+        input_agg = dict()
+        input_agg['features'] = agg['features'][start:end]
+        input_agg['feature_map'] = agg['feature_map'][i]
+        input_agg['anchors'] = agg['anchors'][start:end]
+        input_agg['scales'] = agg['scales'][i]
+        input_agg['labels'] = agg['labels'][start:end]
+        for key in step['inputs']:
+            if key in agg:
+                input_agg[key] = agg[key][start:end] if step['type'] == 'inst' else agg[key][i]
+        if 'scores' in agg:
+            input_agg['scores'] = agg['scores'][start:end]
+        return input_agg
 
+    def run_branch(self, step, agg_batch, feed_dict, anchor_nums, head_scores):
+        """
+        run a supervision branch of the dispatch plan on all the images of the step
+        :return: sum over the images of the loss times the anchor number
+        """
+        module = getattr(self, step['name'])
+        agg = dict(agg_batch)
+        for key in step['inputs']:
+            if key in feed_dict:
+                agg[key] = self.gather_anchors(feed_dict[key], anchor_nums) if step['type'] == 'inst' \
+                    else feed_dict[key]
+        if step['name'] in head_scores:
+            agg['scores'] = head_scores[step['name']]
+        if hasattr(module, 'forward_batch'):
+            return module.forward_batch(agg)
+
+        loss_branch = 0
+        for i, anchor_num in enumerate(anchor_nums):
+            if anchor_num == 0:
+                continue
+            loss_branch += module(self.image_agg(agg, step, i)) * anchor_num
+        return loss_branch
+
+    @staticmethod
+    def self_backbone_input(step, feed_dict):
+        """
+        backbone input of a self supervision branch, the patches of patch_location are flattened to a batch
+        """
+        input_img = feed_dict[step['inputs'][0]]
+        if input_img.dim() == 5:
+            _, _, _, height, width = input_img.shape
+            return input_img.view(-1, 3, height, width)
+        return input_img
+
+    def run_self_branch(self, step, feed_dict, feature_map=None):
+        """
+        run a self supervision branch with one backbone pass over the images of the whole step
+        :param feature_map: feature map of self_backbone_input if it is already computed
+        :return: loss of the branch
+        """
+        input_img, input_label = [feed_dict[key] for key in step['inputs']]
+        if feature_map is None:
+            feature_map = self.backbone(self.self_backbone_input(step, feed_dict))
+        if step['name'] == 'patch_location':
+            batch_img_num, patch_num = input_img.shape[:2]
+            _, C, H, W = feature_map.shape
+            feature_map = feature_map.reshape(batch_img_num, patch_num, C, H, W)
+        return getattr(self, step['name'])([feature_map, input_label])
+
+    def predict(self, feed_dict):
         feature_map = self.backbone(feed_dict['img_data'])
+        anchor_nums = self.get_anchor_nums(feed_dict['anchor_num'])
+        features = self.process_in_roi_layer(feature_map, feed_dict['scales'], feed_dict['anchors'], anchor_nums)
+        labels = self.gather_anchors(feed_dict['label'], anchor_nums).long()
+        return features, labels
+
+    def forward(self, feed_dict):
+        # autocast is entered here since the replicas of the data parallel run forward in their own threads
+        with autocast(self.args, feed_dict['img_data'].device.type):
+            if self.mode == 'feature':
+                return self.predict(feed_dict)
+            elif self.mode == 'diagnosis':
+                return self.diagnosis(feed_dict)
+            return self.step(feed_dict)
+
+    def step(self, feed_dict):
+        """
+        losses and accuracy of a training or validation step
+        """
+        anchor_nums = self.get_anchor_nums(feed_dict['anchor_num'])
+        image_num = sum(1 for anchor_num in anchor_nums if anchor_num != 0)
+        # the processes of a distributed run make the same backbone calls for the synchronized batch norm,
+        # the self supervision of images without anchors runs there with a zero weight
+        run_self = self.mode != 'val' and len(self.self_supervision_plan) != 0 and \
+            (image_num != 0 or getattr(self.args, 'world_size', 1) > 1)
+        self_feature_maps = [None] * len(self.self_supervision_plan)
+        if run_self and getattr(self.args, 'pack_backbone', 0):
+            # the images of the step and of the self supervision in as few backbone calls as possible
+            inputs = [feed_dict['img_data']] + [self.self_backbone_input(step, feed_dict)
+                                                for step in self.self_supervision_plan]
+            feature_maps = packed_forward(self.backbone, inputs, getattr(self.args, 'pack_max_padding', 0.))
+            feature_map, self_feature_maps = feature_maps[0], feature_maps[1:]
+        else:
+            feature_map = self.backbone(feed_dict['img_data'])
+        category_accuracy = torch.zeros(2, self.args.num_base_class, device=feature_map.device)
+        confusion = None
+        if self.mode == 'val' and getattr(self.args, 'confusion_matrix', 0):
+            confusion = torch.zeros(self.args.num_base_class, self.args.num_base_class, device=feature_map.device)
         acc = 0
         loss = 0
-        batch_img_num = feature_map.shape[0]
-
-        instance_sum = torch.tensor([0]).cuda()
-        loss_classification = torch.zeros(1)
-        loss_supervision = torch.zeros(len(self.args.supervision))
-        for i in range(batch_img_num):
-            anchor_num = int(feed_dict['anchor_num'][i].detach().cpu())
-            if anchor_num == 0 or anchor_num > 100:
-                continue
-            feature = self.process_in_roi_layer(feature_map[i], feed_dict['scales'][i],
-                                                feed_dict['anchors'][i], anchor_num)
-            labels = feed_dict['label'][i, : anchor_num].long()
-            loss_cls, acc_cls, category_acc_img = self.classifier([feature, labels])
+
+        instance_sum = torch.tensor([0], device=feature_map.device)
+        loss_classification = torch.zeros(1, device=feature_map.device)
+        loss_supervision = torch.zeros(len(self.args.supervision), device=feature_map.device)
+
+        # pool and classify the anchors of all the images at once
+        # anchors of image i are feature[anchor_offsets[i]:anchor_offsets[i + 1]]
+        anchor_offsets = np.cumsum([0] + anchor_nums)
+        if anchor_offsets[-1] != 0:
+            feature = self.process_in_roi_layer(feature_map, feed_dict['scales'], feed_dict['anchors'], anchor_nums)
+            labels = self.gather_anchors(feed_dict['label'], anchor_nums).long()
+            head_scores = self.compute_head_scores(feature)
+            if 'classifier' in head_scores:
+                loss_cls, acc_cls, category_acc_batch, confusion_batch = \
+                    self.classifier([feature, labels, head_scores['classifier']])
+            else:
+                loss_cls, acc_cls, category_acc_batch, confusion_batch = self.classifier([feature, labels])
             instance_sum[0] += labels.shape[0]
             loss += loss_cls * labels.shape[0]
-
             acc += acc_cls * labels.shape[0]
-            loss_classification += loss_cls.item() * labels.shape[0]
-            category_accuracy += category_acc_img.cuda()
-            # do not contain other supervision
-            if not hasattr(self.args, 'module'):
-                continue
-            if self.mode == 'val':
-                continue
+            loss_classification += loss_cls.detach() * labels.shape[0]
+            category_accuracy += category_acc_batch.to(feature_map.device)
+            if confusion is not None and confusion_batch is not None:
+                confusion += confusion_batch.to(feature_map.device)
+
+            # instance and image level supervision, each branch runs once for the whole step
+            if self.mode != 'val' and len(self.dispatch_plan) != 0:
+                agg_batch = self.build_agg_batch(feed_dict, feature_map, feature, labels, anchor_nums)
+                for step in self.dispatch_plan:
+                    loss_branch = self.run_branch(step, agg_batch, feed_dict, anchor_nums, head_scores)
+                    loss += (loss_branch * step['weight'])
+                    loss_supervision[step['index']] += loss_branch.detach()
 
-            # form generic data input for all supervision branch
-            input_agg = dict()
-            input_agg['features'] = feature
-            input_agg['feature_map'] = feature_map[i]
-            input_agg['anchors'] = feed_dict['anchors'][i][:anchor_num]
-            input_agg['scales'] = feed_dict['scales'][i]
-            input_agg['labels'] = feed_dict['label'][i][:anchor_num]
-
-            for key in feed_dict.keys():
-                if key not in ['img_data', 'patch_location_label', 'patch_location__img',
-                               'rotation_img', 'rotation_label']:
-                    supervision = next((x for x in self.args.supervision if x['name'] == key), None)
-                    if supervision is not None:
-                        input_agg[key] = feed_dict[key][i]
-
-            for j, supervision in enumerate(self.args.supervision):
-                if supervision['type'] != 'self':
-                    loss_branch = getattr(self, supervision['name'])(input_agg) * labels.shape[0]
-                elif supervision['name'] == 'patch_location':
-                    input_patch_location = feed_dict['patch_location_img']
-                    _, _, _, height, width = input_patch_location.shape
-                    patch_location_label = feed_dict['patch_location_label']
-                    patch_location_feature_map = self.backbone(input_patch_location.view(-1, 3, height, width))
-                    _, C, H, W = patch_location_feature_map.shape
-                    patch_location_feature_map = patch_location_feature_map.reshape(batch_img_num, 2, C, H, W)
-                    loss_branch = getattr(self, 'patch_location')([patch_location_feature_map, patch_location_label])
-                elif supervision['name'] == 'rotation':
-                    input_img = feed_dict['rotation_img']
-                    input_label = feed_dict['rotation_label']
-                    rotation_feature_map = self.backbone(input_img)
-                    loss_branch = getattr(self, 'rotation')([rotation_feature_map, input_label])
-                loss += (loss_branch * supervision['weight'])
-                loss_supervision[j] += loss_branch.item()
+        # self supervision, one backbone pass per step. the branch loss was formerly added once
+        # for every image with anchors, it is scaled by that number to keep the weighting
+        if run_self:
+            for step, self_feature_map in zip(self.self_supervision_plan, self_feature_maps):
+                loss_branch = self.run_self_branch(step, feed_dict, self_feature_map) * image_num
+                loss += (loss_branch * step['weight'])
+                loss_supervision[step['index']] += loss_branch.detach()
 
+        if self.mode == 'val' and confusion is not None:
+            return category_accuracy, loss / (instance_sum[0] + 1e-10), acc / (instance_sum[0] + 1e-10), \
+                   instance_sum, confusion
         if self.mode == 'val':
             return category_accuracy, loss / (instance_sum[0] + 1e-10), acc / (instance_sum[0] + 1e-10), instance_sum
         if hasattr(self.args, 'module'):
-            loss_supervision = loss_supervision.cuda()
-            loss_classification = loss_classification.cuda()
             return category_accuracy, loss / (instance_sum[0] + 1e-10), acc / (instance_sum[0] + 1e-10), instance_sum, \
                    loss_supervision / (instance_sum[0] + 1e-10), loss_classification / (instance_sum[0] + 1e-10)
         else:
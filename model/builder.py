@@ -37,6 +37,9 @@ class ModelBuilder:
             backbone = resnet34()
 
         backbone.apply(self.weight_init)
+        if getattr(self.args, 'channels_last', 0):
+            backbone.memory_format = torch.channels_last
+            backbone = backbone.to(memory_format=torch.channels_last)
         return backbone
 
     def build_classifier(self):
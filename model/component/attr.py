@@ -1,15 +1,49 @@
 import torch.nn as nn
 import torch
-import numpy as np
 import torch.nn.functional as F
 
 
 class AttrSoftLoss(nn.Module):
     """
     soft margin loss for this
+    only a random part of the negative labels of each instance is kept in the loss
     """
-    def __init__(self):
+    def __init__(self, keep_ratio=0.05, seed=None):
+        """
+        :param keep_ratio: ratio of the negative labels kept for each instance
+        :param seed: seed of the negative sampling, the global torch random state is used if None
+        """
         super(AttrSoftLoss, self).__init__()
+        self.keep_ratio = keep_ratio
+        self.seed = seed
+        # one generator for each device
+        self.generators = dict()
+
+    def get_generator(self, device):
+        if self.seed is None:
+            return None
+        if device not in self.generators:
+            generator = torch.Generator(device=device)
+            generator.manual_seed(self.seed)
+            self.generators[device] = generator
+        return self.generators[device]
+
+    def sample_mask(self, attributes):
+        """
+        keep all the positive labels and round(negative number * keep_ratio) negative labels of each instance
+        :param attributes: instance_num * label_num
+        :return: float mask of the same shape
+        """
+        negative = attributes == 0
+        negative_num = negative.sum(dim=1)
+        keep_num = negative_num - torch.round(negative_num.float() * (1 - self.keep_ratio)).long()
+        noise = torch.rand(attributes.shape, generator=self.get_generator(attributes.device),
+                           device=attributes.device)
+        # the positive labels are ranked after all the negative ones
+        noise = noise.masked_fill(~negative, 2.0)
+        rank = noise.argsort(dim=1).argsort(dim=1)
+        keep = ~negative | (rank < keep_num.unsqueeze(1))
+        return keep.float()
 
     def forward(self, x):
         """
@@ -19,18 +53,11 @@ class AttrSoftLoss(nn.Module):
         :return: loss
         """
         scores, attributes = x
-        attr_loss = 0.0
-        attributes = attributes.float().cuda()
-        for i in range(attributes.shape[0]):
-            loss_mask = torch.ones(attributes.shape[1]).cuda()
-            zeros = (attributes[i, :] == 0).nonzero().cpu().numpy()
-            indices = np.random.choice(zeros.squeeze(), int(round(len(zeros) * 0.95)), False)
-            loss_mask[indices] = 0
-
-            attr_loss += F.multilabel_soft_margin_loss(scores[i].unsqueeze(0),
-                                                       attributes[i].unsqueeze(0), weight=loss_mask)
-        attr_loss /= attributes.shape[0]
-        return attr_loss
+        # same precision as the float targets of multilabel_soft_margin_loss
+        scores = scores.float()
+        attributes = attributes.float().to(scores.device)
+        loss_mask = self.sample_mask(attributes)
+        return F.multilabel_soft_margin_loss(scores, attributes, weight=loss_mask)
 
 
 class AttrClassifier(nn.Module):
@@ -43,10 +70,12 @@ class AttrClassifier(nn.Module):
         for supervision in args.supervision:
             if supervision['name'] == 'attr':
                 self.num_class = supervision['other']['num_attr']
+                keep_ratio = supervision['other'].get('keep_ratio', 0.05)
+                seed = supervision['other'].get('seed', None)
         # self.mid_layer = nn.Linear(self.in_dim, self.in_dim)
         self.classifier = nn.Linear(self.in_dim, self.num_class)
         self.sigmoid = nn.Sigmoid()
-        self.loss = AttrSoftLoss()
+        self.loss = AttrSoftLoss(keep_ratio, seed)
         self.mode = 'train'
 
     def forward(self, agg_data):
@@ -60,8 +89,25 @@ class AttrClassifier(nn.Module):
 
         x = agg_data['features']
         attributes = agg_data['attr']
-        x = self.classifier(x)
+        if 'scores' in agg_data:
+            x = agg_data['scores']
+        else:
+            x = self.classifier(x)
         # x = self.sigmoid(x)
         attributes = attributes[:x.shape[0]].long()
         loss = self.loss([x, attributes])
         return loss
+
+    def forward_batch(self, agg_batch):
+        """
+        loss of all the anchors of the step, equal to the sum of the per image loss times its anchor number
+        :param agg_batch: refer to ../base_model.py
+        :return: loss
+        """
+        return self.forward(agg_batch) * agg_batch['features'].shape[0]
+
+    def head(self):
+        """
+        linear layers applied to the features, refer to fused_head.py
+        """
+        return [self.classifier]
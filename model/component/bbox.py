@@ -3,15 +3,7 @@ import torch
 import numpy as np
 import torch.nn.functional as F
 from roi_align.roi_align import RoIAlign
-from torch.autograd import Variable
-
-
-def to_variable(arr, requires_grad=False, is_cuda=True):
-    tensor = torch.from_numpy(arr)
-    if is_cuda:
-        tensor = tensor.cuda()
-    var = Variable(tensor, requires_grad=requires_grad)
-    return var
+from model.base_model import anchors_to_boxes
 
 
 class BBoxModule(nn.Module):
@@ -40,18 +32,10 @@ class BBoxModule(nn.Module):
         :param change after processed in the network
         :return: feature C * crop_height * crop_width
         """
-        anchors = np.array(anchors.detach().cpu())
-        scale = np.array(scale.detach().cpu())
-        anchors = anchors / self.down_sampling_rate
         anchor_num = int(anchor_num)
-        anchors[:, 2] = anchors[:, 2] * scale[0]
-        anchors[:, 3] = anchors[:, 3] * scale[0]
-        anchors[:, 0] = anchors[:, 0] * scale[1]
-        anchors[:, 1] = anchors[:, 1] * scale[1]
-        anchors[:, [1, 2]] = anchors[:, [2, 1]]
-        anchor_index = np.zeros(anchor_num)
-        anchor_index = to_variable(anchor_index).int()
-        anchors = to_variable(anchors[:anchor_num, :]).float()
+        anchors = anchors_to_boxes(anchors[:anchor_num, :].to(feature_map.device), scale.to(feature_map.device),
+                                   self.down_sampling_rate)
+        anchor_index = torch.zeros(anchor_num, dtype=torch.int32, device=feature_map.device)
         feature_map = feature_map.unsqueeze(0)
         feature = self.roi_align(feature_map, anchors, anchor_index)
         feature = feature.view(-1, self.args.feat_dim * self.crop_height * self.crop_width)
@@ -77,14 +61,9 @@ class BBoxModule(nn.Module):
 
     @staticmethod
     def prepare_target_value(crop_anchor, tgt_anchor):
-        crop_anchor = np.array(crop_anchor.cpu())
-        tgt_anchor = np.array(tgt_anchor.cpu())
-        # transpose the anchors, then we can directly get the location on each axis
-        crop_anchor = np.transpose(crop_anchor)
-        tgt_anchor = np.transpose(tgt_anchor)
         # left, right, up, down
-        x_crop, r_crop, y_crop, d_crop = crop_anchor
-        x_tgt, r_tgt, y_tgt, d_tgt = tgt_anchor
+        x_crop, r_crop, y_crop, d_crop = crop_anchor.unbind(dim=1)
+        x_tgt, r_tgt, y_tgt, d_tgt = tgt_anchor.to(crop_anchor.device).unbind(dim=1)
         h_crop = d_crop - y_crop
         h_tgt = d_tgt - y_tgt
         w_crop = r_crop - x_crop
@@ -93,11 +72,9 @@ class BBoxModule(nn.Module):
         # compute the value
         dx = (x_tgt - x_crop) / (w_crop + 1e-10)
         dy = (y_crop - y_tgt) / (h_crop + 1e-10)
-        dw = np.log(w_tgt / (w_crop + 1e-10))
-        dh = np.log(h_tgt / (h_crop + 1e-10))
-        target_value = np.stack((dx, dy, dw, dh), axis=0)
-        # restore the shape
-        target_value = np.transpose(target_value)
+        dw = torch.log(w_tgt / (w_crop + 1e-10))
+        dh = torch.log(h_tgt / (h_crop + 1e-10))
+        target_value = torch.stack((dx, dy, dw, dh), dim=1)
         return target_value
 
     def forward(self, agg_data):
@@ -111,12 +88,34 @@ class BBoxModule(nn.Module):
                                             crop_anchors, anchor_num)
 
         target_value = self.prepare_target_value(crop_anchor=crop_anchors, tgt_anchor=tgt_anchors)
-        target_value = torch.tensor(target_value).float().cuda()
+        target_value = target_value.float()
 
-        pred_value = self.regress(features)
+        pred_value = self.regress(features).float()
         loss = F.smooth_l1_loss(pred_value, target_value)
         return loss
 
+    def forward_batch(self, agg_batch):
+        """
+        loss of all the anchors of the step, equal to the sum of the per image loss times its anchor number
+        :param agg_batch: refer to ../base_model.py
+        :return: loss
+        """
+        feature_map = agg_batch['feature_map']
+        crop_anchors = agg_batch['anchors']
+        anchor_index = agg_batch['anchor_index']
+        anchor_num = crop_anchors.shape[0]
+        tgt_anchors = agg_batch['bbox']
 
+        # every anchor is scaled by the scale of its own image
+        scales = agg_batch['scales'].to(feature_map.device)[anchor_index]
+        boxes = anchors_to_boxes(crop_anchors.to(feature_map.device).unsqueeze(1), scales,
+                                 self.down_sampling_rate).squeeze(1)
+        features = self.roi_align(feature_map, boxes, anchor_index.int())
+        features = features.view(-1, self.args.feat_dim * self.crop_height * self.crop_width)
 
+        target_value = self.prepare_target_value(crop_anchor=crop_anchors, tgt_anchor=tgt_anchors)
+        target_value = target_value.float()
 
+        pred_value = self.regress(features).float()
+        loss = F.smooth_l1_loss(pred_value, target_value)
+        return loss * anchor_num
@@ -41,7 +41,7 @@ class FullMaskPredictor(nn.Module):
         mask = agg_input['bkg']
 
         feature_map = feature_map.unsqueeze(0)
-        predicted_map = self.fc1(feature_map)
+        predicted_map = self.fc1(feature_map).float()
         mask = mask.unsqueeze(0)
         mask = mask.unsqueeze(0)
         mask = F.interpolate(mask, size=(predicted_map.shape[2], predicted_map.shape[3]), mode='nearest')
@@ -51,3 +51,22 @@ class FullMaskPredictor(nn.Module):
 
         loss = F.cross_entropy(predicted_map, mask.long(), weight=weight)
         return loss
+
+    def forward_batch(self, agg_batch):
+        """
+        loss of all the anchors of the step, equal to the sum of the per image loss times its anchor number
+        :param agg_batch: refer to ../base_model.py
+        :return: loss
+        """
+        # the loss is summed over every pixel of the map, in float32 as fc1 gives half precision under autocast
+        predicted_map = self.fc1(agg_batch['feature_map']).float()
+        mask = agg_batch['bkg'].unsqueeze(1)
+        mask = F.interpolate(mask, size=(predicted_map.shape[2], predicted_map.shape[3]), mode='nearest')
+        mask = mask.squeeze(1).long()
+        weight = torch.ones(self.args.num_all_class, device=predicted_map.device)
+        weight[self.args.num_base_class:] = 0.1
+
+        # weighted mean of each image as in forward
+        loss = F.cross_entropy(predicted_map, mask, weight=weight, reduction='none')
+        loss = loss.sum(dim=(1, 2)) / weight[mask].sum(dim=(1, 2))
+        return (loss * agg_batch['anchor_nums']).sum()
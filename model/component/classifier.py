@@ -4,6 +4,76 @@ import torch.nn.functional as F
 import math
 
 
+def category_count(preds, label, num_class):
+    """
+    count the correct and all the instances of each category on the device of preds
+    :param preds: predicted category of each instance
+    :param label: label of each instance, negative labels are ignored
+    :param num_class: number of categories
+    :return: 2 * num_class, correct instances in row 0, all the instances in row 1
+    """
+    valid = label >= 0
+    label = label.clamp(min=0)
+    category_accuracy = torch.zeros(2, num_class, device=preds.device)
+    category_accuracy[0].scatter_add_(0, label, (valid & (preds == label)).float())
+    category_accuracy[1].scatter_add_(0, label, valid.float())
+    return category_accuracy
+
+
+def confusion_count(preds, label, num_class):
+    """
+    count the instances of each label and prediction pair on the device of preds
+    :param preds: predicted category of each instance
+    :param label: label of each instance, negative labels are ignored
+    :param num_class: number of categories
+    :return: num_class * num_class, rows are labels and columns are predictions
+    """
+    valid = label >= 0
+    index = label.clamp(min=0) * num_class + preds
+    confusion = torch.zeros(num_class * num_class, device=preds.device)
+    confusion.scatter_add_(0, index, valid.float())
+    return confusion.view(num_class, num_class)
+
+
+def build_temperature(args):
+    """
+    temperature of the cosine classifiers, a parameter if args.learn_temperature is set
+    """
+    t = torch.ones(1) * float(getattr(args, 'cos_temperature', 10))
+    if getattr(args, 'learn_temperature', False):
+        return nn.Parameter(t)
+    return t
+
+
+def normalized_weight(module):
+    """
+    l2 normalized rows of module.weight
+    in eval mode the result is cached until the weight is modified
+    """
+    if module.training:
+        module.weight_cache = None
+        return F.normalize(module.weight, dim=1)
+    key = (module.weight.data_ptr(), module.weight._version)
+    cache = getattr(module, 'weight_cache', None)
+    if cache is None or cache[0] != key:
+        with torch.no_grad():
+            cache = (key, F.normalize(module.weight, dim=1))
+        module.weight_cache = cache
+    return cache[1]
+
+
+def cosine_logits(module, feature):
+    """
+    temperature scaled cosine similarity between the features and the rows of module.weight
+    :param module: module with weight (num_class * dim) and temperature t
+    :param feature: batch * dim
+    :return: batch * num_class
+    """
+    feature = F.normalize(feature, dim=1, eps=1e-8)
+    weight = normalized_weight(module).to(feature.device)
+    return module.t.to(feature.device) * torch.mm(feature, weight.t())
+
+
 class Classifier(nn.Module):
     def __init__(self, args):
         super(Classifier, self).__init__()
@@ -12,31 +82,41 @@ class Classifier(nn.Module):
         self.fc_512 = nn.Linear(args.feat_dim * args.crop_width * args.crop_height, self.num_class)
         self.loss = nn.CrossEntropyLoss(ignore_index=-1)
         self.mode = 'train'
+        self.confusion_matrix = bool(getattr(args, 'confusion_matrix', False))
 
     def _acc(self, pred, label):
-        category_accuracy = torch.zeros(2, self.num_class)
         _, preds = torch.max(pred, dim=1)
         valid = (label >= 0).long()
         acc_sum = torch.sum(valid * (preds == label).long())
         instance_sum = torch.sum(valid)
         acc = acc_sum.float() / (instance_sum.float() + 1e-10)
-        for i, label_instance in enumerate(label):
-            category_accuracy[1, label_instance] += 1
-            if preds[i] == label_instance:
-                category_accuracy[0, label_instance] += 1
+        category_accuracy = category_count(preds, label, self.num_class)
+        # the counts of each replica are gathered by the data parallel, refer to base_model.py
+        confusion = None
+        if self.confusion_matrix and self.mode == 'val':
+            confusion = confusion_count(preds, label, self.num_class)
         del pred
-        return acc, category_accuracy
+        return acc, category_accuracy, confusion
 
     def forward(self, x):
         if self.mode == 'diagnosis':
             return self.diagnosis(x)
 
-        feature, labels = x
-        pred = self.fc_512(feature)
+        feature, labels = x[:2]
+        # the scores may be computed together with the other heads
+        pred = x[2] if len(x) > 2 else self.fc_512(feature)
+        # the scores of the fused head are half precision under autocast, the loss and accuracy use float32
+        pred = pred.float()
         loss = self.loss(pred, labels)
-        acc, category_accuracy = self._acc(pred, labels)
+        acc, category_accuracy, confusion = self._acc(pred, labels)
+
+        return loss, acc, category_accuracy, confusion
 
-        return loss, acc, category_accuracy
+    def head(self):
+        """
+        linear layers applied to the features, refer to fused_head.py
+        """
+        return [self.fc_512]
 
 
 class CosClassifier(nn.Module):
@@ -47,46 +127,41 @@ class CosClassifier(nn.Module):
         self.indim = args.feat_dim * args.crop_width * args.crop_height
         self.outdim = args.num_base_class
 
-        self.t = torch.ones(1).cuda() * 10
+        self.t = build_temperature(args)
         self.weight = nn.Parameter(torch.Tensor(self.outdim , self.indim))
         self.reset_parameters()
         self.loss = nn.CrossEntropyLoss(ignore_index=-1)
         self.mode = 'train'
+        self.confusion_matrix = bool(getattr(args, 'confusion_matrix', False))
 
     def reset_parameters(self):
         stdv = 1. / math.sqrt(self.weight.size(1))
         self.weight.data.uniform_(-stdv, stdv)
 
     def _acc(self, pred, label):
-        category_accuracy = torch.zeros(2, self.num_class)
         _, preds = torch.max(pred, dim=1)
         valid = (label >= 0).long()
         acc_sum = torch.sum(valid * (preds == label).long())
         instance_sum = torch.sum(valid)
         acc = acc_sum.float() / (instance_sum.float() + 1e-10)
-        for i, label_instance in enumerate(label):
-            category_accuracy[1, label_instance] += 1
-            if preds[i] == label_instance:
-                category_accuracy[0, label_instance] += 1
+        category_accuracy = category_count(preds, label, self.num_class)
+        # the counts of each replica are gathered by the data parallel, refer to base_model.py
+        confusion = None
+        if self.confusion_matrix and self.mode == 'val':
+            confusion = confusion_count(preds, label, self.num_class)
         del pred
-        return acc, category_accuracy
+        return acc, category_accuracy, confusion
 
     def forward(self, data):
         if self.mode == 'diagnosis':
             return self.diagnosis(data)
-        loss = 0
         feature, labels = data
-        feat_layers = len(feature)
-        pred = None
-
-        for i in range(feat_layers-1, feat_layers):
-            x = feature[i]
-            batch_size = x.size(0)
-            pred = self.t.cuda() * F.cosine_similarity(
-                x.unsqueeze(1).expand(batch_size, self.outdim, self.indim),
-                self.weight.unsqueeze(0).expand(batch_size, self.outdim, self.indim).cuda(), 2)
-            loss += self.loss(pred, labels)
+        # the last layer is used if the features of several layers are given
+        if isinstance(feature, (list, tuple)):
+            feature = feature[-1]
+        pred = cosine_logits(self, feature).float()
+        loss = self.loss(pred, labels)
 
-        acc, category_accuracy = self._acc(pred, labels)
+        acc, category_accuracy, confusion = self._acc(pred, labels)
 
-        return loss, acc, category_accuracy
+        return loss, acc, category_accuracy, confusion
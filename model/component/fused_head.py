@@ -0,0 +1,44 @@
+import torch
+import torch.nn.functional as F
+
+
+def fused_linear(x, linears):
+    """
+    apply several linear layers to the same input with a single matrix product
+    the layers keep their own parameters, only the product is fused
+    :param x: N * in_dim
+    :param linears: list of nn.Linear with in_dim input features
+    :return: N * sum of the output features, outputs of the layers concatenated in order
+    """
+    if len(linears) == 1:
+        return linears[0](x)
+    weight = torch.cat([linear.weight for linear in linears], dim=0)
+    bias = torch.cat([linear.bias for linear in linears], dim=0)
+    return F.linear(x, weight, bias)
+
+
+def head_widths(linears):
+    return [linear.out_features for linear in linears]
+
+
+def segmented_cross_entropy(scores, labels, widths):
+    """
+    cross entropy of several classification problems whose scores are concatenated
+    :param scores: N * sum(widths)
+    :param labels: N * len(widths), label of each segment
+    :param widths: class number of each segment
+    :return: sum over the segments of the mean loss of the segment
+    """
+    # the fused scores are half precision under autocast, the softmax of the segments is computed in float32
+    scores = scores.float()
+    num, num_segment, max_width = scores.shape[0], len(widths), max(widths)
+    # pad every segment to max_width with -inf, the padded classes get no probability
+    index = torch.full((num_segment, max_width), sum(widths), dtype=torch.long)
+    offset = 0
+    for i, width in enumerate(widths):
+        index[i, :width] = torch.arange(offset, offset + width)
+        offset += width
+    padding = scores.new_full((num, 1), float('-inf'))
+    padded = torch.cat((scores, padding), dim=1)[:, index.to(scores.device).view(-1)]
+    loss = F.cross_entropy(padded.view(num * num_segment, max_width), labels.reshape(-1), reduction='none')
+    return loss.view(num, num_segment).mean(dim=0).sum()
@@ -2,6 +2,7 @@ import torch.nn as nn
 import torch
 import numpy as np
 import torch.nn.functional as F
+from model.component.fused_head import fused_linear, segmented_cross_entropy
 
 
 class HierarchyClassifier(nn.Module):
@@ -26,18 +27,28 @@ class HierarchyClassifier(nn.Module):
         """
         if self.mode == 'diagnosis':
             return self.diagnosis(agg_data)
-        loss_sum = 0
         x = agg_data['features']
         hierarchy = agg_data['hierarchy'].long()
         hierarchy = hierarchy[:x.shape[0]]
 
         # Shallow supervision only
-        losses = []
-        for i in range(len(self.fcs)):
-            fc = self.fcs[i]
-            label = hierarchy[:, i]
-            score = fc(x)
-            losses.append(self.loss(score, label))
-        for loss in losses:
-            loss_sum += loss
-        return loss_sum
+        # scores of all the levels in one product, unless computed with the other heads
+        if 'scores' in agg_data:
+            scores = agg_data['scores']
+        else:
+            scores = fused_linear(x, self.fcs)
+        return segmented_cross_entropy(scores, hierarchy, self.layer_width)
+
+    def forward_batch(self, agg_batch):
+        """
+        loss of all the anchors of the step, equal to the sum of the per image loss times its anchor number
+        :param agg_batch: refer to ../base_model.py
+        :return: loss
+        """
+        return self.forward(agg_batch) * agg_batch['features'].shape[0]
+
+    def head(self):
+        """
+        linear layers applied to the features, refer to fused_head.py
+        """
+        return list(self.fcs)
@@ -1,36 +1,7 @@
 import torch.nn as nn
 import torch
-import numpy as np
 import torch.nn.functional as F
-
-
-class AttrSoftLoss(nn.Module):
-    """
-    soft margin loss for this
-    """
-    def __init__(self):
-        super(AttrSoftLoss, self).__init__()
-
-    def forward(self, x):
-        """
-        consider attributes as multiple labels
-        carry out multi-label classification loss
-        :param x: score and attributes
-        :return: loss
-        """
-        scores, attributes = x
-        attr_loss = 0.0
-        attributes = attributes.float().cuda()
-        for i in range(attributes.shape[0]):
-            loss_mask = torch.ones(attributes.shape[1]).cuda()
-            zeros = (attributes[i, :] == 0).nonzero().cpu().numpy()
-            indices = np.random.choice(zeros.squeeze(), int(round(len(zeros) * 0.95)), False)
-            loss_mask[indices] = 0
-
-            attr_loss += F.multilabel_soft_margin_loss(scores[i].unsqueeze(0),
-                                                       attributes[i].unsqueeze(0), weight=loss_mask)
-        attr_loss /= attributes.shape[0]
-        return attr_loss
+from model.component.attr import AttrSoftLoss
 
 
 class PartClassifier(nn.Module):
@@ -43,10 +14,12 @@ class PartClassifier(nn.Module):
         for supervision in args.supervision:
             if supervision['name'] == 'part':
                 self.num_class = supervision['other']['num_attr']
+                keep_ratio = supervision['other'].get('keep_ratio', 0.05)
+                seed = supervision['other'].get('seed', None)
         # self.mid_layer = nn.Linear(self.in_dim, self.in_dim)
         self.classifier = nn.Linear(self.in_dim, self.num_class)
         self.sigmoid = nn.Sigmoid()
-        self.loss = AttrSoftLoss()
+        self.loss = AttrSoftLoss(keep_ratio, seed)
         self.mode = 'train'
 
     def forward(self, agg_data):
@@ -61,8 +34,25 @@ class PartClassifier(nn.Module):
         x = agg_data['features']
         attributes = agg_data['part']
         # x = self.mid_layer(x)
-        x = self.classifier(x)
+        if 'scores' in agg_data:
+            x = agg_data['scores']
+        else:
+            x = self.classifier(x)
         # x = self.sigmoid(x)
         attributes = attributes[:x.shape[0]].long()
         loss = self.loss([x, attributes])
         return loss
+
+    def forward_batch(self, agg_batch):
+        """
+        loss of all the anchors of the step, equal to the sum of the per image loss times its anchor number
+        :param agg_batch: refer to ../base_model.py
+        :return: loss
+        """
+        return self.forward(agg_batch) * agg_batch['features'].shape[0]
+
+    def head(self):
+        """
+        linear layers applied to the features, refer to fused_head.py
+        """
+        return [self.classifier]
@@ -25,7 +25,7 @@ class PatchLocationClassifier(nn.Module):
         for j in range(2):
             pooled_features.append(self.global_pool(feature[:, j, :, :, :]))
         concat_feature = torch.cat(pooled_features, 1).view(batch_img_num, -1)
-        pred = self.fc(concat_feature)
+        pred = self.fc(concat_feature).float()
         loss = self.loss(pred, labels)
 
         return loss
@@ -2,6 +2,7 @@ import os
 import sys
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import math
 from model.\
     parallel.batchnorm import SynchronizedBatchNorm2d
@@ -141,6 +142,8 @@ class ResNet(nn.Module):
         self.layer4 = self._make_layer(block, 512, layers[3], stride=1,
                                        dilate=replace_stride_with_dilation[2], grow=True)
         self.avgpool = nn.AvgPool2d(kernel_size=3, stride=1)
+        # memory format of the inputs, set to torch.channels_last together with the weights
+        self.memory_format = torch.contiguous_format
 
         for m in self.modules():
             if isinstance(m, nn.Conv2d):
@@ -184,6 +187,7 @@ class ResNet(nn.Module):
         return nn.Sequential(*layers)
 
     def forward(self, x):
+        x = x.contiguous(memory_format=self.memory_format)
         x = self.conv1(x)
         x = self.bn1(x)
         x = self.relu(x)
@@ -197,6 +201,68 @@ class ResNet(nn.Module):
         feat4 = self.avgpool(feat4)
         return feat4
 
+    def feature_size(self, height, width):
+        """
+        height and width of the feature map of an input of height * width
+        """
+        def size(length):
+            # conv1, maxpool and layer1 halve the size, the other layers keep it
+            for i in range(3):
+                length = (length - 1) // 2 + 1
+            # avgpool has no padding
+            return length - 2
+        return size(height), size(width)
+
+
+def pack_groups(shapes, max_padding=0.):
+    """
+    group the inputs of a packed backbone call, the inputs of a group are zero padded to its largest height and width
+    :param shapes: list of (batch, height, width) of the inputs
+    :param max_padding: largest ratio of padded pixels in a group, 0 only groups inputs of the same height and width
+    :return: list of groups, each a list of indices of shapes
+    """
+    groups = []
+    order = sorted(range(len(shapes)), key=lambda i: -shapes[i][1] * shapes[i][2])
+    for i in order:
+        batch, height, width = shapes[i]
+        for group in groups:
+            group_height = max(max(shapes[j][1] for j in group), height)
+            group_width = max(max(shapes[j][2] for j in group), width)
+            pixels = sum(shapes[j][0] * shapes[j][1] * shapes[j][2] for j in group) + batch * height * width
+            group_batch = sum(shapes[j][0] for j in group) + batch
+            if 1 - pixels / float(group_batch * group_height * group_width) <= max_padding:
+                group.append(i)
+                break
+        else:
+            groups.append([i])
+    return groups
+
+
+def packed_forward(backbone, inputs, max_padding=0.):
+    """
+    run the backbone on several inputs with one call for each group of pack_groups
+    the inputs of a call share the batch statistics of the batch normalization
+    and the padded ones see zeros at their bottom and right, as the images padded in a batch by the dataset
+    :param backbone: ResNet
+    :param inputs: list of N_i * 3 * H_i * W_i
+    :param max_padding: largest ratio of padded pixels in a call
+    :return: list of feature maps, one for each input
+    """
+    shapes = [(x.shape[0], x.shape[2], x.shape[3]) for x in inputs]
+    feature_maps = [None] * len(inputs)
+    for group in pack_groups(shapes, max_padding):
+        height = max(shapes[i][1] for i in group)
+        width = max(shapes[i][2] for i in group)
+        packed = torch.cat([F.pad(inputs[i], (0, width - shapes[i][2], 0, height - shapes[i][1]))
+                            for i in group], dim=0) if len(group) > 1 else inputs[group[0]]
+        packed_feature_map = backbone(packed)
+        start = 0
+        for i in group:
+            feature_height, feature_width = backbone.feature_size(shapes[i][1], shapes[i][2])
+            feature_maps[i] = packed_feature_map[start:start + shapes[i][0], :, :feature_height, :feature_width]
+            start += shapes[i][0]
+    return feature_maps
+
 
 def resnet10(pretrained=False, progress=True, **kwargs):
     r"""ResNet-10 model from
@@ -4,42 +4,51 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Function
 
-import roi_align.crop_and_resize_cpu as crop_and_resize_cpu
-if torch.cuda.is_available():
+# the compiled extensions are optional, crop_and_resize falls back to
+# crop_and_resize_torch when the one for the device is not built
+try:
+    import roi_align.crop_and_resize_cpu as crop_and_resize_cpu
+except ImportError:
+    crop_and_resize_cpu = None
+try:
     import roi_align.crop_and_resize_gpu as crop_and_resize_gpu
+except ImportError:
+    crop_and_resize_gpu = None
 
 
+def extension_available(is_cuda):
+    if is_cuda:
+        return crop_and_resize_gpu is not None
+    return crop_and_resize_cpu is not None
 
-class CropAndResizeFunction(Function):
 
-    def __init__(self, crop_height, crop_width, extrapolation_value=0):
-        self.crop_height = crop_height
-        self.crop_width = crop_width
-        self.extrapolation_value = extrapolation_value
+class CropAndResizeFunction(Function):
 
-    def forward(self, image, boxes, box_ind):
+    @staticmethod
+    def forward(ctx, image, boxes, box_ind, crop_height, crop_width, extrapolation_value=0):
         crops = torch.zeros_like(image)
 
         if image.is_cuda:
             crop_and_resize_gpu.forward(
                 image, boxes, box_ind,
-                self.extrapolation_value, self.crop_height, self.crop_width, crops)
+                extrapolation_value, crop_height, crop_width, crops)
         else:
             crop_and_resize_cpu.forward(
                 image, boxes, box_ind,
-                self.extrapolation_value, self.crop_height, self.crop_width, crops)
+                extrapolation_value, crop_height, crop_width, crops)
 
         # save for backward
-        self.im_size = image.size()
-        self.save_for_backward(boxes, box_ind)
+        ctx.im_size = image.size()
+        ctx.save_for_backward(boxes, box_ind)
 
         return crops
 
-    def backward(self, grad_outputs):
-        boxes, box_ind = self.saved_tensors
+    @staticmethod
+    def backward(ctx, grad_outputs):
+        boxes, box_ind = ctx.saved_tensors
 
         grad_outputs = grad_outputs.contiguous()
-        grad_image = torch.zeros_like(grad_outputs).resize_(*self.im_size)
+        grad_image = torch.zeros_like(grad_outputs).resize_(*ctx.im_size)
 
         if grad_outputs.is_cuda:
             crop_and_resize_gpu.backward(
@@ -50,7 +59,74 @@ class CropAndResizeFunction(Function):
                 grad_outputs, boxes, box_ind, grad_image
             )
 
-        return grad_image, None, None
+        return grad_image, None, None, None, None, None
+
+
+def crop_and_resize_torch(image, boxes, box_ind, crop_height, crop_width, extrapolation_value=0):
+    """
+    crop_and_resize with batched bilinear gathers, same sampling as crop_and_resize.cpp
+    the gradient of image is given by autograd
+    :param image: NxCxHxW
+    :param boxes: Mx4 normalized box with (y1, x1, y2, x2)
+    :param box_ind: M
+    :return: MxCxcrop_heightxcrop_width
+    """
+    batch_size, depth, image_height, image_width = image.size()
+    num_boxes = boxes.size(0)
+    boxes = boxes.to(image.dtype)
+    y1, x1, y2, x2 = boxes.unbind(dim=1)
+
+    def sample_location(start, end, crop_size, image_size):
+        # M x crop_size sampling locations on the image and whether they are inside
+        if crop_size > 1:
+            steps = torch.arange(crop_size, dtype=image.dtype, device=image.device)
+            scale = (end - start) * (image_size - 1) / (crop_size - 1)
+            location = start.unsqueeze(1) * (image_size - 1) + steps.unsqueeze(0) * scale.unsqueeze(1)
+        else:
+            location = (0.5 * (start + end) * (image_size - 1)).unsqueeze(1)
+        inside = (location >= 0) & (location <= image_size - 1)
+        location = location.clamp(0, image_size - 1)
+        low = location.floor()
+        lerp = location - low
+        low = low.long()
+        high = location.ceil().long()
+        return low, high, lerp, inside
+
+    top, bottom, y_lerp, y_inside = sample_location(y1, y2, crop_height, image_height)
+    left, right, x_lerp, x_inside = sample_location(x1, x2, crop_width, image_width)
+
+    # gather the four neighbours of every sample from the pixels of all the images
+    pixels = image.permute(0, 2, 3, 1).reshape(-1, depth)
+    base = box_ind.long().view(num_boxes, 1, 1) * (image_height * image_width)
+
+    def gather(y, x):
+        index = base + y.unsqueeze(2) * image_width + x.unsqueeze(1)
+        return pixels.index_select(0, index.view(-1)).view(num_boxes, crop_height, crop_width, depth)
+
+    x_lerp = x_lerp.view(num_boxes, 1, crop_width, 1)
+    y_lerp = y_lerp.view(num_boxes, crop_height, 1, 1)
+    top_left = gather(top, left)
+    top_value = top_left + (gather(top, right) - top_left) * x_lerp
+    bottom_left = gather(bottom, left)
+    bottom_value = bottom_left + (gather(bottom, right) - bottom_left) * x_lerp
+    crops = top_value + (bottom_value - top_value) * y_lerp
+
+    inside = (y_inside.unsqueeze(2) & x_inside.unsqueeze(1)).unsqueeze(3)
+    crops = torch.where(inside, crops, crops.new_full((), extrapolation_value))
+    return crops.permute(0, 3, 1, 2).contiguous()
+
+
+def crop_and_resize(image, boxes, box_ind, crop_height, crop_width, extrapolation_value=0):
+    """
+    crop_and_resize on the compiled extension of the device, or on crop_and_resize_torch if it is not built
+    the crops are computed in float32 from a contiguous image, the extensions only support it
+    and the bilinear weights of reduced precision boxes would be coarse
+    """
+    image = image.float().contiguous()
+    boxes = boxes.float()
+    if extension_available(image.is_cuda):
+        return CropAndResizeFunction.apply(image, boxes, box_ind, crop_height, crop_width, extrapolation_value)
+    return crop_and_resize_torch(image, boxes, box_ind, crop_height, crop_width, extrapolation_value)
 
 
 class CropAndResize(nn.Module):
@@ -67,4 +143,4 @@ class CropAndResize(nn.Module):
         self.extrapolation_value = extrapolation_value
 
     def forward(self, image, boxes, box_ind):
-        return CropAndResizeFunction(self.crop_height, self.crop_width, self.extrapolation_value)(image, boxes, box_ind)
+        return crop_and_resize(image, boxes, box_ind, self.crop_height, self.crop_width, self.extrapolation_value)
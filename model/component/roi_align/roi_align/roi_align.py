@@ -1,7 +1,7 @@
 import torch
 from torch import nn
 
-from roi_align.crop_and_resize import CropAndResizeFunction, CropAndResize
+from roi_align.crop_and_resize import CropAndResizeFunction, CropAndResize, crop_and_resize
 
 
 class RoIAlign(nn.Module):
@@ -45,4 +45,4 @@ class RoIAlign(nn.Module):
 
         boxes = boxes.detach().contiguous()
         box_ind = box_ind.detach()
-        return CropAndResizeFunction(self.crop_height, self.crop_width, self.extrapolation_value)(featuremap, boxes, box_ind)
+        return crop_and_resize(featuremap, boxes, box_ind, self.crop_height, self.crop_width, self.extrapolation_value)
@@ -2,114 +2,248 @@
 //#include <TH/TH.h>
 #include <stdio.h>
 #include <math.h>
+#include <vector>
 
 namespace torch {
-void CropAndResizePerBox(
-    const float * image_data, 
-    const int batch_size,
-    const int depth,
+// sampling location of a crop row or column on the image
+struct CropSample {
+    int low;
+    int high;
+    float lerp;
+    bool valid;
+};
+
+// sampling locations of one box along one axis, shared by all the channels of the box
+void ComputeCropSamples(
+    const float start,
+    const float end,
+    const int crop_size,
+    const int image_size,
+    CropSample * samples
+) {
+    const float scale =
+        (crop_size > 1) ? (end - start) * (image_size - 1) / (crop_size - 1)
+                        : 0;
+    for (int i = 0; i < crop_size; ++i)
+    {
+        const float in = (crop_size > 1)
+                             ? start * (image_size - 1) + i * scale
+                             : 0.5 * (start + end) * (image_size - 1);
+        CropSample & sample = samples[i];
+        sample.valid = !(in < 0 || in > image_size - 1);
+        if (!sample.valid)
+        {
+            sample.low = sample.high = 0;
+            sample.lerp = 0;
+            continue;
+        }
+        sample.low = floorf(in);
+        sample.high = ceilf(in);
+        sample.lerp = in - sample.low;
+    }
+}
+
+// sampling locations of all the boxes, y_samples is num_boxes * crop_height, x_samples is num_boxes * crop_width
+void ComputeBoxSamples(
+    const float * boxes_data,
+    const int num_boxes,
     const int image_height,
     const int image_width,
-
-    const float * boxes_data, 
-    const int * box_index_data,
-    const int start_box, 
-    const int limit_box,
-
-    float * corps_data,
     const int crop_height,
     const int crop_width,
-    const float extrapolation_value
+    CropSample * y_samples,
+    CropSample * x_samples
 ) {
-    const int image_channel_elements = image_height * image_width;
-    const int image_elements = depth * image_channel_elements;
-
-    const int channel_elements = crop_height * crop_width;
-    const int crop_elements = depth * channel_elements;
-
     int b;
     #pragma omp parallel for
-    for (b = start_box; b < limit_box; ++b) {
+    for (b = 0; b < num_boxes; ++b) {
         const float * box = boxes_data + b * 4;
-        const float y1 = box[0];
-        const float x1 = box[1];
-        const float y2 = box[2];
-        const float x2 = box[3];
+        ComputeCropSamples(box[0], box[2], crop_height, image_height, y_samples + b * crop_height);
+        ComputeCropSamples(box[1], box[3], crop_width, image_width, x_samples + b * crop_width);
+    }
+}
 
+void CheckBoxIndex(const int * box_index_data, const int num_boxes, const int batch_size) {
+    for (int b = 0; b < num_boxes; ++b) {
         const int b_in = box_index_data[b];
         if (b_in < 0 || b_in >= batch_size) {
             printf("Error: batch_index %d out of range [0, %d)\n", b_in, batch_size);
             exit(-1);
         }
+    }
+}
 
-        const float height_scale =
-            (crop_height > 1)
-                ? (y2 - y1) * (image_height - 1) / (crop_height - 1)
-                : 0;
-        const float width_scale =
-            (crop_width > 1) ? (x2 - x1) * (image_width - 1) / (crop_width - 1)
-                             : 0;
-
-        for (int y = 0; y < crop_height; ++y)
+// crop of one channel of one box, kCropHeight and kCropWidth are compile time sizes, 0 for the runtime ones
+template <int kCropHeight, int kCropWidth>
+inline void CropChannel(
+    const float * pimage,
+    const int image_width,
+    const CropSample * y_samples,
+    const CropSample * x_samples,
+    const int runtime_crop_height,
+    const int runtime_crop_width,
+    const float extrapolation_value,
+    float * pcrop
+) {
+    const int crop_height = kCropHeight > 0 ? kCropHeight : runtime_crop_height;
+    const int crop_width = kCropWidth > 0 ? kCropWidth : runtime_crop_width;
+    for (int y = 0; y < crop_height; ++y)
+    {
+        const CropSample & sy = y_samples[y];
+        if (!sy.valid)
         {
-            const float in_y = (crop_height > 1)
-                                   ? y1 * (image_height - 1) + y * height_scale
-                                   : 0.5 * (y1 + y2) * (image_height - 1);
-
-            if (in_y < 0 || in_y > image_height - 1)
+            for (int x = 0; x < crop_width; ++x)
+            {
+                pcrop[y * crop_width + x] = extrapolation_value;
+            }
+            continue;
+        }
+        const float * top_row = pimage + sy.low * image_width;
+        const float * bottom_row = pimage + sy.high * image_width;
+        for (int x = 0; x < crop_width; ++x)
+        {
+            const CropSample & sx = x_samples[x];
+            if (!sx.valid)
             {
-                for (int x = 0; x < crop_width; ++x)
-                {
-                    for (int d = 0; d < depth; ++d)
-                    {
-                        // crops(b, y, x, d) = extrapolation_value;
-                        corps_data[crop_elements * b + channel_elements * d + y * crop_width + x] = extrapolation_value;
-                    }
-                }
+                pcrop[y * crop_width + x] = extrapolation_value;
                 continue;
             }
-            
-            const int top_y_index = floorf(in_y);
-            const int bottom_y_index = ceilf(in_y);
-            const float y_lerp = in_y - top_y_index;
+            const float top_left = top_row[sx.low];
+            const float top_right = top_row[sx.high];
+            const float bottom_left = bottom_row[sx.low];
+            const float bottom_right = bottom_row[sx.high];
+
+            const float top = top_left + (top_right - top_left) * sx.lerp;
+            const float bottom = bottom_left + (bottom_right - bottom_left) * sx.lerp;
+            pcrop[y * crop_width + x] = top + (bottom - top) * sy.lerp;
+        }
+    }
+}
 
-            for (int x = 0; x < crop_width; ++x)
+// gradient of one channel of one box added to the image channel
+template <int kCropHeight, int kCropWidth>
+inline void CropChannelBackward(
+    const float * pgrad,
+    const int image_width,
+    const CropSample * y_samples,
+    const CropSample * x_samples,
+    const int runtime_crop_height,
+    const int runtime_crop_width,
+    float * pimage
+) {
+    const int crop_height = kCropHeight > 0 ? kCropHeight : runtime_crop_height;
+    const int crop_width = kCropWidth > 0 ? kCropWidth : runtime_crop_width;
+    for (int y = 0; y < crop_height; ++y)
+    {
+        const CropSample & sy = y_samples[y];
+        if (!sy.valid)
+        {
+            continue;
+        }
+        float * top_row = pimage + sy.low * image_width;
+        float * bottom_row = pimage + sy.high * image_width;
+        for (int x = 0; x < crop_width; ++x)
+        {
+            const CropSample & sx = x_samples[x];
+            if (!sx.valid)
             {
-                const float in_x = (crop_width > 1)
-                                       ? x1 * (image_width - 1) + x * width_scale
-                                       : 0.5 * (x1 + x2) * (image_width - 1);
-                if (in_x < 0 || in_x > image_width - 1)
-                {
-                    for (int d = 0; d < depth; ++d)
-                    {
-                        corps_data[crop_elements * b + channel_elements * d + y * crop_width + x] = extrapolation_value;
-                    }
-                    continue;
-                }
-            
-                const int left_x_index = floorf(in_x);
-                const int right_x_index = ceilf(in_x);
-                const float x_lerp = in_x - left_x_index;
-
-                for (int d = 0; d < depth; ++d)
-                {   
-                    const float *pimage = image_data + b_in * image_elements + d * image_channel_elements;
-
-                    const float top_left = pimage[top_y_index * image_width + left_x_index];
-                    const float top_right = pimage[top_y_index * image_width + right_x_index];
-                    const float bottom_left = pimage[bottom_y_index * image_width + left_x_index];
-                    const float bottom_right = pimage[bottom_y_index * image_width + right_x_index];
-                    
-                    const float top = top_left + (top_right - top_left) * x_lerp;
-                    const float bottom =
-                        bottom_left + (bottom_right - bottom_left) * x_lerp;
-                        
-                    corps_data[crop_elements * b + channel_elements * d + y * crop_width + x] = top + (bottom - top) * y_lerp;
-                }
-            }   // end for x
-        }   // end for y
-    }   // end for b
+                continue;
+            }
+            const float grad_val = pgrad[y * crop_width + x];
+
+            const float dtop = (1 - sy.lerp) * grad_val;
+            top_row[sx.low] += (1 - sx.lerp) * dtop;
+            top_row[sx.high] += sx.lerp * dtop;
+
+            const float dbottom = sy.lerp * grad_val;
+            bottom_row[sx.low] += (1 - sx.lerp) * dbottom;
+            bottom_row[sx.high] += sx.lerp * dbottom;
+        }
+    }
+}
+
+// every (box, channel) pair is an independent crop, the pairs are split among the threads
+template <int kCropHeight, int kCropWidth>
+void CropAndResizePerBox(
+    const float * image_data,
+    const int depth,
+    const int image_height,
+    const int image_width,
+
+    const int * box_index_data,
+    const int num_boxes,
+    const CropSample * y_samples,
+    const CropSample * x_samples,
+
+    float * corps_data,
+    const int crop_height,
+    const int crop_width,
+    const float extrapolation_value
+) {
+    const int64_t image_channel_elements = (int64_t)image_height * image_width;
+    const int64_t image_elements = depth * image_channel_elements;
+    const int64_t channel_elements = crop_height * crop_width;
+    const int64_t num_crops = (int64_t)num_boxes * depth;
+
+    int64_t i;
+    #pragma omp parallel for schedule(static)
+    for (i = 0; i < num_crops; ++i) {
+        const int b = i / depth;
+        const int d = i % depth;
+        CropChannel<kCropHeight, kCropWidth>(
+            image_data + box_index_data[b] * image_elements + d * image_channel_elements,
+            image_width,
+            y_samples + b * crop_height,
+            x_samples + b * crop_width,
+            crop_height,
+            crop_width,
+            extrapolation_value,
+            corps_data + i * channel_elements);
+    }
+}
 
+// every (image, channel) pair only receives the gradients of the boxes on that image,
+// so the threads never write to the same channel and the summation order is kept
+template <int kCropHeight, int kCropWidth>
+void CropAndResizeBackwardPerImage(
+    const float * grads_data,
+    const int batch_size,
+    const int depth,
+    const int image_height,
+    const int image_width,
+
+    const std::vector<std::vector<int> > & boxes_of_image,
+    const CropSample * y_samples,
+    const CropSample * x_samples,
+
+    float * grads_image_data,
+    const int crop_height,
+    const int crop_width
+) {
+    const int64_t image_channel_elements = (int64_t)image_height * image_width;
+    const int64_t channel_elements = crop_height * crop_width;
+    const int64_t crop_elements = depth * channel_elements;
+    const int64_t num_channels = (int64_t)batch_size * depth;
+
+    int64_t i;
+    #pragma omp parallel for schedule(dynamic)
+    for (i = 0; i < num_channels; ++i) {
+        const int b_in = i / depth;
+        const int d = i % depth;
+        float * pimage = grads_image_data + i * image_channel_elements;
+        const std::vector<int> & boxes = boxes_of_image[b_in];
+        for (size_t k = 0; k < boxes.size(); ++k) {
+            const int b = boxes[k];
+            CropChannelBackward<kCropHeight, kCropWidth>(
+                grads_data + b * crop_elements + d * channel_elements,
+                image_width,
+                y_samples + b * crop_height,
+                x_samples + b * crop_width,
+                crop_height,
+                crop_width,
+                pimage);
+        }
+    }
 }
 
 #define CHECK_CUDA(x) AT_ASSERTM(!x.type().is_cuda(), #x " must be a CPU tensor")
@@ -145,24 +279,26 @@ void crop_and_resize_forward(
     crops.zero_();
 
     // crop_and_resize for each box
-    CropAndResizePerBox(
-        image.data<float>(),
-        batch_size,
-        depth,
-        image_height,
-        image_width,
-
-        boxes.data<float>(),
-        box_index.data<int>(),
-        0,
-        num_boxes,
-
-        crops.data<float>(),
-        crop_height,
-        crop_width,
-        extrapolation_value
-    );
-
+    const float * boxes_data = boxes.data<float>();
+    const int * box_index_data = box_index.data<int>();
+    CheckBoxIndex(box_index_data, num_boxes, batch_size);
+    std::vector<CropSample> y_samples(num_boxes * crop_height);
+    std::vector<CropSample> x_samples(num_boxes * crop_width);
+    ComputeBoxSamples(boxes_data, num_boxes, image_height, image_width, crop_height, crop_width,
+                      y_samples.data(), x_samples.data());
+
+    // 3x3 is the default crop size of the models, its loops are unrolled
+    if (crop_height == 3 && crop_width == 3) {
+        CropAndResizePerBox<3, 3>(
+            image.data<float>(), depth, image_height, image_width,
+            box_index_data, num_boxes, y_samples.data(), x_samples.data(),
+            crops.data<float>(), crop_height, crop_width, extrapolation_value);
+    } else {
+        CropAndResizePerBox<0, 0>(
+            image.data<float>(), depth, image_height, image_width,
+            box_index_data, num_boxes, y_samples.data(), x_samples.data(),
+            crops.data<float>(), crop_height, crop_width, extrapolation_value);
+    }
 }
 
 
@@ -187,13 +323,6 @@ void crop_and_resize_backward(
     const int crop_height   = grads.size(2);
     const int crop_width    = grads.size(3);
 
-    // n_elements
-    const int image_channel_elements = image_height * image_width;
-    const int image_elements = depth * image_channel_elements;
-
-    const int channel_elements = crop_height * crop_width;
-    const int crop_elements = depth * channel_elements;
-
     // init output space
     grads_image.zero_();
 //    THFloatTensor_zero(grads_image);
@@ -204,68 +333,27 @@ void crop_and_resize_backward(
     const int * box_index_data = box_index.data<int>();
     float * grads_image_data = grads_image.data<float>();
 
+    CheckBoxIndex(box_index_data, num_boxes, batch_size);
+    std::vector<CropSample> y_samples(num_boxes * crop_height);
+    std::vector<CropSample> x_samples(num_boxes * crop_width);
+    ComputeBoxSamples(boxes_data, num_boxes, image_height, image_width, crop_height, crop_width,
+                      y_samples.data(), x_samples.data());
+    std::vector<std::vector<int> > boxes_of_image(batch_size);
     for (int b = 0; b < num_boxes; ++b) {
-        const float * box = boxes_data + b * 4;
-        const float y1 = box[0];
-        const float x1 = box[1];
-        const float y2 = box[2];
-        const float x2 = box[3];
-
-        const int b_in = box_index_data[b];
-        if (b_in < 0 || b_in >= batch_size) {
-            printf("Error: batch_index %d out of range [0, %d)\n", b_in, batch_size);
-            exit(-1);
-        }
-
-        const float height_scale =
-            (crop_height > 1) ? (y2 - y1) * (image_height - 1) / (crop_height - 1)
-                              : 0;
-        const float width_scale =
-            (crop_width > 1) ? (x2 - x1) * (image_width - 1) / (crop_width - 1)
-                             : 0;
-
-        for (int y = 0; y < crop_height; ++y)
-        {
-            const float in_y = (crop_height > 1)
-                                   ? y1 * (image_height - 1) + y * height_scale
-                                   : 0.5 * (y1 + y2) * (image_height - 1);
-            if (in_y < 0 || in_y > image_height - 1)
-            {
-                continue;
-            }
-            const int top_y_index = floorf(in_y);
-            const int bottom_y_index = ceilf(in_y);
-            const float y_lerp = in_y - top_y_index;
-
-            for (int x = 0; x < crop_width; ++x)
-            {
-                const float in_x = (crop_width > 1)
-                                       ? x1 * (image_width - 1) + x * width_scale
-                                       : 0.5 * (x1 + x2) * (image_width - 1);
-                if (in_x < 0 || in_x > image_width - 1)
-                {
-                    continue;
-                }
-                const int left_x_index = floorf(in_x);
-                const int right_x_index = ceilf(in_x);
-                const float x_lerp = in_x - left_x_index;
-
-                for (int d = 0; d < depth; ++d)
-                {
-                    float *pimage = grads_image_data + b_in * image_elements + d * image_channel_elements;
-                    const float grad_val = grads_data[crop_elements * b + channel_elements * d + y * crop_width + x];
-
-                    const float dtop = (1 - y_lerp) * grad_val;
-                    pimage[top_y_index * image_width + left_x_index] += (1 - x_lerp) * dtop;
-                    pimage[top_y_index * image_width + right_x_index] += x_lerp * dtop;
-
-                    const float dbottom = y_lerp * grad_val;
-                    pimage[bottom_y_index * image_width + left_x_index] += (1 - x_lerp) * dbottom;
-                    pimage[bottom_y_index * image_width + right_x_index] += x_lerp * dbottom;
-                }   // end d
-            }   // end x
-        }   // end y
-    }   // end b
+        boxes_of_image[box_index_data[b]].push_back(b);
+    }
+
+    if (crop_height == 3 && crop_width == 3) {
+        CropAndResizeBackwardPerImage<3, 3>(
+            grads_data, batch_size, depth, image_height, image_width,
+            boxes_of_image, y_samples.data(), x_samples.data(),
+            grads_image_data, crop_height, crop_width);
+    } else {
+        CropAndResizeBackwardPerImage<0, 0>(
+            grads_data, batch_size, depth, image_height, image_width,
+            boxes_of_image, y_samples.data(), x_samples.data(),
+            grads_image_data, crop_height, crop_width);
+    }
 }
 }
 
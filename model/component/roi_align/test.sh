@@ -1,3 +1,4 @@
 python tests/test.py
 python tests/test2.py
 python tests/crop_and_resize_example.py
+python tests/test_torch_backend.py
@@ -0,0 +1,44 @@
+import time
+import argparse
+import torch
+
+from roi_align.crop_and_resize import CropAndResizeFunction, crop_and_resize_torch, extension_available
+from test_torch_backend import generate_data
+
+
+def measure(func, image, boxes, box_ind, crop_size, repeat):
+    """
+    :return: seconds of a forward and backward pass
+    """
+    image = image.detach().requires_grad_()
+    for i in range(repeat + 1):
+        # the first pass is a warm up
+        if i == 1:
+            start = time.time()
+        crops = func(image, boxes, box_ind, crop_size, crop_size, 0)
+        crops.sum().backward()
+    return (time.time() - start) / repeat
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', default=4, type=int)
+    parser.add_argument('--depth', default=512, type=int)
+    parser.add_argument('--size', default=38, type=int, help='height and width of the feature map')
+    parser.add_argument('--boxes', default=200, type=int)
+    parser.add_argument('--crop_size', default=3, type=int)
+    parser.add_argument('--repeat', default=10, type=int)
+    parser.add_argument('--threads', default=0, type=int, help='torch threads, 0 keeps the default')
+    args = parser.parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    image, boxes, box_ind = generate_data(args.batch_size, args.depth, args.size, args.size, args.boxes)
+    elapsed = measure(crop_and_resize_torch, image, boxes, box_ind, args.crop_size, args.repeat)
+    print('torch backend: {:.2f} ms, {:.0f} boxes / s'.format(elapsed * 1000, args.boxes / elapsed))
+    if extension_available(False):
+        elapsed_ext = measure(CropAndResizeFunction.apply, image, boxes, box_ind, args.crop_size, args.repeat)
+        print('cpu extension: {:.2f} ms, {:.0f} boxes / s'.format(elapsed_ext * 1000, args.boxes / elapsed_ext))
+        print('speed up of the torch backend: {:.2f}x'.format(elapsed_ext / elapsed))
+    else:
+        print('cpu extension not built, run python setup.py install first')
@@ -0,0 +1,107 @@
+import numpy as np
+import torch
+from torch.autograd import gradcheck
+
+from roi_align.crop_and_resize import CropAndResizeFunction, crop_and_resize_torch, extension_available
+from roi_align.roi_align import RoIAlign
+
+
+def generate_data(batch_size, depth, im_height, im_width, n_boxes, is_cuda=False):
+    # boxes partly outside the image to cover the extrapolation
+    ys = np.random.uniform(-0.2, 1.2, size=(n_boxes, 2))
+    xs = np.random.uniform(-0.2, 1.2, size=(n_boxes, 2))
+    ys.sort(axis=1)
+    xs.sort(axis=1)
+    boxes = np.stack((ys[:, 0], xs[:, 0], ys[:, 1], xs[:, 1]), axis=-1).astype(np.float32)
+    box_ind = np.random.randint(0, batch_size, size=n_boxes, dtype=np.int32)
+    image = np.random.randn(batch_size, depth, im_height, im_width).astype(np.float32)
+
+    image, boxes, box_ind = torch.from_numpy(image), torch.from_numpy(boxes), torch.from_numpy(box_ind)
+    if is_cuda:
+        image, boxes, box_ind = image.cuda(), boxes.cuda(), box_ind.cuda()
+    return image, boxes, box_ind
+
+
+def crop_and_resize_reference(image, boxes, box_ind, crop_height, crop_width, extrapolation_value=0):
+    """
+    loop version of crop_and_resize.cpp
+    """
+    image, boxes, box_ind = image.cpu().numpy(), boxes.cpu().numpy(), box_ind.cpu().numpy()
+    _, depth, image_height, image_width = image.shape
+    crops = np.zeros((boxes.shape[0], depth, crop_height, crop_width), dtype=np.float32)
+    for b, (y1, x1, y2, x2) in enumerate(boxes):
+        height_scale = (y2 - y1) * (image_height - 1) / (crop_height - 1) if crop_height > 1 else 0
+        width_scale = (x2 - x1) * (image_width - 1) / (crop_width - 1) if crop_width > 1 else 0
+        for y in range(crop_height):
+            in_y = y1 * (image_height - 1) + y * height_scale if crop_height > 1 \
+                else 0.5 * (y1 + y2) * (image_height - 1)
+            for x in range(crop_width):
+                in_x = x1 * (image_width - 1) + x * width_scale if crop_width > 1 \
+                    else 0.5 * (x1 + x2) * (image_width - 1)
+                if in_y < 0 or in_y > image_height - 1 or in_x < 0 or in_x > image_width - 1:
+                    crops[b, :, y, x] = extrapolation_value
+                    continue
+                top, bottom = int(np.floor(in_y)), int(np.ceil(in_y))
+                left, right = int(np.floor(in_x)), int(np.ceil(in_x))
+                y_lerp, x_lerp = in_y - top, in_x - left
+                pimage = image[box_ind[b]]
+                top_value = pimage[:, top, left] + (pimage[:, top, right] - pimage[:, top, left]) * x_lerp
+                bottom_value = pimage[:, bottom, left] + (pimage[:, bottom, right] - pimage[:, bottom, left]) * x_lerp
+                crops[b, :, y, x] = top_value + (bottom_value - top_value) * y_lerp
+    return crops
+
+
+def test_forward_parity(crop_height, crop_width, is_cuda=False):
+    image, boxes, box_ind = generate_data(batch_size=3, depth=4, im_height=17, im_width=23, n_boxes=20,
+                                          is_cuda=is_cuda)
+    crops = crop_and_resize_torch(image, boxes, box_ind, crop_height, crop_width, 0.5)
+    reference = crop_and_resize_reference(image, boxes, box_ind, crop_height, crop_width, 0.5)
+    diff = np.abs(crops.cpu().numpy() - reference)
+    print('reference forward (crop {}x{}) max_err: {}'.format(crop_height, crop_width, diff.max()))
+    assert diff.max() < 1e-4
+
+    if extension_available(is_cuda):
+        image.requires_grad = True
+        crops = crop_and_resize_torch(image, boxes, box_ind, crop_height, crop_width, 0.5)
+        grad = torch.randn_like(crops)
+        grad_torch, = torch.autograd.grad(crops, image, grad)
+        crops_ext = CropAndResizeFunction.apply(image, boxes, box_ind, crop_height, crop_width, 0.5)
+        grad_ext, = torch.autograd.grad(crops_ext, image, grad)
+        forward_diff = (crops - crops_ext).abs().max().item()
+        backward_diff = (grad_torch - grad_ext).abs().max().item()
+        print('extension forward max_err: {}, backward max_err: {}'.format(forward_diff, backward_diff))
+        assert forward_diff < 1e-4 and backward_diff < 1e-4
+    else:
+        print('extension not built, skip the comparison with it')
+
+
+def test_gradcheck(is_cuda=False):
+    image, boxes, box_ind = generate_data(batch_size=2, depth=2, im_height=10, im_width=10, n_boxes=4,
+                                          is_cuda=is_cuda)
+    image = image.double().requires_grad_()
+    gradcheck(lambda x: crop_and_resize_torch(x, boxes, box_ind, 3, 3), (image,))
+    print('gradcheck ok')
+
+
+def test_roialign(is_cuda=False):
+    image, boxes, box_ind = generate_data(batch_size=2, depth=2, im_height=10, im_width=10, n_boxes=4,
+                                          is_cuda=is_cuda)
+    boxes = boxes * 9
+    roi_align = RoIAlign(3, 3, transform_fpcoor=True)
+    crops = roi_align(image, boxes, box_ind)
+    assert crops.shape == (4, 2, 3, 3)
+    print('roi_align ok')
+
+
+if __name__ == '__main__':
+    def main():
+        np.random.seed(0)
+        is_cuda = torch.cuda.is_available()
+        for crop_size in [(1, 1), (3, 3), (7, 5)]:
+            test_forward_parity(crop_size[0], crop_size[1], is_cuda=False)
+            if is_cuda:
+                test_forward_parity(crop_size[0], crop_size[1], is_cuda=True)
+        test_gradcheck(is_cuda=False)
+        test_roialign(is_cuda=is_cuda)
+
+    main()
@@ -15,7 +15,7 @@ class RotationClassifier(nn.Module):
     def forward(self, x):
         feature, labels = x
         pooled_feature = self.global_pool(feature)
-        pred = self.fc(pooled_feature.view(-1, 512))
+        pred = self.fc(pooled_feature.view(-1, 512)).float()
         loss = self.loss(pred, labels)
 
         return loss
@@ -32,8 +32,19 @@ class SceneClassifier(nn.Module):
         scene = agg_data['scene'].long()
 
         # Shallow supervision only
-        x = self.pool(x.unsqueeze(0)).view(-1)
+        x = self.pool(x.unsqueeze(0)).reshape(-1)
         label = scene
-        score = self.fc(x)
+        score = self.fc(x).float()
         loss_sum += self.loss(score.unsqueeze(0), label.unsqueeze(0))
         return loss_sum
+
+    def forward_batch(self, agg_batch):
+        """
+        loss of all the anchors of the step, equal to the sum of the per image loss times its anchor number
+        :param agg_batch: refer to ../base_model.py
+        :return: loss
+        """
+        x = self.pool(agg_batch['feature_map'])
+        score = self.fc(x.reshape(x.shape[0], -1)).float()
+        loss = F.cross_entropy(score, agg_batch['scene'].long(), reduction='none')
+        return (loss * agg_batch['anchor_nums']).sum()
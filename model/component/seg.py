@@ -41,7 +41,7 @@ class MaskPredictor(nn.Module):
         feature_map = agg_input['feature_map']
         mask = agg_input['seg']
         feature_map = feature_map.unsqueeze(0)
-        predicted_map = self.fc1(feature_map)
+        predicted_map = self.fc1(feature_map).float()
         predicted_map = F.interpolate(predicted_map, size=(mask.shape[0], mask.shape[1]), mode='nearest')
         mask = mask.unsqueeze(0)
         weight = torch.ones(self.args.num_base_class + 1).cuda()
@@ -49,3 +49,21 @@ class MaskPredictor(nn.Module):
 
         loss = F.cross_entropy(predicted_map, mask.long(), weight=weight)
         return loss
+
+    def forward_batch(self, agg_batch):
+        """
+        loss of all the anchors of the step, equal to the sum of the per image loss times its anchor number
+        :param agg_batch: refer to ../base_model.py
+        :return: loss
+        """
+        mask = agg_batch['seg'].long()
+        # upsampled to the mask and summed over its pixels, in float32 as fc1 gives half precision under autocast
+        predicted_map = self.fc1(agg_batch['feature_map']).float()
+        predicted_map = F.interpolate(predicted_map, size=(mask.shape[1], mask.shape[2]), mode='nearest')
+        weight = torch.ones(self.args.num_base_class + 1, device=predicted_map.device)
+        weight[-1] = 0.1
+
+        # weighted mean of each image as in forward
+        loss = F.cross_entropy(predicted_map, mask, weight=weight, reduction='none')
+        loss = loss.sum(dim=(1, 2)) / weight[mask].sum(dim=(1, 2))
+        return (loss * agg_batch['anchor_nums']).sum()
@@ -2,8 +2,8 @@ import torch
 import torch.nn as nn
 import numpy as np
 import math
-from torch.nn.functional import cosine_similarity
 import torch.nn.functional as F
+from model.component.classifier import build_temperature, cosine_logits
 
 
 class NovelClassifier(nn.Module):
@@ -79,7 +79,7 @@ class NovelCosClassifier(nn.Module):
         self.loss = nn.CrossEntropyLoss(ignore_index=-1)
         self.mode = 'train'
 
-        self.t = torch.ones(1).cuda() * 10
+        self.t = build_temperature(args)
         self.weight = nn.Parameter(torch.Tensor(self.num_class, self.in_dim))
         self.reset_parameters()
 
@@ -93,11 +93,7 @@ class NovelCosClassifier(nn.Module):
     def predict(self, x):
         feature = x['feature']
         label = x['label'].long()
-        xx = feature
-        batch_size = xx.size(0)
-        pred = self.t.cuda() * cosine_similarity(
-            xx.unsqueeze(1).expand(batch_size, self.num_class, self.in_dim),
-            self.weight.unsqueeze(0).expand(batch_size, self.num_class, self.in_dim).cuda(), 2)
+        pred = cosine_logits(self, feature)
         return self.acc(pred, label)
 
     def forward(self, x):
@@ -109,11 +105,7 @@ class NovelCosClassifier(nn.Module):
         feature = x['feature']
         label = x['label'].long()
 
-        xx = feature
-        batch_size = xx.size(0)
-        pred = self.t.cuda() * cosine_similarity(
-            xx.unsqueeze(1).expand(batch_size, self.num_class, self.in_dim),
-            self.weight.unsqueeze(0).expand(batch_size, self.num_class, self.in_dim).cuda(), 2)
+        pred = cosine_logits(self, feature)
         loss = self.loss(pred, label)
 
         acc = self._acc(pred, label)
@@ -11,6 +11,7 @@
 import collections
 
 import torch
+import torch.distributed as dist
 import torch.nn.functional as F
 
 from torch.nn.modules.batchnorm import _BatchNorm
@@ -31,6 +32,22 @@ def _unsqueeze_ft(tensor):
     return tensor.unsqueeze(0).unsqueeze(-1)
 
 
+class _AllReduceSum(torch.autograd.Function):
+    """sum over the processes of torch.distributed, the gradient is summed the same way"""
+
+    @staticmethod
+    def forward(ctx, tensor):
+        tensor = tensor.clone()
+        dist.all_reduce(tensor)
+        return tensor
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grad_output = grad_output.clone()
+        dist.all_reduce(grad_output)
+        return grad_output
+
+
 _ChildMessage = collections.namedtuple('_ChildMessage', ['sum', 'ssum', 'sum_size'])
 _MasterMessage = collections.namedtuple('_MasterMessage', ['sum', 'inv_std'])
 
@@ -42,6 +59,7 @@ class _SynchronizedBatchNorm(_BatchNorm):
         self._sync_master = SyncMaster(self._data_parallel_master)
 
         self._is_parallel = False
+        self._is_distributed = False
         self._parallel_id = None
         self._slave_pipe = None
 
@@ -54,15 +72,18 @@ class _SynchronizedBatchNorm(_BatchNorm):
         self._tmp_running_var = self.running_var.clone() * self._running_iter
 
     def forward(self, input):
+        if self._is_distributed and self.training:
+            return self._distributed_forward(input)
+
         # If it is not parallel computation or is in evaluation mode, use PyTorch's implementation.
         if not (self._is_parallel and self.training):
             return F.batch_norm(
                 input, self.running_mean, self.running_var, self.weight, self.bias,
                 self.training, self.momentum, self.eps)
 
-        # Resize the input to (B, C, -1).
-        input_shape = input.size()
-        input = input.view(input.size(0), self.num_features, -1)
+        # Resize the input to (B, C, -1), the statistics are computed in float32 under autocast.
+        input_shape, input_dtype = input.size(), input.dtype
+        input = input.reshape(input.size(0), self.num_features, -1).float()
 
         # Compute the sum and square-sum.
         sum_size = input.size(0) * input.size(2)
@@ -83,7 +104,33 @@ class _SynchronizedBatchNorm(_BatchNorm):
             output = (input - _unsqueeze_ft(mean)) * _unsqueeze_ft(inv_std)
 
         # Reshape it.
-        return output.view(input_shape)
+        return output.view(input_shape).to(input_dtype)
+
+    def _distributed_forward(self, input):
+        """
+        training forward with the statistics reduced over the processes of torch.distributed
+        the reduction is differentiable, as the ReduceAddCoalesced and Broadcast of the data parallel
+        """
+        input_shape, input_dtype = input.size(), input.dtype
+        # the statistics are computed in float32 under autocast, as F.batch_norm does
+        input = input.reshape(input.size(0), self.num_features, -1).float()
+
+        # sum, square-sum and size of all the processes in one reduction
+        sum_size = input.size(0) * input.size(2)
+        stats = torch.cat([_sum_ft(input), _sum_ft(input ** 2), input.new_tensor([sum_size])])
+        stats = _AllReduceSum.apply(stats)
+        input_sum, input_ssum = stats[:self.num_features], stats[self.num_features:2 * self.num_features]
+        # the size stays on the device, reading it would stall every layer. every process has a part of
+        # the batch, so the reduced size is over 1 when this one is
+        assert sum_size > 1 or dist.get_world_size() > 1, \
+            'BatchNorm computes unbiased standard-deviation, which requires size > 1.'
+        mean, inv_std = self._compute_mean_std(input_sum, input_ssum, stats[-1])
+
+        if self.affine:
+            output = (input - _unsqueeze_ft(mean)) * _unsqueeze_ft(inv_std * self.weight) + _unsqueeze_ft(self.bias)
+        else:
+            output = (input - _unsqueeze_ft(mean)) * _unsqueeze_ft(inv_std)
+        return output.view(input_shape).to(input_dtype)
 
     def __data_parallel_replicate__(self, ctx, copy_id):
         self._is_parallel = True
@@ -122,8 +169,10 @@ class _SynchronizedBatchNorm(_BatchNorm):
 
     def _compute_mean_std(self, sum_, ssum, size):
         """Compute the mean and standard-deviation with sum and square-sum. This method
-        also maintains the moving average on the master device."""
-        assert size > 1, 'BatchNorm computes unbiased standard-deviation, which requires size > 1.'
+        also maintains the moving average on the master device. The size may be a tensor, which the caller
+        checks."""
+        if not torch.is_tensor(size):
+            assert size > 1, 'BatchNorm computes unbiased standard-deviation, which requires size > 1.'
         mean = sum_ / size
         sumvar = ssum - sum_ * mean
         unbias_var = sumvar / (size - 1)
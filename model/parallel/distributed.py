@@ -0,0 +1,76 @@
+import os
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from .batchnorm import _SynchronizedBatchNorm
+
+__all__ = ['launch', 'get_world_size', 'is_main_process', 'all_reduce_sum', 'patch_distributed_batchnorm']
+
+
+def get_world_size(args):
+    return getattr(args, 'world_size', 1)
+
+
+def is_main_process(args):
+    return getattr(args, 'rank', 0) == 0
+
+
+def all_reduce_sum(tensor, args):
+    """
+    sum of the tensor over the processes of a distributed run, the tensor itself otherwise
+    """
+    if get_world_size(args) == 1:
+        return tensor
+    # nccl only reduces tensors of the device of the process
+    reduced = tensor.detach().to(args.device, copy=True)
+    dist.all_reduce(reduced)
+    return reduced.to(tensor.device)
+
+
+def patch_distributed_batchnorm(module):
+    """
+    synchronize the statistics of the SynchronizedBatchNorm layers across the processes, as the replicas of
+    the data parallel do. every process must then make the same sequence of backbone calls in a training step
+    """
+    for m in module.modules():
+        if isinstance(m, _SynchronizedBatchNorm):
+            m._is_distributed = True
+
+
+def _worker(local_rank, main, args):
+    args.local_rank = local_rank
+    args.rank = args.node_rank * args.nproc_per_node + local_rank
+    if torch.cuda.is_available():
+        torch.cuda.set_device(local_rank)
+        args.device = torch.device('cuda', local_rank)
+        args.gpus = [local_rank]
+    else:
+        args.device = torch.device('cpu')
+        args.gpus = [-1]
+    backend = args.dist_backend
+    if backend == '':
+        backend = 'nccl' if torch.cuda.is_available() else 'gloo'
+    dist.init_process_group(backend, init_method=args.dist_url, world_size=args.world_size, rank=args.rank)
+    main(args)
+    dist.destroy_process_group()
+
+
+def launch(main, args):
+    """
+    run main(args) in one process for each device, on args.nnodes nodes
+    the processes of a node are spawned here, unless they were started by torchrun which sets LOCAL_RANK
+    args: nproc_per_node, nnodes, node_rank, dist_url, dist_backend ('' for nccl on cuda and gloo on cpu)
+    """
+    if 'LOCAL_RANK' in os.environ:
+        args.nproc_per_node = int(os.environ['LOCAL_WORLD_SIZE'])
+        args.nnodes = int(os.environ['WORLD_SIZE']) // args.nproc_per_node
+        args.node_rank = int(os.environ['RANK']) // args.nproc_per_node
+        args.world_size = int(os.environ['WORLD_SIZE'])
+        args.dist_url = 'env://'
+        _worker(int(os.environ['LOCAL_RANK']), main, args)
+        return
+    if args.nproc_per_node <= 0:
+        args.nproc_per_node = torch.cuda.device_count() if torch.cuda.is_available() else 1
+    args.world_size = args.nnodes * args.nproc_per_node
+    mp.spawn(_worker, args=(main, args), nprocs=args.nproc_per_node)
@@ -0,0 +1,40 @@
+"""
+O(1) lookup from ADE20k object ids to category indexes
+shared by generate_list.py and the scripts in supervison_generation
+"""
+import json
+
+
+class CategoryIndex(object):
+    def __init__(self, category_list):
+        """
+        :param category_list: object ids, the position in the list is the category index
+        """
+        self.category_list = list(category_list)
+        self.id2index = dict()
+        for i, obj in enumerate(self.category_list):
+            self.id2index[obj] = i
+
+    @classmethod
+    def from_file(cls, path):
+        f = open(path, 'r')
+        category_list = json.load(f)
+        f.close()
+        return cls(category_list)
+
+    def __len__(self):
+        return len(self.category_list)
+
+    def __contains__(self, obj):
+        return obj in self.id2index
+
+    def index(self, obj):
+        """
+        same as list.index of the category list
+        """
+        if obj not in self.id2index:
+            raise ValueError('{} is not in the category list'.format(obj))
+        return self.id2index[obj]
+
+    def get(self, obj, default=None):
+        return self.id2index.get(obj, default)
@@ -0,0 +1,29 @@
+"""
+compile the json lists generated by generate_list.py into memory-mappable indexes
+the output directory can be passed to train.py as --list_train / --list_val
+"""
+import sys
+sys.path.append('../')
+import json
+import argparse
+from dataset.sample_index import compile_index
+
+
+def compile_list(list_file, output):
+    f = open(list_file, 'r')
+    list_sample = json.load(f)
+    f.close()
+    meta = compile_index(list_sample, output)
+    print('{} -> {}: {} images, {} anchors'.format(list_file, output, meta['img_num'], meta['anchor_num']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--list_files', nargs='+',
+                        default=['../data/ADE/ADE_Base/base_img_train.json',
+                                 '../data/ADE/ADE_Base/base_img_val.json'])
+    args = parser.parse_args()
+
+    for list_file in args.list_files:
+        output = list_file[:-5] + '.idx' if list_file.endswith('.json') else list_file + '.idx'
+        compile_list(list_file, output)
@@ -0,0 +1,31 @@
+"""
+decode the seg / bkg supervision maps once and write them into a map store
+to use it, add the store directory to the 'other' field of the supervision, e.g.
+{"name": "seg", "type": "img", "content": "map", ..., "other": {"store": "data/ADE/ADE_Supervision/seg_store"}}
+"""
+import sys
+sys.path.append('../')
+import os
+import json
+import argparse
+from dataset.map_store import build_map_store
+from dataset.transform import decode_seg, decode_bkg
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--name', default='seg', help='seg or bkg')
+    parser.add_argument('--supervision_file', default='../data/ADE/ADE_Supervision/seg.json')
+    parser.add_argument('--root_dataset', default='../../')
+    parser.add_argument('--output', default='../data/ADE/ADE_Supervision/seg_store')
+    parser.add_argument('--chunk_size', default=1, type=float, help='size of a chunk file in GB')
+    args = parser.parse_args()
+
+    f = open(args.supervision_file, 'r')
+    paths = json.load(f)
+    f.close()
+
+    decode = {'seg': decode_seg, 'bkg': decode_bkg}[args.name]
+    meta = build_map_store(paths, lambda path: decode(os.path.join(args.root_dataset, path)),
+                           args.output, chunk_bytes=int(args.chunk_size * 1024 ** 3))
+    print('{} maps in {} chunks'.format(meta['map_num'], meta['chunk_num']))
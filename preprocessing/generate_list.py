@@ -4,116 +4,174 @@ import argparse
 import os
 import random
 import math
+from multiprocessing import Pool
 from addcontext import add_context
+from stage_cache import StageCache, stage_digest
+from category_index import CategoryIndex
 
 
-def base_generation(args):
-    origin_path = os.path.join(args.root_dataset, args.origin_dataset)
-    supervision_path = os.path.join(args.root_dataset, args.supervision_dataset)
-    base_set_path = os.path.join(origin_path, 'base_set.json')
-    img_path_path = os.path.join(origin_path, 'img_path.json')
-    img_path2size_path = os.path.join(origin_path, 'img_path2size.json')
-    base_list_path = os.path.join(origin_path, 'base_list.json')
-    f = open(base_set_path, 'r')
-    base_set = json.load(f)
+def load_json(path):
+    f = open(path, 'r')
+    data = json.load(f)
     f.close()
-    f = open(img_path_path, 'r')
-    img_path = json.load(f)
-    f.close()
-    f = open(img_path2size_path, 'r')
-    img_path2size = json.load(f)
-    f.close()
-    f = open(base_list_path, 'r')
-    base_list = json.load(f)
+    return data
+
+
+def load_jsons(paths, workers):
+    """
+    parse several json files in parallel
+    """
+    if workers <= 1 or len(paths) <= 1:
+        return [load_json(path) for path in paths]
+    pool = Pool(min(workers, len(paths)))
+    data = pool.map(load_json, paths)
+    pool.close()
+    pool.join()
+    return data
+
+
+def dump_list(sample_list, path):
+    """
+    write the list sample by sample instead of encoding it as a whole
+    the result is the same as json.dump
+    """
+    tmp_path = path + '.tmp'
+    f = open(tmp_path, 'w')
+    f.write('[')
+    for i, sample in enumerate(sample_list):
+        if i != 0:
+            f.write(', ')
+        json.dump(sample, f)
+    f.write(']')
     f.close()
+    os.replace(tmp_path, path)
 
-    # get other supervision
-    supervision_path_names = []
-    for supervision_src in args.supervision_src:
-        supervision_path_names.append({'name': supervision_src['name'], 'path': supervision_src['path'],
-                                       'type': supervision_src['type']})
-    supervision_contents = []
-    for supervision in supervision_path_names:
-        path = os.path.join(supervision_path, supervision['path'])
-        f = open(path, 'r')
-        data = json.load(f)
-        supervision_contents.append({'data': data, 'name': supervision['name'], 'type': supervision['type']})
-        f.close()
-
-    # initialize the sample list,add image level information
-    sample_list_train = [dict() for i in range(len(img_path))]
-    for i in range(len(img_path)):
-        sample_list_train[i]['fpath_img'] = img_path[i]
-        sample_list_train[i]['height'], sample_list_train[i]['width'] = \
-            img_path2size[img_path[i]]
-        sample_list_train[i]['index'] = i
-        sample_list_train[i]['anchors'] = []
-        # add image level information
-        for j in range(len(supervision_contents)):
-            if supervision_contents[j]['type'] == 'img':
-                sample_list_train[i][supervision_contents[j]['name']] = supervision_contents[j]['data'][i]
-
-    sample_list_val = [dict() for i in range(len(img_path))]
+
+def init_sample_list(img_path, img_path2size):
+    sample_list = [dict() for i in range(len(img_path))]
     for i in range(len(img_path)):
-        sample_list_val[i]['fpath_img'] = img_path[i]
-        sample_list_val[i]['height'], sample_list_val[i]['width'] = \
+        sample_list[i]['fpath_img'] = img_path[i]
+        sample_list[i]['height'], sample_list[i]['width'] = \
             img_path2size[img_path[i]]
-        sample_list_val[i]['index'] = i
-        sample_list_val[i]['anchors'] = []
-
-    # get the category information to split train and val
-    # add supervision information to instance level
-    all_list = [[] for category in base_list]
-    for i, obj in enumerate(base_set):
-        img_index = int(obj["img"])
-        category = base_list.index(int(obj["obj"]))
-        box = obj["box"]
-        path = img_path[int(obj["img"])]
+        sample_list[i]['index'] = i
+        sample_list[i]['anchors'] = []
+    return sample_list
+
+
+def collect_objects(object_set, category_list, inst_contents=(), skip_unknown=False):
+    """
+    map every object to its category in a single pass
+    :param object_set: base_set or novel_set
+    :param category_list: object ids of the categories
+    :param inst_contents: instance level supervision aligned with object_set
+    :param skip_unknown: drop the objects not in category_list instead of raising ValueError
+    :return: list of (img, category, box, instance supervision) in the order of object_set
+    """
+    category_index = CategoryIndex(category_list)
+    objects = []
+    for i, obj in enumerate(object_set):
+        if skip_unknown:
+            category = category_index.get(int(obj["obj"]))
+            if category is None:
+                continue
+        else:
+            category = category_index.index(int(obj["obj"]))
+        supervision = dict()
+        for content in inst_contents:
+            supervision[content['name']] = content['data'][i]
+        objects.append((int(obj["img"]), category, obj["box"], supervision))
+    return objects
+
+
+def group_objects(args, objects, category_num, img_path, img_path2size):
+    """
+    add context to the boxes and shuffle the objects of each category
+    """
+    # same random state as a fresh import of addcontext
+    random.seed(73)
+    all_list = [[] for category in range(category_num)]
+    for img_index, category, box, supervision in objects:
+        path = img_path[img_index]
         shape = img_path2size[path]
         if args.context:
             box = add_context(args, box, shape)
         annotation = {"img": img_index, "obj": category, "box": box}
-        for supervision in supervision_contents:
-            if supervision['type'] == 'inst':
-                data = supervision['data'][i]
-                annotation[supervision['name']] = data
+        annotation.update(supervision)
         all_list[category].append(annotation)
 
     random.seed(73)
-    for category in range(len(base_list)):
-        if all_list[category] is []:
-            continue
+    for category in range(category_num):
         random.shuffle(all_list[category])
+    return all_list
 
-    # split into train and val
-    for i in range(len(base_list)):
-        length = len(all_list[i])
-        if length == 0:
-            continue
-        for j in range(0, math.ceil(5 * length / 6)):
-            img_index = all_list[i][j]['img']
-            anchor = dict()
-            anchor['anchor'] = all_list[i][j]['box']
-            anchor['label'] = i
-            # add instance level supervision for train
-            for supervision in supervision_contents:
-                if supervision['type'] == 'inst':
-                    anchor[supervision['name']] = all_list[i][j][supervision['name']]
-            sample_list_train[img_index]['anchors'].append(anchor)
-
-        for j in range(math.ceil(5 * length / 6), length):
-            img_index = all_list[i][j]['img']
-            sample_list_val[img_index]['anchors'].append({'anchor': all_list[i][j]['box'], 'label': i})
 
+def base_generation(args):
+    origin_path = os.path.join(args.root_dataset, args.origin_dataset)
+    supervision_path = os.path.join(args.root_dataset, args.supervision_dataset)
+    base_set_path = os.path.join(origin_path, 'base_set.json')
+    img_path_path = os.path.join(origin_path, 'img_path.json')
+    img_path2size_path = os.path.join(origin_path, 'img_path2size.json')
+    base_list_path = os.path.join(origin_path, 'base_list.json')
     output_path = os.path.join(args.root_dataset, args.output)
     output_train = os.path.join(output_path, 'base_img_train.json')
-    f = open(output_train, 'w')
-    json.dump(sample_list_train, f)
-    f.close()
     output_val = os.path.join(output_path, 'base_img_val.json')
-    f = open(output_val, 'w')
-    json.dump(sample_list_val, f)
-    f.close()
+    cache = StageCache(args.cache_dir if args.cache_dir != '' else os.path.join(output_path, '.stage_cache'))
+
+    # get other supervision
+    inst_supervision = [x for x in args.supervision_src if x['type'] == 'inst']
+    img_supervision = [x for x in args.supervision_src if x['type'] == 'img']
+    inst_paths = [os.path.join(supervision_path, x['path']) for x in inst_supervision]
+    img_paths = [os.path.join(supervision_path, x['path']) for x in img_supervision]
+
+    # stage 1: category of every object, with its instance level supervision
+    def base_objects():
+        data = load_jsons([base_set_path, base_list_path] + inst_paths, args.workers)
+        base_set, base_list = data[0], data[1]
+        inst_contents = [{'name': x['name'], 'data': d} for x, d in zip(inst_supervision, data[2:])]
+        return collect_objects(base_set, base_list, inst_contents), len(base_list)
+    objects_digest = stage_digest([base_set_path, base_list_path] + inst_paths,
+                                  [x['name'] for x in inst_supervision])
+    objects, category_num = cache.run('base_objects', objects_digest, base_objects)
+
+    # stage 2: split into train and val and write the lists
+    def base_lists():
+        data = load_jsons([img_path_path, img_path2size_path] + img_paths, args.workers)
+        img_path, img_path2size = data[0], data[1]
+
+        # initialize the sample list,add image level information
+        sample_list_train = init_sample_list(img_path, img_path2size)
+        for i in range(len(img_path)):
+            for supervision, content in zip(img_supervision, data[2:]):
+                sample_list_train[i][supervision['name']] = content[i]
+        sample_list_val = init_sample_list(img_path, img_path2size)
+
+        # get the category information to split train and val
+        all_list = group_objects(args, objects, category_num, img_path, img_path2size)
+
+        # split into train and val
+        for i in range(category_num):
+            length = len(all_list[i])
+            if length == 0:
+                continue
+            for j in range(0, math.ceil(5 * length / 6)):
+                img_index = all_list[i][j]['img']
+                anchor = dict()
+                anchor['anchor'] = all_list[i][j]['box']
+                anchor['label'] = i
+                # add instance level supervision for train
+                for supervision in inst_supervision:
+                    anchor[supervision['name']] = all_list[i][j][supervision['name']]
+                sample_list_train[img_index]['anchors'].append(anchor)
+
+            for j in range(math.ceil(5 * length / 6), length):
+                img_index = all_list[i][j]['img']
+                sample_list_val[img_index]['anchors'].append({'anchor': all_list[i][j]['box'], 'label': i})
+
+        dump_list(sample_list_train, output_train)
+        dump_list(sample_list_val, output_val)
+    lists_digest = stage_digest([img_path_path, img_path2size_path] + img_paths,
+                                [objects_digest, [x['name'] for x in img_supervision], args.context, args.ratio])
+    cache.run('base_lists', lists_digest, base_lists, outputs=[output_train, output_val])
 
 
 def novel_generation(args):
@@ -122,78 +180,47 @@ def novel_generation(args):
     img_path_path = os.path.join(origin_path, 'img_path.json')
     img_path2size_path = os.path.join(origin_path, 'img_path2size.json')
     novel_list_path = os.path.join(origin_path, 'novel_val_list.json')
-    f = open(novel_set_path, 'r')
-    novel_set = json.load(f)
-    f.close()
-    f = open(img_path_path, 'r')
-    img_path = json.load(f)
-    f.close()
-    f = open(img_path2size_path, 'r')
-    img_path2size = json.load(f)
-    f.close()
-    f = open(novel_list_path, 'r')
-    novel_list = json.load(f)
-    f.close()
-
-    # initialize the sample list
-    sample_list_train = [dict() for i in range(len(img_path))]
-    for i in range(len(img_path)):
-        sample_list_train[i]['fpath_img'] = img_path[i]
-        sample_list_train[i]['height'], sample_list_train[i]['width'] = \
-            img_path2size[img_path[i]]
-        sample_list_train[i]['index'] = i
-        sample_list_train[i]['anchors'] = []
-    sample_list_val = [dict() for i in range(len(img_path))]
-    for i in range(len(img_path)):
-        sample_list_val[i]['fpath_img'] = img_path[i]
-        sample_list_val[i]['height'], sample_list_val[i]['width'] = \
-            img_path2size[img_path[i]]
-        sample_list_val[i]['index'] = i
-        sample_list_val[i]['anchors'] = []
-
-    # get the category information to split train and val
-    all_list = [[] for category in novel_list]
-    for obj in novel_set:
-        img_index = int(obj["img"])
-        if int(obj["obj"]) not in novel_list:
-            continue
-        category = novel_list.index(int(obj["obj"]))
-        box = obj["box"]
-        path = img_path[int(obj["img"])]
-        shape = img_path2size[path]
-        if args.context:
-            box = add_context(args, box, shape)
-        annotation = {"img": img_index, "obj": category, "box": box}
-        all_list[category].append(annotation)
-
-    random.seed(73)
-    for category in range(len(novel_list)):
-        if all_list[category] is []:
-            continue
-        random.shuffle(all_list[category])
-
-    # split into train and val
-    for i in range(len(novel_list)):
-        length = len(all_list[i])
-        if length == 0:
-            continue
-        for j in range(0, args.shot):
-            img_index = all_list[i][j]['img']
-            sample_list_train[img_index]['anchors'].append({'anchor': all_list[i][j]['box'], 'label': i})
-
-        for j in range(args.shot, length):
-            img_index = all_list[i][j]['img']
-            sample_list_val[img_index]['anchors'].append({'anchor': all_list[i][j]['box'], 'label': i})
-
     output_path = os.path.join(args.root_dataset, args.output)
     output_train = os.path.join(output_path, 'novel_img_train.json')
-    f = open(output_train, 'w')
-    json.dump(sample_list_train, f)
-    f.close()
     output_val = os.path.join(output_path, 'novel_img_val.json')
-    f = open(output_val, 'w')
-    json.dump(sample_list_val, f)
-    f.close()
+    cache = StageCache(args.cache_dir if args.cache_dir != '' else os.path.join(output_path, '.stage_cache'))
+
+    # stage 1: category of every object, objects not in the novel list are dropped
+    def novel_objects():
+        novel_set, novel_list = load_jsons([novel_set_path, novel_list_path], args.workers)
+        return collect_objects(novel_set, novel_list, skip_unknown=True), len(novel_list)
+    objects_digest = stage_digest([novel_set_path, novel_list_path], [])
+    objects, category_num = cache.run('novel_objects', objects_digest, novel_objects)
+
+    # stage 2: split into train and val by shot and write the lists
+    def novel_lists():
+        img_path, img_path2size = load_jsons([img_path_path, img_path2size_path], args.workers)
+
+        # initialize the sample list
+        sample_list_train = init_sample_list(img_path, img_path2size)
+        sample_list_val = init_sample_list(img_path, img_path2size)
+
+        # get the category information to split train and val
+        all_list = group_objects(args, objects, category_num, img_path, img_path2size)
+
+        # split into train and val
+        for i in range(category_num):
+            length = len(all_list[i])
+            if length == 0:
+                continue
+            for j in range(0, args.shot):
+                img_index = all_list[i][j]['img']
+                sample_list_train[img_index]['anchors'].append({'anchor': all_list[i][j]['box'], 'label': i})
+
+            for j in range(args.shot, length):
+                img_index = all_list[i][j]['img']
+                sample_list_val[img_index]['anchors'].append({'anchor': all_list[i][j]['box'], 'label': i})
+
+        dump_list(sample_list_train, output_train)
+        dump_list(sample_list_val, output_val)
+    lists_digest = stage_digest([img_path_path, img_path2size_path],
+                                [objects_digest, args.context, args.ratio, args.shot])
+    cache.run('novel_lists', lists_digest, novel_lists, outputs=[output_train, output_val])
 
 
 if __name__ == '__main__':
@@ -202,11 +229,13 @@ if __name__ == '__main__':
     parser.add_argument('-origin_dataset', default='ADE_Origin/', help='origin dir')
     parser.add_argument('--supervision_dataset', default='ADE_Supervision/', help='supervision information')
     parser.add_argument('-part', default='Base', help='Base or Novel')
-    parser.add_argument('-shot', default=5, help='shot in Novel')
+    parser.add_argument('-shot', default=5, type=int, help='shot in Novel')
     parser.add_argument('-img_size', default='img_path2size.json', help='img size file')
     parser.add_argument('--supervision_src', default=json.load(open('./supervision.json', 'r')), type=list)
     parser.add_argument('-context', type=bool, default=True)
     parser.add_argument('-ratio', type=float, default=2.7)
+    parser.add_argument('--workers', type=int, default=4, help='processes parsing the input files')
+    parser.add_argument('--cache_dir', default='', help='stage cache, default to .stage_cache in the output dir')
     # example [{'type': 'img', 'name': 'seg', 'path': '1.json'},
     # {'type': 'inst', 'name': 'attr', 'path': 'attr.json'}]
 
@@ -215,4 +244,4 @@ if __name__ == '__main__':
     if args.part == 'Base':
         base_generation(args)
     elif args.part == 'Novel':
-        novel_generation(args)
\ No newline at end of file
+        novel_generation(args)
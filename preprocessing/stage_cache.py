@@ -0,0 +1,62 @@
+"""
+content hash based cache for the stages of the list generation
+a stage is skipped when the digest of its inputs is the same as in the last run
+"""
+import os
+import json
+import pickle
+import hashlib
+
+
+def file_digest(path):
+    md5 = hashlib.md5()
+    f = open(path, 'rb')
+    for block in iter(lambda: f.read(1 << 20), b''):
+        md5.update(block)
+    f.close()
+    return md5.hexdigest()
+
+
+def stage_digest(files, params):
+    """
+    :param files: input files of the stage
+    :param params: json serializable parameters of the stage, including the digests of former stages
+    :return: digest of the inputs
+    """
+    md5 = hashlib.md5()
+    for path in files:
+        md5.update(file_digest(path).encode('utf-8'))
+    md5.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+    return md5.hexdigest()
+
+
+class StageCache(object):
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def run(self, name, digest, func, outputs=()):
+        """
+        run a stage unless its inputs are unchanged
+        :param name: stage name
+        :param digest: digest of the stage inputs
+        :param func: function computing the stage result
+        :param outputs: files written by func, the stage reruns if any of them is missing
+        :return: result of func, loaded from the cache if skipped
+        """
+        path = os.path.join(self.cache_dir, name + '.pkl')
+        if os.path.exists(path) and all(os.path.exists(output) for output in outputs):
+            f = open(path, 'rb')
+            cached_digest, result = pickle.load(f)
+            f.close()
+            if cached_digest == digest:
+                print('skip stage {}: inputs unchanged'.format(name))
+                return result
+
+        print('run stage {}'.format(name))
+        result = func()
+        f = open(path, 'wb')
+        pickle.dump((digest, result), f, protocol=pickle.HIGHEST_PROTOCOL)
+        f.close()
+        return result
@@ -7,6 +7,9 @@ import json
 import numpy as np
 import os
 import argparse
+import sys
+sys.path.append('../')
+from category_index import CategoryIndex
 
 
 def generate_attr(args):
@@ -16,13 +19,11 @@ def generate_attr(args):
     f = open(args.base_set, 'r')
     base_set = json.load(f)
     f.close()
-    f = open(args.base_list, 'r')
-    base_list = json.load(f)
-    f.close()
+    category_index = CategoryIndex.from_file(args.base_list)
 
     attr_list = []
     for i, sample in enumerate(base_set):
-        category = base_list.index(int(sample["obj"]))
+        category = category_index.index(int(sample["obj"]))
         attr_list.append(attr[category])
 
     f = open(args.output, 'w')
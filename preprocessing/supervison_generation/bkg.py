@@ -6,7 +6,22 @@ import json
 import argparse
 import os
 import numpy as np
-import cv2
+import sys
+sys.path.append('../')
+from category_index import CategoryIndex
+from remap import build_table, run_remap
+
+
+def encode_bkg(seg_map, src):
+    """
+    split the class index into 3 uint8 channels
+    """
+    if (seg_map < 0).any():
+        raise KeyError('{} contains objects not in the class list'.format(src))
+    p0 = seg_map % 256
+    p1 = (seg_map // 256) % 256
+    p2 = seg_map // (256 * 256)
+    return np.stack((p0, p1, p2), axis=2).astype(np.uint8)
 
 
 def generate_bkg(args):
@@ -19,43 +34,20 @@ def generate_bkg(args):
     img_paths = json.load(f)
     f.close()
 
-    f = open('../../data/ADE/ADE_Origin/all_list.json')
-    base_list = json.load(f)
-    f.close()
-
-    base_map = {}
-    for i in range(len(base_list)):
-        base_map[base_list[i]] = i
-    base_set = set(base_map.keys())
+    category_index = CategoryIndex.from_file(args.all_list)
+    table = build_table(category_index, -1)
 
     seg_paths = []
-    length = len(img_paths)
+    tasks = []
     for i, img_path in enumerate(img_paths):
         seg_path_original = img_path[:-4] + '_seg.png'
-        if not os.path.exists(os.path.join('../../../' + seg_path_original)):
+        if not os.path.exists(os.path.join(args.root_dataset + seg_path_original)):
             raise RuntimeError('{} not exists'.format(seg_path_original))
-        seg_path = img_path[:-4] + '_seg_base.png'
+        seg_path = img_path[:-4] + '_seg_bkg.png'
         seg_paths.append(seg_path)
+        tasks.append((args.root_dataset + seg_path_original, args.root_dataset + seg_path))
 
-        segmentation = cv2.imread(os.path.join('../../../' + seg_path_original))
-        B, G, R = np.transpose(segmentation, (2, 0, 1))
-        seg_map = (G + 256 * (R / 10))
-        seg_map_new = np.zeros((seg_map.shape[0], seg_map.shape[1], 3))
-        H, W = seg_map.shape
-        for h in range(H):
-            for w in range(W):
-                val = base_map[seg_map[h, w]]
-                p0 = val % 256
-                val = val // 256
-                p1 = val % 256
-                p2 = val // 256
-                seg_map_new[h, w, 0] = p0
-                seg_map_new[h, w, 1] = p1
-                seg_map_new[h, w, 2] = p2
-        cv2.imwrite('../../../' + seg_path, seg_map_new.astype(np.uint8))
-
-        if i % 1 == 0:
-            print('{} / {}'.format(i, length))
+    run_remap(tasks, table, encode_bkg, args.output + '.state', args.workers)
 
     f = open(args.output, 'w')
     json.dump(seg_paths, f)
@@ -65,7 +57,10 @@ def generate_bkg(args):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--img_path_file', default='../../data/ADE/ADE_Origin/img_path.json')
+    parser.add_argument('--all_list', default='../../data/ADE/ADE_Origin/all_list.json')
+    parser.add_argument('--root_dataset', default='../../../')
     parser.add_argument('--output', default='../../data/ADE/ADE_Supervision/bkg.json')
+    parser.add_argument('--workers', default=8, type=int)
     args = parser.parse_args()
 
     generate_bkg(args)
@@ -0,0 +1,55 @@
+"""
+generate all the instance level supervision in a single pass over base_set
+Format: same as attr.py, hierarchy.py and bbox.py, one file per supervision
+"""
+import json
+import os
+import argparse
+import sys
+sys.path.append('../')
+from category_index import CategoryIndex
+
+
+def generate_inst(args):
+    f = open(args.base_set, 'r')
+    base_set = json.load(f)
+    f.close()
+    category_index = CategoryIndex.from_file(args.base_list)
+
+    # category level supervision, looked up by the category of each object
+    sources = dict()
+    for name, path in [('attr', args.attr_file), ('part', args.part_file), ('hierarchy', args.hierarchy_file)]:
+        if path == '':
+            continue
+        f = open(path, 'r')
+        sources[name] = json.load(f)
+        f.close()
+
+    outputs = dict()
+    for name in sources.keys():
+        outputs[name] = []
+    outputs['bbox'] = []
+    for sample in base_set:
+        category = category_index.index(int(sample["obj"]))
+        for name, source in sources.items():
+            outputs[name].append(source[category])
+        outputs['bbox'].append(sample['box'])
+
+    for name, content in outputs.items():
+        f = open(os.path.join(args.output_dir, name + '.json'), 'w')
+        json.dump(content, f)
+        f.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--attr_file', default='../../data/ADE/ADE_Origin/attr.json', help='empty to skip')
+    parser.add_argument('--part_file', default='../../data/ADE/ADE_Origin/part.json', help='empty to skip')
+    parser.add_argument('--hierarchy_file', default='../../data/ADE/ADE_Origin/hierarchy.json', help='empty to skip')
+    parser.add_argument('--base_set', default='../../data/ADE/ADE_Origin/base_set.json')
+    parser.add_argument('--base_list', default='../../data/ADE/ADE_Origin/base_list.json')
+    parser.add_argument('--output_dir', default='../../data/ADE/ADE_Supervision/')
+
+    args = parser.parse_args()
+
+    generate_inst(args)
@@ -0,0 +1,93 @@
+"""
+remap ADE20k _seg.png files through a dense lookup table
+shared by seg.py and bkg.py, the images are processed by a pool of workers
+and an interrupted run resumes from the images that are not written yet
+"""
+import os
+import json
+import hashlib
+from multiprocessing import Pool
+import numpy as np
+import cv2
+
+_table = None
+_encode = None
+
+
+def build_table(class_map, default):
+    """
+    dense table from the (R, G) value of a _seg.png pixel to a class index
+    :param class_map: CategoryIndex or dict from the ADE20k object id (G + 256 * R / 10) to the class index
+    :param default: index of the pixels whose object id is not in class_map
+    :return: table of 256 * 256 items, indexed by R * 256 + G
+    """
+    table = np.zeros(256 * 256, dtype=np.int64)
+    for r in range(256):
+        for g in range(256):
+            table[r * 256 + g] = class_map.get(g + 256 * (r / 10), default)
+    return table
+
+
+def remap(segmentation, table):
+    """
+    :param segmentation: BGR _seg.png
+    :param table: refer to build_table
+    :return: class index of every pixel
+    """
+    B, G, R = np.transpose(segmentation, (2, 0, 1))
+    return np.take(table, R.astype(np.int64) * 256 + G)
+
+
+def _init_worker(table, encode):
+    global _table, _encode
+    _table = table
+    _encode = encode
+
+
+def _remap_file(task):
+    src, dst = task
+    segmentation = cv2.imread(src)
+    result = _encode(remap(segmentation, _table), src)
+    # write to a temporary file first, a partial png is never taken as done when resuming
+    tmp = dst[:-4] + '.tmp.png'
+    cv2.imwrite(tmp, result)
+    os.replace(tmp, dst)
+    return dst
+
+
+def run_remap(tasks, table, encode, state_path, workers):
+    """
+    remap all the images, skipping the ones already done with the same table
+    :param tasks: list of (source _seg.png, output png)
+    :param table: refer to build_table
+    :param encode: function(class index map, source path) -> image to write
+    :param state_path: file recording the table of the current pass, the outputs must not be written by
+    another remap with its own state file
+    :param workers: number of processes
+    """
+    digest = hashlib.md5(table.tobytes()).hexdigest()
+    resume = False
+    if os.path.exists(state_path):
+        f = open(state_path, 'r')
+        resume = json.load(f)['digest'] == digest
+        f.close()
+    if not resume:
+        # a new class list, every image is generated again
+        f = open(state_path, 'w')
+        json.dump({'digest': digest}, f)
+        f.close()
+    state_time = os.path.getmtime(state_path)
+
+    todo = []
+    for src, dst in tasks:
+        if resume and os.path.exists(dst) and os.path.getmtime(dst) >= state_time:
+            continue
+        todo.append((src, dst))
+    print('{} / {} images to generate'.format(len(todo), len(tasks)))
+
+    pool = Pool(workers, initializer=_init_worker, initargs=(table, encode))
+    for i, _ in enumerate(pool.imap_unordered(_remap_file, todo, chunksize=16)):
+        if i % 100 == 0:
+            print('{} / {}'.format(i, len(todo)))
+    pool.close()
+    pool.join()
@@ -6,7 +6,14 @@ import json
 import argparse
 import os
 import numpy as np
-import cv2
+import sys
+sys.path.append('../')
+from category_index import CategoryIndex
+from remap import build_table, run_remap
+
+
+def encode_seg(seg_map, src):
+    return seg_map.astype(np.uint8)
 
 
 def generate_seg(args):
@@ -19,36 +26,21 @@ def generate_seg(args):
     img_paths = json.load(f)
     f.close()
 
-    f = open('../../data/ADE/ADE_Origin/base_list.json')
-    base_list = json.load(f)
-    f.close()
-
-    base_map = {}
-    for i in range(len(base_list)):
-        base_map[base_list[i]] = i
-    base_set = set(base_map.keys())
+    category_index = CategoryIndex.from_file(args.base_list)
+    # pixels not in the base classes are assigned to the extra class
+    table = build_table(category_index, len(category_index))
 
     seg_paths = []
-    length = len(img_paths)
+    tasks = []
     for i, img_path in enumerate(img_paths):
         seg_path_original = img_path[:-4] + '_seg.png'
-        if not os.path.exists(os.path.join('../../../' + seg_path_original)):
+        if not os.path.exists(os.path.join(args.root_dataset + seg_path_original)):
             raise RuntimeError('{} not exists'.format(seg_path_original))
         seg_path = img_path[:-4] + '_seg_base.png'
         seg_paths.append(seg_path)
-        segmentation = cv2.imread(os.path.join('../../../' + seg_path_original))
-        B, G, R = np.transpose(segmentation, (2, 0, 1))
-        seg_map = (G + 256 * (R / 10))
-        H, W = seg_map.shape
-        for h in range(H):
-            for w in range(W):
-                if seg_map[h, w] not in base_set:
-                    seg_map[h, w] = 189
-                else:
-                    seg_map[h, w] = base_map[seg_map[h, w]]
-        cv2.imwrite('../../../' + seg_path, seg_map.astype(np.uint8))
-        if i % 1 == 0:
-            print('{} / {}'.format(i, length))
+        tasks.append((args.root_dataset + seg_path_original, args.root_dataset + seg_path))
+
+    run_remap(tasks, table, encode_seg, args.output + '.state', args.workers)
 
     f = open(args.output, 'w')
     json.dump(seg_paths, f)
@@ -58,7 +50,10 @@ def generate_seg(args):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--img_path_file', default='../../data/ADE/ADE_Origin/img_path.json')
+    parser.add_argument('--base_list', default='../../data/ADE/ADE_Origin/base_list.json')
+    parser.add_argument('--root_dataset', default='../../../')
     parser.add_argument('--output', default='../../data/ADE/ADE_Supervision/seg.json')
+    parser.add_argument('--workers', default=8, type=int)
     args = parser.parse_args()
 
     generate_seg(args)
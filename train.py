@@ -14,13 +14,18 @@ import torch
 import torch.nn as nn
 
 from dataset.base_dataset import BaseDataset
-from dataset.collate import UserScatteredDataParallel, user_scattered_collate
+from dataset.collate import UserScatteredDataParallel, UserScatteredDistributedDataParallel, \
+    user_scattered_collate
 from dataset.dataloader import DataLoaderIter, DataLoader
+from dataset.sampler import build_epoch_sampler
 from utils import AverageMeter, parse_devices
 
 from model.builder import ModelBuilder
+from model.amp import build_grad_scaler, scaled_backward
 from model.base_model import BaseLearningModule
 from model.parallel.replicate import patch_replication_callback
+from model.parallel.distributed import launch, get_world_size, is_main_process, all_reduce_sum, \
+    patch_distributed_batchnorm
 
 from utils import selective_load_weights, category_acc, set_fixed_weights
 from logger import Logger
@@ -44,6 +49,7 @@ def train(module, iterator, optimizers, epoch, args):
 
     module.train()
     module.module.mode = 'train'
+    module.module.classifier.mode = 'train'
     # main loop
     tic = time.time()
     for i in range(args.train_epoch_iters):
@@ -62,18 +68,21 @@ def train(module, iterator, optimizers, epoch, args):
 
         instances = instances.type_as(acc).detach()
         acc = acc.detach()
-        loss = (loss * instances).sum() / instances.sum().float()
-        acc_actual = (acc * instances).sum() / instances.sum().float()
+        # instance weighted means over the devices, and over the processes of a distributed run.
+        # the batches filled up to a budget vary in size, every anchor of the step still weighs the same
+        instance_sum = all_reduce_sum(instances.sum().float(), args)
+        loss = (loss * instances).sum() / instance_sum
+        acc_actual = (acc * instances).sum() / instance_sum
 
         if loss_supervision is not None:
-            loss_cls = (loss_cls * instances).sum() / instances.sum().float()
+            loss_cls = (loss_cls * instances).sum() / instance_sum
             loss_supervision_agg = []
             for sup, supervision in enumerate(args.supervision):
                 tmp = 0
                 gpu_num = len(args.gpus)
                 for j in range(gpu_num):
                     tmp += loss_supervision[len(args.supervision) * j + sup] * instances[j]
-                tmp = tmp / instances.sum().float()
+                tmp = tmp / instance_sum
                 loss_supervision_agg.append({"name": supervision["name"],
                                              "value": tmp})
 
@@ -81,16 +90,26 @@ def train(module, iterator, optimizers, epoch, args):
         #     break
 
         # Backward
-        loss.backward()
-        for optimizer in optimizers:
-            optimizer.step()
+        # the gradients are averaged over the processes, the loss is scaled to keep the instance weighted mean
+        scaled_backward(loss * get_world_size(args), optimizers, args.grad_scaler)
+
+        # sum the parts of the processes in one reduction
+        metrics = [loss.detach(), acc_actual]
+        if loss_supervision is not None:
+            metrics += [loss_cls.detach()] + [agg['value'].detach() for agg in loss_supervision_agg]
+        metrics = all_reduce_sum(torch.stack(metrics), args)
+        loss, acc_actual = metrics[0], metrics[1]
+        if loss_supervision is not None:
+            loss_cls = metrics[2]
+            for j, agg in enumerate(loss_supervision_agg):
+                agg['value'] = metrics[3 + j]
 
         # measure elapsed time
         batch_time.update(time.time() - tic)
         tic = time.time()
 
         # update average loss and acc
-        for k in range(int(instances.sum())):
+        for k in range(int(instance_sum)):
             ave_total_loss.update(loss.data.item())
             ave_acc.update(acc_actual * 100)
             if loss_cls is not None:
@@ -98,7 +117,7 @@ def train(module, iterator, optimizers, epoch, args):
                 for j in range(len(args.supervision)):
                     ave_supervision_loss[j].update(loss_supervision_agg[j]["value"].item())
 
-        if i % args.display_iter == 0:
+        if i % args.display_iter == 0 and is_main_process(args):
             message = 'Epoch: [{}][{}/{}], Time: {:.2f}, Data: {:.2f}, ' \
                       'lr_feat: {:.6f}, lr_cls: {:.6f}, Accuracy: {:4.2f}, ' \
                       'Loss: {:.6f}, Acc-Iter: {:4.2f}, '.format(epoch, i, args.train_epoch_iters, batch_time.average(),
@@ -128,8 +147,10 @@ def train(module, iterator, optimizers, epoch, args):
         del acc_actual
         del instances
         del batch_data
+    category_accuracy = all_reduce_sum(category_accuracy, args)
     acc = category_acc(category_accuracy, args)
-    print('Ave Category Acc: {:4.2f}'.format(acc.item() * 100))
+    if is_main_process(args):
+        print('Ave Category Acc: {:4.2f}'.format(acc.item() * 100))
 
 
 def validate(module, iterator, epoch, args):
@@ -140,31 +161,38 @@ def validate(module, iterator, epoch, args):
 
     module.eval()
     module.module.mode = 'val'
+    module.module.classifier.mode = 'val'
     # main loop
     tic = time.time()
     category_accuracy = torch.zeros(2, args.num_base_class)
+    confusion = torch.zeros(args.num_base_class, args.num_base_class) if args.confusion_matrix else None
     for i in range(args.val_epoch_iters):
         batch_data = next(iterator)
         data_time.update(time.time() - tic)
 
-        category_batch_acc, loss, acc, instances = module(batch_data)
+        outputs = module(batch_data)
+        category_batch_acc, loss, acc, instances = outputs[:4]
         category_batch_acc = category_batch_acc.detach().cpu()
         for j in range(len(args.gpus)):
             category_accuracy += category_batch_acc[2 * j:2 * j + 2, :]
+        # the counts of the replicas are concatenated
+        if confusion is not None:
+            confusion += outputs[4].detach().cpu().view(-1, args.num_base_class, args.num_base_class).sum(0)
 
         instances = instances.type_as(acc).detach().cpu()
         acc = acc.detach().cpu()
-        acc_actual = (acc * instances).sum() / instances.sum().float()
-        loss = (loss.detach().cpu() * instances).sum() / instances.sum().float()
+        instance_sum = all_reduce_sum(instances.sum().float(), args)
+        metrics = torch.stack([(acc * instances).sum(), (loss.detach().cpu() * instances).sum()])
+        acc_actual, loss = all_reduce_sum(metrics, args) / instance_sum
         # measure elapsed time
         batch_time.update(time.time() - tic)
         tic = time.time()
         # update average loss and acc
-        for k in range(int(instances.sum())):
+        for k in range(int(instance_sum)):
             ave_acc.update(acc_actual.data.item() * 100)
             ave_total_loss.update(loss.item())
 
-        if i % args.display_iter == 0:
+        if i % args.display_iter == 0 and is_main_process(args):
             print('Epoch: [{}][{}/{}], Time: {:.2f}, Data: {:.2f}, '
                   'Accuracy: {:4.2f}, Loss: {:.6f}, Acc-Iter: {:4.2f}'
                   .format(epoch, i, args.val_epoch_iters,
@@ -178,12 +206,23 @@ def validate(module, iterator, epoch, args):
             for tag, value in info.items():
                 args.logger.scalar_summary(tag, value, i + dispepoch * args.val_epoch_iters)
         del batch_data
-    print('Epoch: [{}], Accuracy: {:4.2f}'.format(epoch, ave_acc.average()))
+    category_accuracy = all_reduce_sum(category_accuracy, args)
     acc = category_acc(category_accuracy, args)
+    if confusion is not None:
+        confusion = all_reduce_sum(confusion, args)
+    if not is_main_process(args):
+        return
+    print('Epoch: [{}], Accuracy: {:4.2f}'.format(epoch, ave_acc.average()))
     print('Ave Category Acc: {:4.2f}'.format(acc.item() * 100))
+    if confusion is not None:
+        if not os.path.exists(args.ckpt):
+            os.makedirs(args.ckpt)
+        torch.save(confusion, '{}/confusion_epoch_{}.pth'.format(args.ckpt, epoch))
 
 
 def checkpoint(nets, args, epoch_num):
+    if not is_main_process(args):
+        return
     print('Saving checkpoints to {}...'.format(args.ckpt))
     if not os.path.exists(args.ckpt):
         os.makedirs(args.ckpt)
@@ -220,8 +259,19 @@ def train_adjust_lr_drop(optimizers, epoch, iteration, args):
     return None
 
 
+def report_padding(sampler, epoch, args):
+    """
+    :param epoch: epoch of the sampler, the epochs of the warm up included
+    """
+    if sampler is not None and is_main_process(args):
+        print('Padding efficiency: {:4.2f}'.format(sampler.padding_efficiency(epoch) * 100))
+
+
 def main(args):
     torch.backends.cudnn.deterministic = True
+    if args.index_batching:
+        # same initialization and loader worker seeds in every run
+        torch.manual_seed(args.seed)
     # Network Builders
     builder = ModelBuilder(args)
     feature_extractor = builder.build_backbone()
@@ -237,8 +287,10 @@ def main(args):
 
     dataset_train = BaseDataset(args.list_train, args)
     dataset_train.mode = 'train'
+    sampler_train = build_epoch_sampler(dataset_train, args)
     loader_train = DataLoader(
         dataset_train, batch_size=len(args.gpus), shuffle=False,
+        sampler=sampler_train,
         collate_fn=user_scattered_collate,
         num_workers=int(args.workers),
         drop_last=True,
@@ -246,18 +298,26 @@ def main(args):
     )
     dataset_val = BaseDataset(args.list_val, args)
     dataset_val.mode = 'val'
+    sampler_val = build_epoch_sampler(dataset_val, args)
     loader_val = DataLoader(
         dataset_val, batch_size=len(args.gpus), shuffle=False,
+        sampler=sampler_val,
         collate_fn=user_scattered_collate,
         num_workers=int(args.workers),
         drop_last=True,
         pin_memory=True
     )
 
-    args.train_epoch_iters = \
-        math.ceil(dataset_train.num_sample / (args.batch_size_per_gpu * len(args.gpus)))
-    args.val_epoch_iters = \
-        math.ceil(dataset_val.num_sample / (args.batch_size_per_gpu * len(args.gpus)))
+    if args.index_batching:
+        # an epoch is the planned batches, every image is seen once
+        args.train_epoch_iters = sampler_train.num_steps
+        args.val_epoch_iters = sampler_val.num_steps
+    else:
+        # the datasets of a distributed run are shards of the same size
+        args.train_epoch_iters = \
+            math.ceil(dataset_train.num_sample / (args.batch_size_per_gpu * len(args.gpus)))
+        args.val_epoch_iters = \
+            math.ceil(dataset_val.num_sample / (args.batch_size_per_gpu * len(args.gpus)))
     print('1 Train Epoch = {} iters'.format(args.train_epoch_iters))
     print('1 Val Epoch = {} iters'.format(args.val_epoch_iters))
     setattr(args, 'total_iters', args.train_epoch_iters * (args.num_epoch - args.start_epoch))
@@ -280,12 +340,23 @@ def main(args):
     if args.model_weight != '':
         selective_load_weights(network, args.model_weight)
     # set_fixed_weights(network)
-    network = UserScatteredDataParallel(network, device_ids=args.gpus)
-    patch_replication_callback(network)
-    network.cuda()
+    if args.distributed:
+        # the processes must make the same backbone calls, packing depends on the image sizes of each one
+        assert not args.pack_backbone, 'pack_backbone is not supported in distributed training'
+        patch_distributed_batchnorm(network)
+        network.to(args.device)
+        network = UserScatteredDistributedDataParallel(
+            network, device_ids=args.gpus if torch.cuda.is_available() else None, find_unused_parameters=True)
+    else:
+        network = UserScatteredDataParallel(network, device_ids=args.gpus)
+        patch_replication_callback(network)
+        network.cuda()
 
     args.isWarmUp = False
-    args.logger = Logger(os.path.join(args.log_dir, args.comment))
+    args.logger = Logger(os.path.join(args.log_dir, args.comment)) if is_main_process(args) else None
+    args.grad_scaler = build_grad_scaler(args)
+    # epoch of the batches planned by the train sampler
+    sampler_epoch = args.start_epoch
     # warm up
     if args.log == '' and args.start_epoch == 0 and args.model_weight == '':
         print('Start Warm Up')
@@ -293,6 +364,8 @@ def main(args):
         args.warm_up_iters = args.warm_up_epoch * args.train_epoch_iters
         for warm_up_epoch in range(args.warm_up_epoch):
             train(network, iterator_train, optimizers, warm_up_epoch, args)
+            report_padding(sampler_train, sampler_epoch, args)
+            sampler_epoch += 1
             validate(network, iterator_val, warm_up_epoch, args, )
             checkpoint(network, args, -args.warm_up_epoch + warm_up_epoch)
 
@@ -312,6 +385,8 @@ def main(args):
 
     for epoch in range(args.start_epoch, args.num_epoch):
         train(network, iterator_train, optimizers, epoch, args)
+        report_padding(sampler_train, sampler_epoch, args)
+        sampler_epoch += 1
         validate(network, iterator_val, epoch, args)
         checkpoint(network, args, epoch)
         torch.cuda.empty_cache()
@@ -333,6 +408,18 @@ if __name__ == '__main__':
     parser.add_argument('--padding_constant', default=8, type=int, help='max down sampling rate of the network')
     parser.add_argument('--down_sampling_rate', default=8, type=int, help='down sampling rate')
     parser.add_argument('--cls', default="Linear", type=str, help='classifier type')
+    parser.add_argument('--cos_temperature', default=10, type=float, help='temperature of the cosine classifier')
+    parser.add_argument('--learn_temperature', default=0, type=int, help='learn the temperature of the cosine classifier')
+    parser.add_argument('--confusion_matrix', default=0, type=int,
+                        help='save the confusion matrix of each validation to the ckpt folder')
+    parser.add_argument('--amp', default=0, type=int, help='mixed precision training')
+    parser.add_argument('--amp_dtype', default='float16', type=str,
+                        help='float16 or bfloat16 on cuda, the cpu autocast always uses bfloat16')
+    parser.add_argument('--channels_last', default=0, type=int, help='channels last memory format of the backbone')
+    parser.add_argument('--pack_backbone', default=0, type=int,
+                        help='run the images of the self supervision in the backbone calls of the step images')
+    parser.add_argument('--pack_max_padding', default=0., type=float,
+                        help='largest ratio of padded pixels when inputs of different sizes share a backbone call')
 
     # data loading arguments
     parser.add_argument('--supervision', default='supervision.json', type=str)
@@ -350,9 +437,36 @@ if __name__ == '__main__':
                         help='input image size of short edge (int or list)')
     parser.add_argument('--imgMaxSize', default=1500, type=int,
                         help='maximum input image size of long edge')
+    parser.add_argument('--img_cache_dir', default='',
+                        help='directory of the decoded image cache, empty to disable')
+    parser.add_argument('--img_cache_size', default=20, type=float,
+                        help='byte budget of the image cache in GB')
+    parser.add_argument('--index_batching', default=0, type=int,
+                        help='batches planned for each epoch from a seeded permutation, '
+                             'every image is seen once per epoch')
+    parser.add_argument('--seed', default=73, type=int, help='seed of the epoch permutations')
+    parser.add_argument('--aspect_bins', default='0.6,0.8,1,1.25,1.67', type=str,
+                        help='boundaries of the height / width ratio of the images batched together with '
+                             'index_batching, 1 for the two groups of h > w and h <= w')
+    parser.add_argument('--anchor_bins', default='', type=str,
+                        help='boundaries of the anchor count of the images batched together, e.g. 10,30')
+    parser.add_argument('--batch_max_anchors', default=0, type=int,
+                        help='fill the batches of index_batching up to this many anchors instead of '
+                             'batch_size_per_gpu images, 0 to disable')
+    parser.add_argument('--batch_max_pixels', default=0, type=float,
+                        help='fill the batches up to this many pixels of the padded tensor, 0 to disable')
+    parser.add_argument('--batch_max_images', default=8, type=int, help='images of a batch filled up to a budget')
 
     # running arguments
     parser.add_argument('--gpus', default=[0, 1, 2, 3], help='gpus to use, e.g. 0-3 or 0,1,2,3')
+    parser.add_argument('--distributed', default=0, type=int,
+                        help='one process for each device with DistributedDataParallel instead of the gpus')
+    parser.add_argument('--nproc_per_node', default=0, type=int,
+                        help='processes of a node, 0 for one for each gpu or a single one on cpu')
+    parser.add_argument('--nnodes', default=1, type=int)
+    parser.add_argument('--node_rank', default=0, type=int)
+    parser.add_argument('--dist_url', default='tcp://127.0.0.1:23456', help='address of the node 0 process')
+    parser.add_argument('--dist_backend', default='', help='nccl on cuda and gloo on cpu if empty')
     parser.add_argument('--batch_size_per_gpu', default=2, type=int, help='input batch size')
     parser.add_argument('--num_epoch', default=12, type=int, help='epochs to train for')
     parser.add_argument('--start_epoch', default=0, type=int,
@@ -390,4 +504,7 @@ if __name__ == '__main__':
     if args.log != '':
         args.model_weight = args.ckpt + 'net_epoch_' + args.log + '.pth'
 
-    main(args)
+    if args.distributed:
+        launch(main, args)
+    else:
+        main(args)